@@ -1,22 +1,33 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Form
-from fastapi.responses import FileResponse
-import shutil
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Form, Header, Query, BackgroundTasks, Response
 from pathlib import Path
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 import os
 import json
+import hashlib
 import random
+import time
 import google.generativeai as genai
 import traceback
 
+from common import analyses, bulkexport, coaching, compression, deadline, deid, drugnames, llm, metrics, notes, profiling, scheduling, slotboard, statestore, terminology, tracing
+from common.imaging import PerceptualCache, prepare_image
+from common import responses
+from common.responses import FastJSONResponse, RangedFileResponse
+from common.storage import BlobStore, UploadTooLarge
+
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
+app.add_middleware(profiling.ProfilerMiddleware)
+app.add_middleware(deadline.DeadlineMiddleware)
+app.add_middleware(tracing.TracingMiddleware, service_name="medx-api")
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(compression.CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -35,7 +46,7 @@ api_key = os.getenv("GOOGLE_API_KEY", "").strip()
 
 try:
     if api_key:
-        genai.configure(api_key=api_key)
+        llm.configure_gemini(genai, api_key)
         print("Gemini API configured successfully.")
     else:
         print("Critical Error: No API key available in environment variables.")
@@ -43,21 +54,54 @@ except Exception as e:
     print(f"Error configuring Gemini: {e}")
     api_key = None
 
-# Database Mock (In-memory for demo)
+# The mock medication list belongs to the single demo patient
+DEMO_PATIENT_ID = "demo"
+
+# Demo medications, adherence and audit logs. They live in the shared state store rather than in
+# process memory, so every worker (and every instance) sees the same lists.
 class MockDB:
-    def __init__(self):
-        self.medications = [
+    def __init__(self, store: statestore.SQLStateStore):
+        self.store = store
+        store.seed("medications", DEMO_PATIENT_ID, [
             {"id": "1", "name": "Metformin", "dosage": "500mg", "frequency": "Daily"},
             {"id": "2", "name": "Lisinopril", "dosage": "10mg", "frequency": "Daily"}
-        ]
-        self.adherence = []
-        self.audit_logs = [
+        ])
+        # Listed newest first, so seeded oldest first
+        store.seed("audit_logs", "", reversed([
             {"id": "a1", "timestamp": "2026-01-06T10:00:00Z", "action": "Note Analysis", "user": "Dr. Smith", "status": "Success"},
             {"id": "a2", "timestamp": "2026-01-06T10:15:00Z", "action": "Prescription OCR", "user": "Scanner-01", "status": "Success"},
             {"id": "a3", "timestamp": "2026-01-06T10:30:00Z", "action": "Interaction Check", "user": "Dr. Smith", "status": "Warning"},
-        ]
+        ]))
+
+    @property
+    def medications(self) -> List[dict]:
+        return self.store.list("medications", DEMO_PATIENT_ID)
+
+    @property
+    def medications_version(self) -> int:
+        return self.store.version("medications", DEMO_PATIENT_ID)
+
+    @property
+    def adherence(self) -> List[dict]:
+        return self.store.list("adherence")
+
+    @property
+    def audit_logs(self) -> List[dict]:
+        return self.store.list("audit_logs", newest_first=True)
+
+    def add_medication(self, medication: dict) -> dict:
+        return self.store.add("medications", DEMO_PATIENT_ID, medication)
+
+    def delete_medication(self, med_id: str) -> bool:
+        return self.store.delete("medications", DEMO_PATIENT_ID, med_id)
+
+    def log_adherence(self, data: dict) -> dict:
+        return self.store.add("adherence", "", data)
 
-db = MockDB()
+    def audit(self, action: str, user: str, status: str, timestamp: str = "Just now"):
+        self.store.add("audit_logs", "", {
+            "id": os.urandom(4).hex(), "timestamp": timestamp, "action": action, "user": user, "status": status,
+        })
 
 # Models
 class ClinicalNote(BaseModel):
@@ -80,10 +124,11 @@ class ChatRequest(BaseModel):
     role: str = ""
 
 # Endpoints
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime
-from datetime import datetime
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Boolean, ForeignKey, DateTime, Index, case, text
+from datetime import date, datetime, timedelta
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.exc import IntegrityError
 import bcrypt
 from fastapi import Depends
 
@@ -120,6 +165,9 @@ else:
     SQLALCHEMY_DATABASE_URL = f"sqlite:///{db_path}"
     engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
     
+metrics.instrument_engine(engine)
+tracing.instrument_engine(engine)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -173,6 +221,8 @@ def run_migrations():
                 conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS address VARCHAR"))
                 conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS medical_history VARCHAR"))
                 conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS google_id VARCHAR"))
+                conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash VARCHAR"))
+                conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS file_size INTEGER"))
                 
                 # Create documents table if not exists (create_all handles this usually, but good to be sure for relationships)
                 # Actually create_all below handles new tables. We just need to patch existing ones.
@@ -212,6 +262,9 @@ class Appointment(Base):
     doctor = relationship("User", foreign_keys=[doctor_id], back_populates="doctor_appointments")
     patient = relationship("User", foreign_keys=[patient_id], back_populates="patient_appointments")
 
+    # Used by the overlap re-check when an appointment is booked
+    __table_args__ = (Index("ix_appointments_doctor_time", "doctor_id", "date_time"),)
+
 class Document(Base):
     __tablename__ = "documents"
     id = Column(Integer, primary_key=True, index=True)
@@ -219,18 +272,43 @@ class Document(Base):
     filename = Column(String)
     file_type = Column(String)
     file_path = Column(String)
+    content_hash = Column(String, index=True, nullable=True)
+    file_size = Column(Integer, nullable=True)
     upload_date = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="documents")
 
+class Blob(Base):
+    __tablename__ = "blobs"
+    sha256 = Column(String, primary_key=True)
+    size = Column(Integer)
+    ref_count = Column(Integer, default=0)
+
+class EntityVersion(Base):
+    """Change counter per scope ("org:1", "doctor:7", "patient:12"); listing ETags are built from it."""
+    __tablename__ = "entity_versions"
+    scope = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
 
 startup_error = None
 try:
     Base.metadata.create_all(bind=engine)
+    # create_all skips indexes on tables that already existed
+    for index in Appointment.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
 except Exception as e:
     startup_error = f"Database startup error: {str(e)}\n{traceback.format_exc()}"
     print(startup_error)
 
+# Shared demo state goes in the main database unless STATE_DATABASE_URL points elsewhere
+STATE_DATABASE_URL = os.getenv("STATE_DATABASE_URL")
+db = MockDB(statestore.open_store(STATE_DATABASE_URL) if STATE_DATABASE_URL else statestore.SQLStateStore(engine))
+
+# Note analyses are kept per patient and note; the clinical service can share them via ANALYSIS_DATABASE_URL
+ANALYSIS_DATABASE_URL = os.getenv("ANALYSIS_DATABASE_URL")
+analysis_store = analyses.open_store(ANALYSIS_DATABASE_URL) if ANALYSIS_DATABASE_URL else analyses.AnalysisStore(engine)
+
 # Security (Using bcrypt directly)
 def verify_password(plain_password, hashed_password):
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
@@ -245,6 +323,27 @@ def get_db():
     finally:
         db.close()
 
+# Listing versions. Writes bump the scopes they touched once their own commit is done, so a client
+# that sees a new version also sees the new rows; a 304 only needs the one entity_versions row.
+def bump_versions(db: Session, *scopes: Optional[str]):
+    for scope in dict.fromkeys(s for s in scopes if s):
+        for _ in range(2):
+            updated = db.query(EntityVersion).filter(EntityVersion.scope == scope).update(
+                {EntityVersion.version: EntityVersion.version + 1})
+            if not updated:
+                # First change in this scope: start from the clock so versions never repeat after a reset
+                db.add(EntityVersion(scope=scope, version=int(time.time() * 1000)))
+            try:
+                db.commit()
+                break
+            except IntegrityError:
+                # Another writer created the row first; retry as an increment
+                db.rollback()
+
+def listing_etag(db: Session, kind: str, scope: str) -> str:
+    version = db.query(EntityVersion.version).filter(EntityVersion.scope == scope).scalar() or 0
+    return f'W/"{kind}-{scope}-{version}"'
+
 # Auth Models
 # Auth Models
 class UserCreate(BaseModel):
@@ -318,6 +417,70 @@ class Token(BaseModel):
 class VerifyPasswordRequest(BaseModel):
     password: str
 
+# Response models for the listings. The endpoints build rows straight from column queries and
+# return FastJSONResponse, so these document the shape without a validation pass per row.
+class OrgDoctorOut(BaseModel):
+    id: int
+    full_name: Optional[str]
+    email: Optional[str]
+    specialization: Optional[str]
+    availability: Optional[str]
+    is_active: Optional[bool]
+    gender: Optional[str]
+
+class DoctorOut(BaseModel):
+    id: int
+    full_name: Optional[str]
+    specialization: Optional[str]
+    availability: Optional[str]
+    organization_id: Optional[int]
+    organization_name: str
+    rating: float
+    gender: Optional[str]
+
+class OrgAppointmentOut(BaseModel):
+    id: int
+    doctor_name: Optional[str]
+    doctor_specialization: Optional[str]
+    patient_name: Optional[str]
+    date_time: datetime
+    reason: Optional[str]
+    status: Optional[str]
+
+class DoctorAppointmentOut(BaseModel):
+    id: int
+    patient_name: Optional[str]
+    date_time: datetime
+    reason: Optional[str]
+    status: Optional[str]
+    diagnosis: Optional[str]
+    treatment_notes: Optional[str]
+
+class PatientAppointmentOut(BaseModel):
+    id: int
+    doctor_id: Optional[int]
+    organization_id: Optional[int]
+    doctor_name: Optional[str]
+    specialization: Optional[str]
+    date_time: datetime
+    reason: Optional[str]
+    status: Optional[str]
+    diagnosis: Optional[str]
+    treatment_notes: Optional[str]
+
+class HistoryEntryOut(BaseModel):
+    date: datetime
+    doctor_name: Optional[str]
+    diagnosis: Optional[str]
+    treatment_notes: Optional[str]
+
+class DocumentOut(BaseModel):
+    id: int
+    filename: Optional[str]
+    file_type: Optional[str]
+    file_size: Optional[int]
+    upload_date: Optional[datetime]
+
 # Endpoints
 # Endpoints
 @app.post("/api/register")
@@ -526,27 +689,27 @@ async def add_doctor(doctor: OrgDoctorCreate, db: Session = Depends(get_db)):
     )
     db.add(new_doctor)
     db.commit()
+    bump_versions(db, f"org:{doctor.organization_id}:doctors")
+    doctors_changed()
     return {"status": "success", "message": "Doctor added successfully"}
 
-@app.get("/api/org/doctors")
-async def get_doctors(organization_id: int, search: Optional[str] = None, db: Session = Depends(get_db)):
-    query = db.query(User).filter(User.organization_id == organization_id, User.role == "doctor")
+@app.get("/api/org/doctors", response_model=List[OrgDoctorOut])
+async def get_doctors(organization_id: int, search: Optional[str] = None,
+                      if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    etag = listing_etag(db, "doctors", f"org:{organization_id}:doctors")
+    unchanged = responses.not_modified(if_none_match, etag)
+    if unchanged:
+        return unchanged
+    query = db.query(
+        User.id, User.full_name, User.email, User.specialization, User.availability, User.is_active, User.gender,
+    ).filter(User.organization_id == organization_id, User.role == "doctor")
     if search:
         search_filter = f"%{search}%"
         query = query.filter(
             (User.full_name.ilike(search_filter)) | 
             (User.specialization.ilike(search_filter))
         )
-    doctors = query.all()
-    return [{
-        "id": d.id, 
-        "full_name": d.full_name, 
-        "email": d.email, 
-        "specialization": d.specialization,
-        "availability": d.availability,
-        "is_active": d.is_active,
-        "gender": d.gender
-    } for d in doctors]
+    return FastJSONResponse(responses.rows_to_dicts(query), headers=responses.validator_headers(etag))
 
 @app.put("/api/org/doctors/{doctor_id}")
 async def update_doctor(doctor_id: int, doctor: OrgDoctorUpdate, db: Session = Depends(get_db)):
@@ -564,6 +727,10 @@ async def update_doctor(doctor_id: int, doctor: OrgDoctorUpdate, db: Session = D
         db_doctor.gender = doctor.gender
     
     db.commit()
+    # Doctor names and specializations also appear in the organization's appointment listing
+    listed = f"org:{db_doctor.organization_id}:appointments" if doctor.full_name or doctor.specialization else None
+    bump_versions(db, f"org:{db_doctor.organization_id}:doctors", listed)
+    doctors_changed(doctor_id)
     return {"status": "success", "message": "Doctor updated"}
 
 @app.delete("/api/org/doctors/{doctor_id}")
@@ -572,30 +739,234 @@ async def delete_doctor(doctor_id: int, db: Session = Depends(get_db)):
     if not db_doctor:
         raise HTTPException(status_code=404, detail="Doctor not found")
     
+    organization_id = db_doctor.organization_id
     db.delete(db_doctor)
     db.commit()
+    # The organization's appointments now list the doctor as "Unknown"
+    bump_versions(db, f"org:{organization_id}:doctors", f"org:{organization_id}:appointments", f"doctor:{doctor_id}")
+    doctors_changed(doctor_id)
     return {"status": "success", "message": "Doctor removed"}
 
-# Appointment Endpoints
-@app.get("/api/org/appointments")
-async def get_appointments(organization_id: int, db: Session = Depends(get_db)):
-    appointments = db.query(Appointment).filter(Appointment.organization_id == organization_id).order_by(Appointment.date_time.desc()).all()
-    return [{
-        "id": a.id,
-        "doctor_name": a.doctor.full_name if a.doctor else "Unknown",
-        "doctor_specialization": a.doctor.specialization if a.doctor else "",
-        "patient_name": a.patient_name,
-        "date_time": a.date_time.isoformat(),
-        "reason": a.reason,
-        "status": a.status
-    } for a in appointments]
+# Appointment Scheduling
+def load_doctor_schedule(doctor_id: int):
+    """Upcoming scheduled appointments of one doctor, for the in-memory calendar."""
+    db = SessionLocal()
+    try:
+        since = scheduling.now() - timedelta(days=1)
+        return db.query(Appointment.id, Appointment.date_time).filter(
+            Appointment.doctor_id == doctor_id,
+            Appointment.status == "Scheduled",
+            Appointment.date_time >= since,
+        ).all()
+    finally:
+        db.close()
 
-@app.post("/api/org/appointments")
-async def create_appointment(appt: AppointmentCreate, db: Session = Depends(get_db)):
+schedule_index = scheduling.ScheduleIndex(load_doctor_schedule)
+
+def load_slot_board(organization_id: Optional[int], since: date):
+    """Doctors (of one organization, or all) and their scheduled appointments from a date on."""
+    db = SessionLocal()
+    try:
+        query = db.query(User).filter(User.role == "doctor")
+        if organization_id is not None:
+            query = query.filter(User.organization_id == organization_id)
+        doctors = [slotboard.DoctorRow(
+            d.id, d.full_name, d.specialization, d.organization_id,
+            d.organization.name if d.organization else "Unknown", d.availability,
+        ) for d in query.all()]
+        appointments = db.query(Appointment.doctor_id, Appointment.date_time).filter(
+            Appointment.doctor_id.in_([d.doctor_id for d in doctors]),
+            Appointment.status == "Scheduled",
+            Appointment.date_time >= datetime.combine(since, datetime.min.time()),
+        ).all()
+        return doctors, appointments
+    finally:
+        db.close()
+
+slot_boards = slotboard.SlotBoards(load_slot_board) if slotboard.NUMPY_AVAILABLE else None
+
+def appointment_booked(doctor_id: int, appt_id: int, dt: datetime):
+    schedule_index.add(doctor_id, appt_id, dt)
+    if slot_boards:
+        slot_boards.book(doctor_id, dt)
+
+def appointment_released(doctor_id: int, appt_id: int, dt: datetime):
+    schedule_index.remove(doctor_id, appt_id)
+    if slot_boards:
+        slot_boards.release(doctor_id, dt)
+
+def doctors_changed(doctor_id: Optional[int] = None):
+    if doctor_id is not None:
+        schedule_index.drop(doctor_id)
+    if slot_boards:
+        slot_boards.invalidate()
+
+def parse_appointment_time(value: str) -> datetime:
+    try:
+        return scheduling.wall_time(datetime.fromisoformat(value.replace('Z', '+00:00')))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+
+def lock_bookings(db: Session):
+    """
+    On SQLite, takes the database write lock before the overlap check. pysqlite runs SELECTs outside
+    any transaction and only BEGINs before the first write, so without this two workers could both
+    find a slot free and both book it. Elsewhere the doctor row lock in check_slot does this.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    # Already inside a write transaction (an earlier flush): the lock is held until commit
+    if not db.connection().connection.driver_connection.in_transaction:
+        db.execute(text("BEGIN IMMEDIATE"))
+
+def check_slot(db: Session, doctor_id: int, dt: datetime, enforce_hours: bool, ignore: Optional[int] = None):
+    """
+    Raises 404 if doctor_id is not a doctor, and 409 if the doctor is booked (or, for patient
+    bookings, not available) at dt. Bookings for a doctor are serialized from here until commit.
+    """
+    lock_bookings(db)
+    # Postgres: later bookings for this doctor wait on the row lock until we commit
+    doctor = db.query(User).filter(User.id == doctor_id, User.role == "doctor").with_for_update().first()
+    if not doctor:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    if enforce_hours:
+        template = scheduling.parse_availability(doctor.availability)
+        if template and not template.contains(dt):
+            raise HTTPException(status_code=409, detail="Requested time is outside the doctor's availability")
+    # The database decides; the in-memory calendar can be a TTL behind other workers' bookings and cancellations
+    length = timedelta(minutes=scheduling.APPOINTMENT_MINUTES)
+    clash = db.query(Appointment.id).filter(
+        Appointment.doctor_id == doctor_id,
+        Appointment.status == "Scheduled",
+        Appointment.date_time > dt - length,
+        Appointment.date_time < dt + length,
+        Appointment.id != (ignore or 0),
+    ).first()
+    if bool(clash) != bool(schedule_index.conflicts(doctor_id, dt, ignore)):
+        # The calendar disagrees with the database; reload it on next use
+        doctors_changed(doctor_id)
+    if clash:
+        raise HTTPException(status_code=409, detail="Doctor already has an appointment at this time")
+
+def doctor_slot(doctor: slotboard.DoctorRow, start: str) -> Dict[str, Any]:
+    return {
+        "doctor_id": doctor.doctor_id,
+        "full_name": doctor.full_name,
+        "specialization": doctor.specialization,
+        "organization_id": doctor.organization_id,
+        "organization_name": doctor.organization_name,
+        "start": start,
+    }
+
+def calendar_slots(db: Session, specialization: Optional[str], organization_id: Optional[int],
+                   start: datetime, end: datetime, per_doctor: int, taken: Dict[int, int]) -> List[Tuple[int, slotboard.DoctorRow]]:
+    """
+    (start minute, doctor) openings in [start, end) from the per-doctor calendars, in time order:
+    up to per_doctor for each doctor, less the taken[doctor_id] already found elsewhere.
+    """
+    query = db.query(User).filter(User.role == "doctor")
+    if organization_id is not None:
+        query = query.filter(User.organization_id == organization_id)
+    if specialization:
+        query = query.filter(User.specialization.ilike(f"%{specialization}%"))
+    end_minute = scheduling.minute_of(end)
+    candidates = []
+    for d in query.all():
+        template = scheduling.parse_availability(d.availability)
+        wanted = per_doctor - taken.get(d.id, 0)
+        if not template or wanted <= 0:
+            continue
+        minutes = schedule_index.free_slots(d.id, template, start.date(), end.date(), after=start)
+        row = slotboard.DoctorRow(d.id, d.full_name, d.specialization, d.organization_id,
+                                  d.organization.name if d.organization else "Unknown", d.availability)
+        candidates += [(minute, row) for minute in minutes[:wanted] if minute < end_minute]
+    candidates.sort(key=lambda c: (c[0], c[1].doctor_id))
+    return candidates
+
+@app.get("/api/doctors/next-available")
+async def next_available(specialization: Optional[str] = None, organization_id: Optional[int] = None,
+                         start: Optional[str] = None, end: Optional[str] = None,
+                         limit: int = 10, per_doctor: int = 3, db: Session = Depends(get_db)):
+    """
+    Earliest open appointment times across all matching doctors (default window: the next 14 days).
+    The slot board covers the next SLOT_HORIZON_DAYS; later parts of the window use the per-doctor calendars.
+    """
+    now = scheduling.now()
+    window_start = max(parse_appointment_time(start), now) if start else now
+    window_end = parse_appointment_time(end) if end else window_start + timedelta(days=14)
+    limit, per_doctor = max(1, min(limit, 100)), max(1, per_doctor)
+
+    slots = []
+    taken: Dict[int, int] = {}
+    # Calendars cover the whole window without numpy, and whatever lies past the board's horizon otherwise
+    calendar_start = window_start
+    if slot_boards:
+        board = slot_boards.board(organization_id)
+        found = board.search(start=window_start, end=window_end, specialization=specialization,
+                             limit=limit, per_doctor=per_doctor)
+        for found_slot in found:
+            slots.append(doctor_slot(found_slot.doctor, found_slot.start.isoformat()))
+            taken[found_slot.doctor.doctor_id] = taken.get(found_slot.doctor.doctor_id, 0) + 1
+        calendar_start = max(window_start, board.end)
+    if len(slots) < limit and calendar_start < window_end:
+        candidates = calendar_slots(db, specialization, organization_id, calendar_start, window_end, per_doctor, taken)
+        slots += [doctor_slot(row, scheduling.isoformat(minute)) for minute, row in candidates[:limit - len(slots)]]
+
+    return {"appointment_minutes": scheduling.APPOINTMENT_MINUTES, "slots": slots}
+
+@app.get("/api/doctors/{doctor_id}/slots")
+async def get_doctor_slots(doctor_id: int, start_date: Optional[str] = None, end_date: Optional[str] = None, db: Session = Depends(get_db)):
+    """Free appointment slots for a doctor between two dates (inclusive, default the next 7 days)."""
+    doctor = db.query(User).filter(User.id == doctor_id, User.role == "doctor").first()
+    if not doctor:
+        raise HTTPException(status_code=404, detail="Doctor not found")
     try:
-        dt = datetime.fromisoformat(appt.date_time.replace('Z', '+00:00'))
+        first = date.fromisoformat(start_date) if start_date else scheduling.today()
+        last = date.fromisoformat(end_date) if end_date else first + timedelta(days=6)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format")
+    if last < first or (last - first).days > 92:
+        raise HTTPException(status_code=400, detail="Date range must be between 1 and 93 days")
+
+    template = scheduling.parse_availability(doctor.availability)
+    slots = schedule_index.free_slots(doctor_id, template, first, last, after=scheduling.now()) if template else []
+    return {
+        "doctor_id": doctor_id,
+        "availability": doctor.availability,
+        "schedule": template.to_dict() if template else None,
+        "slot_minutes": scheduling.APPOINTMENT_MINUTES,
+        "slots": [scheduling.isoformat(minute) for minute in slots],
+    }
+
+# Appointment Endpoints
+# Doctor columns for appointment listings (outer-joined on Appointment.doctor_id)
+DOCTOR_NAME = case((User.id.is_(None), "Unknown"), else_=User.full_name)
+DOCTOR_SPECIALIZATION = case((User.id.is_(None), ""), else_=User.specialization)
+
+@app.get("/api/org/appointments", response_model=List[OrgAppointmentOut])
+async def get_appointments(organization_id: int, if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    etag = listing_etag(db, "appointments", f"org:{organization_id}:appointments")
+    unchanged = responses.not_modified(if_none_match, etag)
+    if unchanged:
+        return unchanged
+    rows = db.query(
+        Appointment.id,
+        DOCTOR_NAME.label("doctor_name"),
+        DOCTOR_SPECIALIZATION.label("doctor_specialization"),
+        Appointment.patient_name,
+        Appointment.date_time,
+        Appointment.reason,
+        Appointment.status,
+    ).outerjoin(User, User.id == Appointment.doctor_id).filter(
+        Appointment.organization_id == organization_id
+    ).order_by(Appointment.date_time.desc())
+    return FastJSONResponse(responses.rows_to_dicts(rows), headers=responses.validator_headers(etag))
+
+@app.post("/api/org/appointments")
+async def create_appointment(appt: AppointmentCreate, db: Session = Depends(get_db)):
+    dt = parse_appointment_time(appt.date_time)
+    # Staff may book outside the published hours, but never on top of another appointment
+    check_slot(db, appt.doctor_id, dt, enforce_hours=False)
 
     new_appt = Appointment(
         organization_id=appt.organization_id,
@@ -606,6 +977,8 @@ async def create_appointment(appt: AppointmentCreate, db: Session = Depends(get_
     )
     db.add(new_appt)
     db.commit()
+    bump_versions(db, f"org:{appt.organization_id}:appointments", f"doctor:{appt.doctor_id}")
+    appointment_booked(appt.doctor_id, new_appt.id, dt)
     return {"status": "success", "message": "Appointment scheduled"}
 
 @app.put("/api/org/appointments/{appt_id}")
@@ -614,24 +987,31 @@ async def update_appointment(appt_id: int, status_update: AppointmentUpdate, db:
     if not appt:
         raise HTTPException(status_code=404, detail="Appointment not found")
     
+    was_scheduled = appt.status == "Scheduled"
+    if status_update.status == "Scheduled" and not was_scheduled:
+        check_slot(db, appt.doctor_id, appt.date_time, enforce_hours=False, ignore=appt.id)
     appt.status = status_update.status
     db.commit()
+    bump_versions(db, f"org:{appt.organization_id}:appointments", f"doctor:{appt.doctor_id}")
+    if appt.status == "Scheduled" and not was_scheduled:
+        appointment_booked(appt.doctor_id, appt.id, appt.date_time)
+    elif appt.status != "Scheduled" and was_scheduled:
+        appointment_released(appt.doctor_id, appt.id, appt.date_time)
     return {"status": "success"}
 
 # Doctor Endpoints
-@app.get("/api/doctor/appointments")
-async def get_doctor_appointments(doctor_id: int, db: Session = Depends(get_db)):
+@app.get("/api/doctor/appointments", response_model=List[DoctorAppointmentOut])
+async def get_doctor_appointments(doctor_id: int, if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
     # In real app, doctor_id comes from JWT
-    appointments = db.query(Appointment).filter(Appointment.doctor_id == doctor_id).order_by(Appointment.date_time.asc()).all()
-    return [{
-        "id": a.id,
-        "patient_name": a.patient_name,
-        "date_time": a.date_time.isoformat(),
-        "reason": a.reason,
-        "status": a.status,
-        "diagnosis": a.diagnosis,
-        "treatment_notes": a.treatment_notes
-    } for a in appointments]
+    etag = listing_etag(db, "appointments", f"doctor:{doctor_id}")
+    unchanged = responses.not_modified(if_none_match, etag)
+    if unchanged:
+        return unchanged
+    rows = db.query(
+        Appointment.id, Appointment.patient_name, Appointment.date_time, Appointment.reason,
+        Appointment.status, Appointment.diagnosis, Appointment.treatment_notes,
+    ).filter(Appointment.doctor_id == doctor_id).order_by(Appointment.date_time.asc())
+    return FastJSONResponse(responses.rows_to_dicts(rows), headers=responses.validator_headers(etag))
 
 @app.put("/api/doctor/appointments/{appt_id}/complete")
 async def complete_appointment(appt_id: int, data: AppointmentComplete, db: Session = Depends(get_db)):
@@ -639,56 +1019,58 @@ async def complete_appointment(appt_id: int, data: AppointmentComplete, db: Sess
     if not appt:
         raise HTTPException(status_code=404, detail="Appointment not found")
     
+    was_scheduled = appt.status == "Scheduled"
     appt.status = "Completed"
     appt.diagnosis = data.diagnosis
     appt.treatment_notes = data.treatment_notes
     db.commit()
+    bump_versions(db, f"org:{appt.organization_id}:appointments", f"doctor:{appt.doctor_id}")
+    if was_scheduled:
+        appointment_released(appt.doctor_id, appt.id, appt.date_time)
     return {"status": "success", "message": "Consultation completed"}
 
-@app.get("/api/doctor/patients/{patient_name}/history")
+@app.get("/api/doctor/patients/{patient_name}/history", response_model=List[HistoryEntryOut])
 async def get_patient_history(patient_name: str, db: Session = Depends(get_db)):
     # Simple search by name substring
-    appointments = db.query(Appointment).filter(Appointment.patient_name.ilike(f"%{patient_name}%"), Appointment.status == "Completed").order_by(Appointment.date_time.desc()).all()
-    return [{
-        "date": a.date_time.isoformat(),
-        "doctor_name": a.doctor.full_name if a.doctor else "Unknown",
-        "diagnosis": a.diagnosis,
-        "treatment_notes": a.treatment_notes
-    } for a in appointments]
+    rows = db.query(
+        Appointment.date_time.label("date"), DOCTOR_NAME.label("doctor_name"), Appointment.diagnosis, Appointment.treatment_notes,
+    ).outerjoin(User, User.id == Appointment.doctor_id).filter(
+        Appointment.patient_name.ilike(f"%{patient_name}%"), Appointment.status == "Completed"
+    ).order_by(Appointment.date_time.desc())
+    return FastJSONResponse(responses.rows_to_dicts(rows))
 
 # Patient Endpoints
-@app.get("/api/doctors")
+@app.get("/api/doctors", response_model=List[DoctorOut])
 async def get_all_doctors(specialization: Optional[str] = None, db: Session = Depends(get_db)):
-    query = db.query(User).filter(User.role == "doctor")
+    query = db.query(
+        User.id, User.full_name, User.specialization, User.availability, User.organization_id,
+        case((Organization.id.is_(None), "Unknown"), else_=Organization.name).label("organization_name"),
+        User.gender,
+    ).outerjoin(Organization, Organization.id == User.organization_id).filter(User.role == "doctor")
     if specialization:
         query = query.filter(User.specialization.ilike(f"%{specialization}%"))
-    doctors = query.all()
-    return [{
-        "id": d.id,
-        "full_name": d.full_name,
-        "specialization": d.specialization,
-        "availability": d.availability,
-        "organization_id": d.organization_id,
-        "organization_name": d.organization.name if d.organization else "Unknown",
-        "rating": round(random.uniform(3.5, 5.0), 1),
-        "gender": d.gender
-    } for d in doctors]
-
-@app.get("/api/patient/appointments")
+    doctors = responses.rows_to_dicts(query)
+    for d in doctors:
+        d["rating"] = round(random.uniform(3.5, 5.0), 1)
+    return FastJSONResponse(doctors)
+
+@app.get("/api/patient/appointments", response_model=List[PatientAppointmentOut])
 async def get_patient_appointments(patient_id: int, db: Session = Depends(get_db)):
-    appointments = db.query(Appointment).filter(Appointment.patient_id == patient_id).order_by(Appointment.date_time.desc()).all()
-    return [{
-        "id": a.id,
-        "doctor_id": a.doctor.id if a.doctor else None,
-        "organization_id": a.organization_id,
-        "doctor_name": a.doctor.full_name if a.doctor else "Unknown",
-        "specialization": a.doctor.specialization if a.doctor else "",
-        "date_time": a.date_time.isoformat(),
-        "reason": a.reason,
-        "status": a.status,
-        "diagnosis": a.diagnosis,
-        "treatment_notes": a.treatment_notes
-    } for a in appointments]
+    rows = db.query(
+        Appointment.id,
+        User.id.label("doctor_id"),
+        Appointment.organization_id,
+        DOCTOR_NAME.label("doctor_name"),
+        DOCTOR_SPECIALIZATION.label("specialization"),
+        Appointment.date_time,
+        Appointment.reason,
+        Appointment.status,
+        Appointment.diagnosis,
+        Appointment.treatment_notes,
+    ).outerjoin(User, User.id == Appointment.doctor_id).filter(
+        Appointment.patient_id == patient_id
+    ).order_by(Appointment.date_time.desc())
+    return FastJSONResponse(responses.rows_to_dicts(rows))
 
 @app.post("/api/patient/appointments")
 async def book_appointment(appt: AppointmentCreate, db: Session = Depends(get_db)):
@@ -703,10 +1085,8 @@ async def book_appointment(appt: AppointmentCreate, db: Session = Depends(get_db
     # Wait, I can't update it in this chunk easily if it's far away.
     # I'll create a new model `PatientAppointmentCreate` or just update `AppointmentCreate` in a separate chunk.
     # For now, let's assume I will update `AppointmentCreate` to include `patient_id`.
-    try:
-        dt = datetime.fromisoformat(appt.date_time.replace('Z', '+00:00'))
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid date format")
+    dt = parse_appointment_time(appt.date_time)
+    check_slot(db, appt.doctor_id, dt, enforce_hours=True)
 
     # We need to find the patient_id.
     # Since we don't have auth middleware yet injecting user ID, we rely on the frontend sending it.
@@ -723,6 +1103,8 @@ async def book_appointment(appt: AppointmentCreate, db: Session = Depends(get_db
     )
     db.add(new_appt)
     db.commit()
+    bump_versions(db, f"org:{appt.organization_id}:appointments", f"doctor:{appt.doctor_id}")
+    appointment_booked(appt.doctor_id, new_appt.id, dt)
     return {"status": "success", "message": "Appointment booked"}
 
 @app.put("/api/patient/appointments/{appt_id}/cancel")
@@ -731,8 +1113,12 @@ async def cancel_patient_appointment(appt_id: int, db: Session = Depends(get_db)
     if not appt:
         raise HTTPException(status_code=404, detail="Appointment not found")
     
+    was_scheduled = appt.status == "Scheduled"
     appt.status = "Cancelled"
     db.commit()
+    bump_versions(db, f"org:{appt.organization_id}:appointments", f"doctor:{appt.doctor_id}")
+    if was_scheduled:
+        appointment_released(appt.doctor_id, appt.id, appt.date_time)
     return {"status": "success", "message": "Appointment cancelled"}
 
 @app.get("/api/patient/profile")
@@ -801,48 +1187,58 @@ async def health_check():
     except Exception as e:
         db_status = f"disconnected: {str(e)}"
 
-    return {"status": "healthy", "service": "consolidated-api", "database": db_status}
+    return {
+        "status": "healthy",
+        "service": "consolidated-api",
+        "database": db_status,
+        "llm": llm.stats()
+    }
+
+# Prometheus scrape target; set METRICS_TOKEN to require a bearer token
+app.add_route("/metrics", metrics.metrics_endpoint, include_in_schema=False)
+app.add_route("/api/metrics", metrics.metrics_endpoint, include_in_schema=False)
+# Slow-request profiles and runtime profiler switch; needs PROFILER_TOKEN
+app.include_router(profiling.router, prefix="/api")
 
 @app.get("/api/audit-log")
 async def get_audit_logs():
-    return db.audit_logs
+    return FastJSONResponse(db.audit_logs)
 
 @app.get("/api/medications")
-async def get_medications():
-    return db.medications
+async def get_medications(if_none_match: Optional[str] = Header(None)):
+    etag = f'W/"medications-patient:{DEMO_PATIENT_ID}-{db.medications_version}"'
+    unchanged = responses.not_modified(if_none_match, etag)
+    if unchanged:
+        return unchanged
+    return FastJSONResponse(db.medications, headers=responses.validator_headers(etag))
 
 @app.post("/api/medications")
 async def add_medication(med: Medication):
     import uuid
-    med_dict = med.dict()
+    med_dict = drugnames.annotate(med.dict())
     med_dict["id"] = str(uuid.uuid4())
-    db.medications.append(med_dict)
+    db.add_medication(med_dict)
+    coaching_worker.schedule(DEMO_PATIENT_ID, db.medications)
     return {"status": "success", "data": med_dict}
 
 @app.delete("/api/medications/{med_id}")
 async def delete_medication(med_id: str):
-    initial_len = len(db.medications)
-    db.medications = [m for m in db.medications if m["id"] != med_id]
-    if len(db.medications) == initial_len:
+    if not db.delete_medication(med_id):
         raise HTTPException(status_code=404, detail="Medication not found")
+    coaching_worker.schedule(DEMO_PATIENT_ID, db.medications)
     return {"status": "success"}
 
 @app.post("/api/adherence")
 async def log_adherence(data: Dict[str, Any]):
-    db.adherence.append(data)
+    db.log_adherence(data)
     # Add to audit log too
-    db.audit_logs.insert(0, {
-        "id": os.urandom(4).hex(),
-        "timestamp": data.get("timestamp", "Just now"),
-        "action": f"Adherence Log: {data.get('medication_id')}",
-        "user": "System",
-        "status": data.get("status", "Logged")
-    })
+    db.audit(f"Adherence Log: {data.get('medication_id')}", "System", data.get("status", "Logged"),
+             timestamp=data.get("timestamp", "Just now"))
     return {"status": "success"}
 
 @app.get("/api/adherence")
 async def get_adherence():
-    return db.adherence
+    return FastJSONResponse(db.adherence)
 
 @app.post("/api/chat")
 @app.post("/api/ai/chat")
@@ -873,33 +1269,53 @@ Keep your answers concise, helpful, and friendly. Guide the user based on their
         for msg in req.history:
             gemini_history.append({"role": "user" if msg["role"] == "user" else "model", "parts": [msg["content"]]})
         
-        chat = model.start_chat(history=gemini_history)
-        
-        response = chat.send_message(req.message)
+        async def send():
+            # A fresh chat session per attempt, so a hedged copy never shares history state
+            response = await llm.call(
+                lambda: llm.send_message(model.start_chat(history=gemini_history), req.message),
+                llm.Priority.BACKGROUND,
+                kind="chat"
+            )
+            return response.text
         
-        return {"response": response.text}
+        # Frontend retries resend the exact same conversation
+        payload = {"message": req.message, "history": req.history, "context": req.context, "role": req.role}
+        return {"response": await llm.coalesced("chat", payload, send)}
     except Exception as e:
         traceback.print_exc()
         return {"response": f"I encountered an error while processing your request: {str(e)}"}
 
+def save_analysis(note: ClinicalNote, result: Dict[str, Any]) -> Dict[str, Any]:
+    # Results with failed excerpts or an unchecked medication list are returned but not kept,
+    # so the next request retries them
+    chunks = result.get("chunks") or {}
+    if not chunks.get("failed") and chunks.get("interactions_checked", True):
+        try:
+            analysis_store.save(note.patient_id, note.note_text, analyses.from_analysis(result), analysis=result,
+                                note_date=note.note_date, source="analyze-note")
+        except Exception as e:
+            print(f"Warning: could not store analysis for patient {note.patient_id}: {e}")
+    return result
+
 @app.post("/api/analyze-note")
 async def analyze_note(note: ClinicalNote):
-    db.audit_logs.insert(0, {
-        "id": os.urandom(4).hex(),
-        "timestamp": "Just now",
-        "action": "Clinical Note Analysis",
-        "user": "Web Client",
-        "status": "Success"
-    })
+    db.audit("Clinical Note Analysis", "Web Client", "Success")
     
     if not api_key:
         return get_mock_analysis(note.patient_id, note.note_text)
-    
+
+    # A note that was analyzed before (e.g. the dashboard reopening a patient) is served from the store
+    stored = analysis_store.get(note.patient_id, note.note_text)
+    if stored and stored["analysis"] is not None:
+        return FastJSONResponse(stored["analysis"], headers={"X-Analysis-Stored": str(stored["id"])})
+
     try:
         model = genai.GenerativeModel('gemini-flash-latest')
-        prompt = f"""
+
+        def build_prompt(note_text: str) -> str:
+            return f"""
         Analyze this clinical note and extract structured medical data.
-        Note: {note.note_text}
+        Note: {note_text}
         
         Return the result in valid JSON format ONLY with this exact structure:
         {{
@@ -940,14 +1356,38 @@ async def analyze_note(note: ClinicalNote):
             }}
         }}
         """
-        response = model.generate_content(prompt)
-        text = response.text
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0]
-        return json.loads(text.strip())
+
+        # Notes are split by section and the excerpts analyzed concurrently
+        async def analyze_chunk(chunk: notes.Chunk, total: int):
+            excerpt = f"(Excerpt {chunk.index + 1} of {total}; sections: {', '.join(chunk.sections)})\n{chunk.text}"
+
+            async def analyze():
+                response = await llm.generate(model, build_prompt(excerpt), llm.Priority.CLINICAL, kind="analyze_note_chunk")
+                return llm.parse_json_response(response.text)
+
+            return await llm.coalesced("analyze_note_chunk", {"chunk": llm.normalize_text(chunk.text)}, analyze)
+
+        # Sections unchanged since an earlier version of the note are reused; the rest go to the model
+        merged = await notes.analyze_incremental(note.note_text, analyze_chunk, analysis_store.sections, "api.analyze_note",
+                                                 check_interactions=note_interactions, summarize=note_summary)
+        if merged is None:
+            merged = await notes.analyze_in_chunks(note.note_text, analyze_chunk, check_interactions=note_interactions,
+                                                   summarize=note_summary)
+        if merged is not None:
+            return FastJSONResponse(save_analysis(note, terminology.normalize_analysis(merged)))
+
+        async def analyze():
+            response = await llm.generate(model, build_prompt(note.note_text), llm.Priority.CLINICAL, kind="analyze_note")
+            return llm.parse_json_response(response.text)
+        
+        shared = await llm.coalesced("analyze_note", {"note": llm.normalize_text(note.note_text)}, analyze)
+        # Validate and fill codes locally instead of trusting whatever the model returned
+        return FastJSONResponse(save_analysis(note, terminology.normalize_analysis(shared)))
     except Exception as e:
         print(f"Error in analyze_note: {str(e)}")
-        if "429" in str(e):
+        if isinstance(e, deadline.DeadlineExceeded):
+            raise HTTPException(status_code=504, detail=str(e))
+        if llm.is_quota_error(e):
              raise HTTPException(status_code=429, detail=f"Quota exceeded: {str(e)}")
         # For analysis, we might want to fall back to mock if it's just a model error, 
         # but the user specifically asked to integrate Gemini. 
@@ -956,15 +1396,34 @@ async def analyze_note(note: ClinicalNote):
         # However, to be safe and consistent with previous behavior, let's just log and raise if it's a 500.
         raise HTTPException(status_code=500, detail=f"Failed to analyze note: {str(e)}")
 
+# Re-scans of the same prescription land within a few bits of each other
+scan_cache = PerceptualCache(max_entries=int(os.getenv("SCAN_CACHE_SIZE", "512")), name="prescription_scan")
+
+# Stored analyses, for dashboards: plain indexed reads, no LLM calls
+@app.get("/api/patients/{patient_id}/analyses")
+async def get_patient_analyses(patient_id: str, limit: int = Query(analyses.HISTORY_LIMIT, ge=1, le=500)):
+    return FastJSONResponse(analysis_store.history(patient_id, limit))
+
+@app.get("/api/patients/{patient_id}/analyses/{analysis_id}")
+async def get_patient_analysis(patient_id: str, analysis_id: int):
+    record = analysis_store.record(patient_id, analysis_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    return FastJSONResponse(record)
+
+@app.get("/api/patients/{patient_id}/conditions")
+async def get_patient_conditions(patient_id: str):
+    """Conditions whose latest mention in the patient's notes is not negated."""
+    return FastJSONResponse(analysis_store.active_conditions(patient_id))
+
+@app.get("/api/analyses/patients")
+async def get_patients_on_drug(drug: str):
+    """Patients with the drug (any brand or salt name of the same ingredient; misspellings are not corrected) in an analysis."""
+    return FastJSONResponse(analysis_store.patients_on(drug))
+
 @app.post("/api/scan-prescription")
 async def scan_prescription(file: UploadFile = File(...)):
-    db.audit_logs.insert(0, {
-        "id": os.urandom(4).hex(),
-        "timestamp": "Just now",
-        "action": "Prescription OCR Scan",
-        "user": "Web Client",
-        "status": "Success"
-    })
+    db.audit("Prescription OCR Scan", "Web Client", "Success")
     
     if not api_key:
         return {
@@ -977,6 +1436,12 @@ async def scan_prescription(file: UploadFile = File(...)):
     
     try:
         content = await file.read()
+        prepared = await prepare_image(content, file.content_type)
+        if prepared.phash is not None:
+            cached = scan_cache.get(prepared.phash, prepared.signature)
+            if cached is not None:
+                return cached
+
         model = genai.GenerativeModel('gemini-flash-latest')
         
         prompt = """
@@ -993,33 +1458,86 @@ async def scan_prescription(file: UploadFile = File(...)):
         }
         """
         
-        response = model.generate_content([
-            prompt,
-            {"mime_type": file.content_type, "data": content}
-        ])
+        async def scan():
+            response = await llm.generate(model, [
+                prompt,
+                {"mime_type": prepared.mime_type, "data": prepared.data}
+            ], llm.Priority.CLINICAL, kind="scan_prescription")
+            return llm.parse_json_response(response.text)
         
-        text = response.text
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0]
-        
-        return json.loads(text.strip())
+        payload = {"sha256": hashlib.sha256(prepared.data).hexdigest()}
+        result = await llm.coalesced("scan_prescription", payload, scan)
+        # The coalesced result is shared between callers; annotate a copy
+        result = dict(result, medications=[drugnames.annotate(dict(m)) for m in result.get("medications") or []])
+        if prepared.phash is not None:
+            scan_cache.put(prepared.phash, prepared.signature, result)
+        return result
     except Exception as e:
         print(f"Error in scan_prescription: {str(e)}")
         if "400" in str(e):
              raise HTTPException(status_code=400, detail=f"Invalid image or request: {str(e)}")
-        if "429" in str(e):
+        if isinstance(e, deadline.DeadlineExceeded):
+            raise HTTPException(status_code=504, detail=str(e))
+        if llm.is_quota_error(e):
              raise HTTPException(status_code=429, detail=f"Quota exceeded: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to scan prescription: {str(e)}")
 
+@app.post("/api/normalize-medications")
+async def normalize_medications(req: MedicationsRequest):
+    """Resolves free-text names (brands, typos, dose suffixes) to ingredient RxCUIs."""
+    return {"status": "success", "medications": drugnames.normalize_many(req.medications)}
+
+async def find_interactions(medications: List[str]) -> Dict[str, Any]:
+    """Model check of a medication list ({"interactions", "warnings"}); shared result, do not mutate."""
+    model = genai.GenerativeModel('gemini-flash-latest')
+    prompt = f"""
+        Check for drug-drug interactions between these medications: {', '.join(medications)}.
+        
+        Return the result in valid JSON format ONLY with this exact structure:
+        {{
+            "interactions": [
+                {{
+                    "drug_a": "...",
+                    "drug_b": "...",
+                    "severity": "High/Moderate/Low",
+                    "mechanism": "Brief scientific reason for interaction",
+                    "recommendation": "Clinical advice for the provider"
+                }}
+            ],
+            "warnings": ["General safety warning 1", "General safety warning 2"]
+        }}
+        If no interactions are found, return "interactions": [].
+        """
+    async def check():
+        response = await llm.generate(model, prompt, llm.Priority.CLINICAL, kind="check_interactions")
+        return llm.parse_json_response(response.text)
+    
+    return await llm.coalesced("check_interactions", {"medications": llm.normalize_medications(medications)}, check)
+
+async def note_interactions(medications: List[str]) -> List[Dict[str, Any]]:
+    return (await find_interactions(medications)).get("interactions") or []
+
+async def note_summary(summaries: List[str]) -> str:
+    """One summary for a note analyzed in excerpts, written from the excerpt summaries."""
+    model = genai.GenerativeModel('gemini-flash-latest')
+    excerpts = "\n".join(f"- {s}" for s in summaries)
+    prompt = f"""
+        These are summaries of consecutive excerpts of ONE clinical note:
+        {excerpts}
+
+        Write a single concise, professional summary of the patient's condition, diagnosis, and plan,
+        without repeating findings. Return the result in valid JSON format ONLY:
+        {{"clinical_summary": "..."}}
+        """
+    async def summarize():
+        response = await llm.generate(model, prompt, llm.Priority.CLINICAL, kind="summarize_note")
+        return llm.parse_json_response(response.text)
+
+    return (await llm.coalesced("summarize_note", {"summaries": summaries}, summarize)).get("clinical_summary") or ""
+
 @app.post("/api/check-interactions")
 async def check_interactions(req: MedicationsRequest):
-    db.audit_logs.insert(0, {
-        "id": os.urandom(4).hex(),
-        "timestamp": "Just now",
-        "action": "Drug Interaction Check",
-        "user": "Web Client",
-        "status": "Success"
-    })
+    db.audit("Drug Interaction Check", "Web Client", "Success")
     
     if not api_key:
         # Better mock interactions
@@ -1037,48 +1555,64 @@ async def check_interactions(req: MedicationsRequest):
         }
     
     try:
-        model = genai.GenerativeModel('gemini-flash-latest')
-        prompt = f"""
-        Check for drug-drug interactions between these medications: {', '.join(req.medications)}.
-        
-        Return the result in valid JSON format ONLY with this exact structure:
-        {{
-            "interactions": [
-                {{
-                    "drug_a": "...",
-                    "drug_b": "...",
-                    "severity": "High/Moderate/Low",
-                    "mechanism": "Brief scientific reason for interaction",
-                    "recommendation": "Clinical advice for the provider"
-                }}
-            ],
-            "warnings": ["General safety warning 1", "General safety warning 2"]
-        }}
-        If no interactions are found, return "interactions": [].
-        """
-        response = model.generate_content(prompt)
-        text = response.text
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0]
-        return json.loads(text.strip())
+        return await find_interactions(req.medications)
     except Exception as e:
         print(f"Error in check_interactions: {str(e)}")
-        if "429" in str(e):
+        if isinstance(e, deadline.DeadlineExceeded):
+            raise HTTPException(status_code=504, detail=str(e))
+        if llm.is_quota_error(e):
              raise HTTPException(status_code=429, detail=f"Quota exceeded: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to check interactions: {str(e)}")
 
 @app.post("/api/de-identify")
 async def de_identify(note: ClinicalNote):
-    return {"de_identified_text": f"[DE-IDENTIFIED] {note.note_text[:50]}..."}
+    result = deid.deidentify(note.note_text)
+    return {"de_identified_text": result.text, "identifiers_removed": result.counts()}
+
+DEFAULT_COACHING = [
+    {"medication": "Lisinopril", "message": "Best taken in the morning to keep blood pressure stable all day.", "importance": "high", "timing": "Morning"},
+    {"medication": "Metformin", "message": "Take with meals to reduce stomach sensitivity.", "importance": "moderate", "timing": "With Dinner"}
+]
+
+async def generate_coaching_cards(patient_id: str, context: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Runs in the coaching worker, at background priority, after the patient's medications change.
+    Raises on failure so the worker keeps the previous cards; DEFAULT_COACHING is applied per response.
+    """
+    if not api_key:
+        raise RuntimeError("Gemini API key not configured")
+    model = genai.GenerativeModel('gemini-flash-latest')
+    meds = [{k: m.get(k) for k in ("name", "drug_name", "dosage", "frequency") if m.get(k)} for m in context["medications"]]
+    patient = dict(context, medications=meds)
+    prompt = f"TASK: Generate Personalized Patient Adherence Coaching\n\nCONTEXT:\n{json.dumps(patient, default=str)}\n\nGENERATE JSON array of coaching cards with keys: medication, message (patient-friendly), timing, importance (high/medium/low)."
+
+    async def coach():
+        response = await llm.generate(model, prompt, llm.Priority.BACKGROUND, kind="generate_coaching")
+        return llm.parse_json_response(response.text)
+
+    return await llm.coalesced("generate_coaching", patient, coach)
+
+coaching_worker = coaching.CoachingWorker(generate_coaching_cards, coaching.CoachingStore(db.store))
 
 @app.post("/api/generate-coaching")
 async def generate_coaching(context: Dict[str, Any]):
-    return {
-        "coaching_messages": [
-            {"medication": "Lisinopril", "message": "Best taken in the morning to keep blood pressure stable all day.", "importance": "high", "timing": "Morning"},
-            {"medication": "Metformin", "message": "Take with meals to reduce stomach sensitivity.", "importance": "moderate", "timing": "With Dinner"}
-        ]
-    }
+    # Served from the precomputed cards; a changed medication list or context only schedules a refresh
+    patient_id = str(context.get("patient_id") or DEMO_PATIENT_ID)
+    medications = context.get("medications")
+    patient = coaching.patient_context(context)
+    if not isinstance(medications, list):
+        medications = db.medications if patient_id == DEMO_PATIENT_ID else None
+    elif "patient_id" not in context:
+        # Ad-hoc lists (e.g. from a note analysis) share cards with any identical medication set and context
+        patient_id = "meds:" + coaching.fingerprint(medications, patient)
+    if medications is None:
+        result = coaching_worker.cards(patient_id)
+    else:
+        result = await coaching_worker.fetch(patient_id, medications, patient)
+    if result["generated_at"] is None:
+        # Nothing generated yet (no API key, or Gemini failing): defaults are shown but never stored
+        result["coaching_messages"] = DEFAULT_COACHING
+    return result
 
 # Document Endpoints
 # Document Endpoints
@@ -1094,6 +1628,26 @@ except OSError:
     UPLOAD_DIR = Path("/tmp/uploads")
     UPLOAD_DIR.mkdir(exist_ok=True, parents=True)
 
+blob_store = BlobStore(UPLOAD_DIR / "blobs")
+
+def acquire_blob(db: Session, sha256: str, size: int):
+    # Atomic increment first so concurrent uploads of the same content never lose a reference
+    updated = db.query(Blob).filter(Blob.sha256 == sha256).update({Blob.ref_count: Blob.ref_count + 1})
+    if not updated:
+        db.add(Blob(sha256=sha256, size=size, ref_count=1))
+
+def blob_referenced(db: Session, sha256: str) -> bool:
+    return db.query(Blob.sha256).filter(Blob.sha256 == sha256, Blob.ref_count > 0).first() is not None
+
+def release_blob(db: Session, sha256: str) -> bool:
+    """Drops one reference. Returns True when the blob is no longer referenced."""
+    db.query(Blob).filter(Blob.sha256 == sha256).update({Blob.ref_count: Blob.ref_count - 1})
+    blob = db.query(Blob).filter(Blob.sha256 == sha256).first()
+    if blob and blob.ref_count <= 0:
+        db.delete(blob)
+        return True
+    return False
+
 @app.post("/api/documents")
 async def upload_document(
     file: UploadFile = File(...), 
@@ -1101,43 +1655,205 @@ async def upload_document(
     db: Session = Depends(get_db)
 ):
     try:
-        file_path = UPLOAD_DIR / f"{user_id}_{file.filename}"
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-        new_doc = Document(
-            user_id=user_id,
-            filename=file.filename,
-            file_type=file.content_type,
-            file_path=str(file_path)
-        )
-        db.add(new_doc)
-        db.commit()
+        staged = await blob_store.stage(file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        print(f"Upload error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    try:
+        # The file goes in place before the rows that point at it; a failure below removes it again
+        # unless another document already uses the same content
+        await blob_store.publish(staged)
+        for attempt in range(2):
+            try:
+                acquire_blob(db, staged.sha256, staged.size)
+                new_doc = Document(
+                    user_id=user_id,
+                    filename=file.filename,
+                    file_type=file.content_type,
+                    file_path=str(blob_store.path_for(staged.sha256)),
+                    content_hash=staged.sha256,
+                    file_size=staged.size
+                )
+                db.add(new_doc)
+                db.commit()
+                break
+            except IntegrityError:
+                # Another upload created the same blob row first; retry as an increment
+                db.rollback()
+                if attempt:
+                    raise
         db.refresh(new_doc)
+        # A delete of the same content racing with this upload may have taken the file; put it back
+        await blob_store.publish(staged)
+        bump_versions(db, f"patient:{user_id}")
         
         return {"status": "success", "message": "File uploaded", "document": {
             "id": new_doc.id, "filename": new_doc.filename, "upload_date": new_doc.upload_date.isoformat()
         }}
     except Exception as e:
+        db.rollback()
+        await blob_store.delete(staged.sha256, lambda: blob_referenced(db, staged.sha256))
         print(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-
-@app.get("/api/documents")
-async def get_documents(user_id: int, db: Session = Depends(get_db)):
-    docs = db.query(Document).filter(Document.user_id == user_id).order_by(Document.upload_date.desc()).all()
-    return [{
-        "id": d.id,
-        "filename": d.filename,
-        "file_type": d.file_type,
-        "upload_date": d.upload_date.isoformat()
-    } for d in docs]
-
-@app.get("/api/documents/{doc_id}")
-async def get_document_file(doc_id: int, db: Session = Depends(get_db)):
+    finally:
+        await blob_store.discard(staged)
+
+@app.get("/api/documents", response_model=List[DocumentOut])
+async def get_documents(user_id: int, if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)):
+    etag = listing_etag(db, "documents", f"patient:{user_id}")
+    unchanged = responses.not_modified(if_none_match, etag)
+    if unchanged:
+        return unchanged
+    rows = db.query(
+        Document.id, Document.filename, Document.file_type, Document.file_size, Document.upload_date,
+    ).filter(Document.user_id == user_id).order_by(Document.upload_date.desc())
+    return FastJSONResponse(responses.rows_to_dicts(rows), headers=responses.validator_headers(etag))
+
+@app.api_route("/api/documents/{doc_id}", methods=["GET", "HEAD"])
+async def get_document_file(doc_id: int, download: bool = False, db: Session = Depends(get_db)):
     doc = db.query(Document).filter(Document.id == doc_id).first()
     if not doc or not os.path.exists(doc.file_path):
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(doc.file_path, filename=doc.filename)
+    if doc.content_hash:
+        etag = f'"{doc.content_hash}"'
+    else:
+        # Legacy uploads have no content hash; mtime/size is only good enough for a weak validator
+        st = os.stat(doc.file_path)
+        etag = f'W/"{int(st.st_mtime)}-{st.st_size}"'
+    return RangedFileResponse(
+        doc.file_path,
+        etag=etag,
+        filename=doc.filename,
+        media_type=doc.file_type,
+        disposition="attachment" if download else "inline"
+    )
+
+@app.delete("/api/documents/{doc_id}")
+async def delete_document(doc_id: int, db: Session = Depends(get_db)):
+    doc = db.query(Document).filter(Document.id == doc_id).first()
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    content_hash = doc.content_hash
+    db.delete(doc)
+    orphaned = release_blob(db, content_hash) if content_hash else False
+    db.commit()
+    bump_versions(db, f"patient:{doc.user_id}")
+    if orphaned:
+        # Re-checked against the database: an upload of the same content may have committed meanwhile
+        await blob_store.delete(content_hash, lambda: blob_referenced(db, content_hash))
+    elif not content_hash and os.path.exists(doc.file_path):
+        # Legacy per-user copies are not shared
+        os.remove(doc.file_path)
+    return {"status": "success", "message": "Document deleted"}
+
+# Bulk FHIR export ($export). Needs EXPORT_TOKEN; files land in EXPORT_DIR.
+# Sources read column rows through server-side cursors (yield_per streams results on Postgres;
+# SQLite reads incrementally), so only one batch of rows is held at a time.
+EXPORT_BATCH = 1000
+
+def stream_rows(build):
+    session = SessionLocal()
+    try:
+        yield from build(session).yield_per(EXPORT_BATCH)
+    finally:
+        session.close()
+
+def export_patients():
+    rows = stream_rows(lambda s: s.query(
+        User.id, User.medx_id, User.full_name, User.gender, User.dob, User.email, User.contact_number, User.address,
+    ).filter(User.role == "patient").order_by(User.id))
+    return map(bulkexport.patient_resource, rows)
+
+def export_practitioners():
+    rows = stream_rows(lambda s: s.query(
+        User.id, User.full_name, User.gender, User.specialization,
+    ).filter(User.role == "doctor").order_by(User.id))
+    return map(bulkexport.practitioner_resource, rows)
+
+def export_appointments():
+    rows = stream_rows(lambda s: s.query(
+        Appointment.id, Appointment.status, Appointment.reason, Appointment.date_time,
+        Appointment.patient_id, Appointment.patient_name, Appointment.doctor_id,
+    ).order_by(Appointment.id))
+    return map(bulkexport.appointment_resource, rows)
+
+def export_medications():
+    return (bulkexport.medication_statement(owner, m) for owner, m in db.store.iter_collection("medications"))
+
+def export_conditions():
+    return map(bulkexport.condition_resource, analysis_store.iter_rows(analyses.conditions_table))
+
+def export_medication_requests():
+    return map(bulkexport.medication_request, analysis_store.iter_rows(analyses.medications_table))
+
+EXPORT_SOURCES: Dict[str, bulkexport.Source] = {
+    "Patient": export_patients,
+    "Practitioner": export_practitioners,
+    "Appointment": export_appointments,
+    "MedicationStatement": export_medications,
+    "Condition": export_conditions,
+    "MedicationRequest": export_medication_requests,
+}
+
+def export_url(request: Request, job_id: str) -> str:
+    return f"{str(request.base_url).rstrip('/')}/api/fhir/export/{job_id}"
+
+@app.get("/api/fhir/$export", status_code=202)
+@app.get("/api/fhir/Patient/$export", status_code=202)
+async def bulk_export(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    types: Optional[str] = Query(None, alias="_type"),
+    output_format: Optional[str] = Query(None, alias="_outputFormat"),
+    authorization: Optional[str] = Header(None),
+):
+    """Starts an export; poll the Content-Location URL until it returns the file manifest."""
+    bulkexport.require_export_token(authorization)
+    if output_format and output_format not in (bulkexport.NDJSON, "application/ndjson", "ndjson"):
+        raise HTTPException(status_code=400, detail="Only NDJSON output is supported")
+    requested = [t.strip() for t in types.split(",") if t.strip()] if types else list(EXPORT_SOURCES)
+    unknown = [t for t in requested if t not in EXPORT_SOURCES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unsupported _type: {', '.join(unknown)}")
+    manifest = bulkexport.create_job(str(request.url), list(dict.fromkeys(requested)))
+    background_tasks.add_task(bulkexport.run, manifest["id"], EXPORT_SOURCES)
+    return Response(status_code=202, headers={"Content-Location": export_url(request, manifest["id"])})
+
+@app.get("/api/fhir/export/{job_id}")
+async def bulk_export_status(job_id: str, request: Request, authorization: Optional[str] = Header(None)):
+    bulkexport.require_export_token(authorization)
+    manifest = bulkexport.read_manifest(job_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    if manifest["status"] != "completed":
+        return Response(status_code=202, headers={"X-Progress": bulkexport.progress_header(manifest), "Retry-After": "2"})
+    return FastJSONResponse(bulkexport.completion_manifest(manifest, str(request.base_url)))
+
+@app.delete("/api/fhir/export/{job_id}", status_code=202)
+async def bulk_export_delete(job_id: str, authorization: Optional[str] = Header(None)):
+    """Cancels a running export or deletes a finished one's files."""
+    bulkexport.require_export_token(authorization)
+    if not bulkexport.delete_job(job_id):
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return Response(status_code=202)
+
+@app.api_route("/api/fhir/export/{job_id}/{filename}", methods=["GET", "HEAD"])
+async def bulk_export_file(job_id: str, filename: str, authorization: Optional[str] = Header(None)):
+    """One output file; supports Range requests, so large files can be fetched in parallel parts."""
+    bulkexport.require_export_token(authorization)
+    manifest = bulkexport.read_manifest(job_id)
+    if not manifest or not any(f["file"] == filename for f in manifest["output"]):
+        raise HTTPException(status_code=404, detail="Export file not found")
+    return RangedFileResponse(
+        str(bulkexport.job_dir(job_id) / filename),
+        etag=f'"{job_id}-{filename}"',
+        filename=filename,
+        media_type=bulkexport.NDJSON,
+    )
 
 @app.post("/api/verify-password")
 async def verify_password_endpoint(
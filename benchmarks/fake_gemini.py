@@ -0,0 +1,172 @@
+"""
+Local stand-in for the Gemini REST API, for load tests that must not spend real quota.
+
+    python benchmarks/fake_gemini.py --port 8999 --median-ms 800 --p95-ms 2500 --error-rate 0.02
+
+Point the services at it with GEMINI_API_ENDPOINT=http://127.0.0.1:8999 (and any non-empty
+GOOGLE_API_KEY). Latency is log-normal with the given median and p95, plus a per-output-token
+cost; 429s are injected at a fixed rate and/or whenever a requests-per-minute quota is exceeded.
+Responses are shaped like the JSON each MedX prompt asks for, so the parsing paths run for real.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from collections import deque
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI(title="Fake Gemini")
+
+settings = argparse.Namespace(
+    median_ms=800.0, p95_ms=2500.0, output_tokens=300, ms_per_token=0.0,
+    error_rate=0.0, rpm=0, seed=None,
+)
+counters = {"requests": 0, "throttled": 0, "prompt_tokens": 0, "output_tokens": 0}
+_recent = deque()
+
+FILLER = ("patient tolerating therapy well with stable vitals and no new complaints reported at this visit "
+          "continue current regimen and review labs at follow up ").split()
+
+
+def filler(tokens: int) -> str:
+    # Roughly 0.75 English words per token
+    words = int(tokens * 0.75)
+    return " ".join(FILLER[i % len(FILLER)] for i in range(words))
+
+
+def latency_seconds(output_tokens: int) -> float:
+    mu = math.log(settings.median_ms)
+    sigma = max(math.log(settings.p95_ms / settings.median_ms) / 1.645, 0.0)
+    return (random.lognormvariate(mu, sigma) + output_tokens * settings.ms_per_token) / 1000
+
+
+def prompt_text(body: dict) -> str:
+    parts = []
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            if "text" in part:
+                parts.append(part["text"])
+    return "\n".join(parts)
+
+
+def has_image(body: dict) -> bool:
+    return any("inlineData" in part or "inline_data" in part
+               for content in body.get("contents", []) for part in content.get("parts", []))
+
+
+def answer_for(prompt: str, image: bool, tokens: int) -> str:
+    lowered = prompt.lower()
+    if image:
+        return json.dumps({
+            "medications": [
+                {"name": "Metformin", "dosage": "500mg", "frequency": "Twice daily", "duration": "30 days"},
+                {"name": "Amlodipine", "dosage": "5mg", "frequency": "Once daily", "duration": "30 days"},
+            ],
+            "raw_text": "Tab Metformin 500mg BD x 30 days\nTab Amlodipine 5mg OD x 30 days\n" + filler(tokens),
+        })
+    if "de-identify" in lowered:
+        return "[PATIENT_NAME] seen on [DATE]. " + filler(tokens)
+    if "coaching" in lowered:
+        return json.dumps([{"medication": "Metformin", "message": filler(tokens), "importance": "high", "timing": "Morning"}])
+    if "clinical note" in lowered:
+        return "```json\n" + json.dumps({
+            "clinical_summary": filler(tokens),
+            "extracted_entities": {
+                "conditions": [{"clinical_text": "Type 2 diabetes mellitus", "icd_10": "E11.9", "confidence": 95, "severity": "Chronic"}],
+                "medications": [{"drug_name": "Metformin", "rxnorm_code": "860975", "dosage": "500mg", "frequency": "BID", "confidence": 93}],
+            },
+            "adherence_insights": {"complexity_score": 3, "barriers_identified": ["cost"]},
+            "fhir_resources": {"resourceType": "Bundle", "type": "collection", "entry": []},
+        }) + "\n```"
+    if "interactions" in lowered:
+        return json.dumps({
+            "interactions": [{
+                "drug_a": "Aspirin", "drug_b": "Warfarin", "severity": "High",
+                "mechanism": "Additive anticoagulant and antiplatelet effect.",
+                "recommendation": "Avoid combination or monitor INR closely.",
+            }],
+            "warnings": [filler(tokens)],
+        })
+    # Chat
+    return filler(tokens)
+
+
+def over_quota() -> bool:
+    if not settings.rpm:
+        return False
+    now = time.monotonic()
+    while _recent and now - _recent[0] > 60:
+        _recent.popleft()
+    if len(_recent) >= settings.rpm:
+        return True
+    _recent.append(now)
+    return False
+
+
+@app.post("/{version}/models/{model_action}")
+async def generate_content(version: str, model_action: str, request: Request):
+    body = await request.json()
+    counters["requests"] += 1
+
+    if random.random() < settings.error_rate or over_quota():
+        counters["throttled"] += 1
+        await asyncio.sleep(0.01)
+        return JSONResponse(status_code=429, content={"error": {
+            "code": 429, "message": "Resource has been exhausted (e.g. check quota).", "status": "RESOURCE_EXHAUSTED"}})
+
+    prompt = prompt_text(body)
+    tokens = max(int(random.gauss(settings.output_tokens, settings.output_tokens * 0.2)), 1)
+    prompt_tokens = max(len(prompt) // 4, 1) + (258 if has_image(body) else 0)
+    counters["prompt_tokens"] += prompt_tokens
+    counters["output_tokens"] += tokens
+    await asyncio.sleep(latency_seconds(tokens))
+
+    return {
+        "candidates": [{
+            "content": {"parts": [{"text": answer_for(prompt, has_image(body), tokens)}], "role": "model"},
+            "finishReason": "STOP",
+            "index": 0,
+        }],
+        "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": tokens,
+                          "totalTokenCount": prompt_tokens + tokens},
+    }
+
+
+@app.get("/stats")
+def stats():
+    return dict(counters, settings=vars(settings))
+
+
+@app.post("/stats/reset")
+def reset_stats():
+    for key in counters:
+        counters[key] = 0
+    return counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--median-ms", type=float, default=settings.median_ms)
+    parser.add_argument("--p95-ms", type=float, default=settings.p95_ms)
+    parser.add_argument("--output-tokens", type=int, default=settings.output_tokens, help="mean output tokens per response")
+    parser.add_argument("--ms-per-token", type=float, default=settings.ms_per_token, help="extra latency per output token")
+    parser.add_argument("--error-rate", type=float, default=settings.error_rate, help="fraction of calls answered with 429")
+    parser.add_argument("--rpm", type=int, default=settings.rpm, help="429 once this many calls arrive within a minute (0 = no quota)")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    for key in vars(settings):
+        setattr(settings, key, getattr(args, key))
+    if args.seed is not None:
+        random.seed(args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Incremental re-analysis of edited notes: what goes to the model, whole-note versus per section.
+
+    python benchmarks/incremental_notes.py
+    python benchmarks/incremental_notes.py --sizes 2,8,32 --prompt-tokens 750 --ms-per-token 2
+
+For each note size (KB), a structured note is analyzed once, then re-analyzed after editing one
+sentence in one section, using a stand-in model that charges a fixed latency plus a cost per
+prompt token. The whole-note rows are what every re-submission cost before (one prompt for short
+notes, analyze_in_chunks for long ones); the incremental rows use notes.analyze_incremental,
+which is enabled here whatever NOTE_INCREMENTAL says. Tokens are the estimate_tokens of the
+excerpts plus --prompt-tokens of instructions per call (summary calls included).
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Any, Dict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ROOT, os.path.dirname(ROOT)]
+
+from common import notes
+from microbench import clinical_note
+
+SECTIONS = ["Chief Complaint", "HPI", "Past Medical History", "Medications", "Allergies", "Social History",
+            "Physical Exam", "Labs", "Assessment and Plan", "Follow-up"]
+
+
+def structured_note(size_kb: int, seed: int) -> str:
+    body = clinical_note(size_kb * 1024, seed)
+    lines = body.splitlines(keepends=True)
+    per_section = max(1, len(lines) // len(SECTIONS))
+    return "".join(f"{name}:\n" + "".join(lines[i * per_section:(i + 1) * per_section])
+                   for i, name in enumerate(SECTIONS))
+
+
+class StandIn:
+    def __init__(self, prompt_tokens: int, base_ms: float, ms_per_token: float):
+        self.prompt_tokens, self.base_ms, self.ms_per_token = prompt_tokens, base_ms, ms_per_token
+        self.calls = self.tokens = 0
+
+    async def analyze(self, chunk: notes.Chunk, total: int) -> Dict[str, Any]:
+        tokens = self.prompt_tokens + chunk.tokens
+        self.calls += 1
+        self.tokens += tokens
+        await asyncio.sleep((self.base_ms + tokens * self.ms_per_token) / 1000)
+        return {"extracted_entities": {"conditions": [{"clinical_text": chunk.sections[0]}]},
+                "clinical_summary": f"Summary of {', '.join(chunk.sections)}."}
+
+    async def summarize(self, summaries) -> str:
+        tokens = self.prompt_tokens + sum(notes.estimate_tokens(s) for s in summaries)
+        self.calls += 1
+        self.tokens += tokens
+        await asyncio.sleep((self.base_ms + tokens * self.ms_per_token) / 1000)
+        return " ".join(summaries)
+
+    async def whole(self, note_text: str) -> Dict[str, Any]:
+        merged = await notes.analyze_in_chunks(note_text, self.analyze, summarize=self.summarize)
+        if merged is None:
+            merged = await self.analyze(notes.Chunk(["Note"], note_text), 1)
+        return merged
+
+
+async def incremental(note_text: str, model: StandIn, cache: notes.SectionCache) -> Dict[str, Any]:
+    # Callers fall back to the whole-note path when the note is too short or unstructured
+    return (await notes.analyze_incremental(note_text, model.analyze, cache, summarize=model.summarize)
+            or await model.whole(note_text))
+
+
+async def measure(run, model: StandIn) -> Dict[str, Any]:
+    model.calls = model.tokens = 0
+    started = time.perf_counter()
+    await run()
+    return {"calls": model.calls, "tokens": model.tokens, "ms": (time.perf_counter() - started) * 1000}
+
+
+async def main_async(args):
+    notes.INCREMENTAL_ENABLED = True
+    print(f"{'note':>6}  {'mode':<12}{'pass':<7}{'calls':>6}{'tokens':>9}{'ms':>8}")
+    for size_kb in [int(s) for s in args.sizes.split(",")]:
+        note = structured_note(size_kb, seed=size_kb)
+        # Edit one sentence in the Medications section
+        start = note.index("Medications:")
+        line_end = note.index("\n", note.index("\n", start) + 1)
+        edited = note[:line_end] + " Dose increased." + note[line_end:]
+        model = StandIn(args.prompt_tokens, args.base_ms, args.ms_per_token)
+        cache = notes.SectionCache()
+        rows = [
+            ("whole-note", "first", await measure(lambda: model.whole(note), model)),
+            ("whole-note", "edit", await measure(lambda: model.whole(edited), model)),
+            ("incremental", "first", await measure(lambda: incremental(note, model, cache), model)),
+            ("incremental", "edit", await measure(lambda: incremental(edited, model, cache), model)),
+        ]
+        for mode, label, r in rows:
+            print(f"{size_kb:>4}KB  {mode:<12}{label:<7}{r['calls']:>6}{r['tokens']:>9}{r['ms']:>8.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="2,8,32", help="comma-separated note sizes in KB")
+    parser.add_argument("--prompt-tokens", type=int, default=750, help="instruction tokens sent with every call")
+    parser.add_argument("--base-ms", type=float, default=300, help="fixed latency per call")
+    parser.add_argument("--ms-per-token", type=float, default=0.5, help="latency per prompt token")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+Mixed-workload load test for the MedX API and microservices.
+
+    # 1. Gemini stand-in (see fake_gemini.py for latency / 429 knobs)
+    python benchmarks/fake_gemini.py --port 8999
+    # 2. Services pointed at it
+    GOOGLE_API_KEY=fake GEMINI_API_ENDPOINT=http://127.0.0.1:8999 uvicorn api.index:app --port 8000
+    # 3. Drive load; results land in benchmarks/results/
+    python benchmarks/load_test.py --api http://127.0.0.1:8000 --duration 60 --concurrency 32 --label baseline
+    python benchmarks/load_test.py ... --label my-change --compare benchmarks/results/<baseline>.json
+
+Closed-loop workers pick operations by weight (--mix). The microservice operations only run
+when --clinical / --ai / --patient URLs are given. Per operation the report shows throughput,
+error count and p50/p95/p99 latency; --compare flags p95 or throughput regressions.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+try:
+    from PIL import Image, ImageDraw
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+DEFAULT_MIX = (
+    "login=20,doctor_appointments=15,patient_appointments=15,org_appointments=5,doctors=10,"
+    "analyze_note=10,check_interactions=5,scan=5,chat=5,"
+    "clinical_ingest=4,ai_analyze_note=3,ai_scan=2,patient_medications=1"
+)
+
+CONDITIONS = ["type 2 diabetes", "essential hypertension", "hyperlipidaemia", "asthma", "GERD", "hypothyroidism", "CKD stage 3"]
+MEDICATIONS = ["metformin 500mg BD", "amlodipine 5mg OD", "atorvastatin 20mg HS", "salbutamol inhaler PRN",
+               "pantoprazole 40mg OD", "levothyroxine 50mcg OD", "losartan 50mg OD", "aspirin 75mg OD"]
+DRUGS = ["Aspirin", "Warfarin", "Metformin", "Lisinopril", "Amlodipine", "Atorvastatin", "Clopidogrel", "Omeprazole"]
+
+
+def clinical_note(rng: random.Random, paragraphs: int) -> str:
+    lines = [f"Patient is a {rng.randint(25, 85)}-year-old presenting for follow-up."]
+    for _ in range(paragraphs):
+        lines.append(
+            f"History of {rng.choice(CONDITIONS)}. Currently on {rng.choice(MEDICATIONS)} and {rng.choice(MEDICATIONS)}. "
+            f"BP {rng.randint(110, 160)}/{rng.randint(70, 100)}, HbA1c {rng.uniform(5.5, 9.5):.1f}%. "
+            f"Plan: continue therapy, review in {rng.randint(2, 12)} weeks."
+        )
+    return "\n".join(lines)
+
+
+def prescription_images(count: int) -> List[bytes]:
+    """Distinct synthetic prescriptions; re-used so the scan cache sees realistic repeats."""
+    images = []
+    for i in range(count):
+        if not PIL_AVAILABLE:
+            images.append(os.urandom(2048))
+            continue
+        image = Image.new("L", (1240, 1754), 255)
+        draw = ImageDraw.Draw(image)
+        draw.text((80, 80), f"Dr. Bench Clinic   Rx #{i:04d}", fill=0)
+        for row, med in enumerate(random.Random(i).sample(MEDICATIONS, 3)):
+            draw.text((100, 220 + row * 60), f"{row + 1}. Tab {med} x {10 + i} days", fill=0)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=85)
+        images.append(out.getvalue())
+    return images
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.status_counts: Dict[str, Dict[str, int]] = {}
+        self.images = prescription_images(8)
+        self.password = "bench-password"
+        self.users: List[str] = []
+        self.doctor_ids: List[int] = []
+        self.patient_ids: List[int] = []
+        self.org_id: Optional[int] = None
+
+    # --- Setup ----------------------------------------------------------------
+
+    async def setup(self, client: httpx.AsyncClient):
+        api = self.args.api
+        admin = f"admin-{self.run_id}@bench.local"
+        r = await client.post(f"{api}/api/org/register", json={
+            "org_name": f"Bench Clinic {self.run_id}", "admin_email": admin,
+            "admin_password": self.password, "admin_name": "Bench Admin"})
+        r.raise_for_status()
+        r = await client.post(f"{api}/api/login", json={"email": admin, "password": self.password})
+        r.raise_for_status()
+        self.org_id = r.json()["organization_id"]
+        self.users.append(admin)
+
+        for i in range(self.args.doctors):
+            email = f"doctor{i}-{self.run_id}@bench.local"
+            r = await client.post(f"{api}/api/org/doctors", json={
+                "email": email, "password": self.password, "full_name": f"Dr. Bench {i}",
+                "specialization": self.rng.choice(["Cardiology", "Endocrinology", "General Medicine"]),
+                "availability": "Mon-Fri, 9am - 5pm", "gender": self.rng.choice(["Male", "Female"]),
+                "organization_id": self.org_id})
+            r.raise_for_status()
+            self.users.append(email)
+        r = await client.get(f"{api}/api/org/doctors", params={"organization_id": self.org_id})
+        self.doctor_ids = [d["id"] for d in r.json()]
+
+        for i in range(self.args.patients):
+            email = f"patient{i}-{self.run_id}@bench.local"
+            r = await client.post(f"{api}/api/register", json={
+                "email": email, "password": self.password, "full_name": f"Patient Bench {i}"})
+            r.raise_for_status()
+            r = await client.post(f"{api}/api/login", json={"email": email, "password": self.password})
+            self.patient_ids.append(r.json()["user_id"])
+            self.users.append(email)
+
+        start = datetime.now().replace(minute=0, second=0, microsecond=0)
+        for i in range(self.args.appointments):
+            await client.post(f"{api}/api/patient/appointments", json={
+                "doctor_id": self.rng.choice(self.doctor_ids), "organization_id": self.org_id,
+                "patient_id": self.rng.choice(self.patient_ids), "patient_name": f"Patient Bench {i % self.args.patients}",
+                "date_time": (start + timedelta(hours=i)).isoformat(), "reason": "Follow-up"})
+
+    # --- Operations -----------------------------------------------------------
+
+    def operations(self) -> Dict[str, Callable]:
+        api, a = self.args.api, self.args
+        ops = {
+            "login": lambda c: c.post(f"{api}/api/login", json={"email": self.rng.choice(self.users), "password": self.password}),
+            "doctors": lambda c: c.get(f"{api}/api/doctors"),
+            "doctor_appointments": lambda c: c.get(f"{api}/api/doctor/appointments", params={"doctor_id": self.rng.choice(self.doctor_ids)}),
+            "patient_appointments": lambda c: c.get(f"{api}/api/patient/appointments", params={"patient_id": self.rng.choice(self.patient_ids)}),
+            "org_appointments": lambda c: c.get(f"{api}/api/org/appointments", params={"organization_id": self.org_id}),
+            "analyze_note": lambda c: c.post(f"{api}/api/analyze-note", json=self.note_payload()),
+            "check_interactions": lambda c: c.post(f"{api}/api/check-interactions", json={"medications": self.rng.sample(DRUGS, 3)}),
+            "scan": lambda c: c.post(f"{api}/api/scan-prescription", files=self.scan_file()),
+            "chat": lambda c: c.post(f"{api}/api/chat", json={
+                "message": self.rng.choice(["How do I book an appointment?", "What does Safety Guard do?", "Where are my medications?"]),
+                "history": [], "context": "dashboard", "role": "patient"}),
+        }
+        if a.clinical:
+            ops["clinical_ingest"] = lambda c: c.post(f"{a.clinical}/ingest", json=self.note_payload())
+        if a.ai:
+            ops["ai_analyze_note"] = lambda c: c.post(f"{a.ai}/analyze-note", json=self.note_payload())
+            ops["ai_scan"] = lambda c: c.post(f"{a.ai}/scan-prescription", files=self.scan_file())
+        if a.patient:
+            ops["patient_medications"] = lambda c: c.get(f"{a.patient}/medications", headers={"Authorization": "Bearer valid_token"})
+        return ops
+
+    def note_payload(self) -> Dict[str, Any]:
+        # Mostly short notes with a long tail of discharge-summary sized ones
+        paragraphs = min(int(self.rng.paretovariate(1.2) * 2), 200)
+        return {"patient_id": f"bench-{self.rng.randint(1, 500)}", "note_text": clinical_note(self.rng, paragraphs)}
+
+    def scan_file(self):
+        return {"file": ("rx.jpg", self.rng.choice(self.images), "image/jpeg")}
+
+    # --- Driver ---------------------------------------------------------------
+
+    async def worker(self, client: httpx.AsyncClient, ops, names, weights, stop_at: float, record_after: float):
+        while time.monotonic() < stop_at:
+            name = self.rng.choices(names, weights)[0]
+            started = time.monotonic()
+            try:
+                response = await ops[name](client)
+                status = str(response.status_code)
+                ok = response.status_code < 400
+            except httpx.HTTPError as e:
+                status, ok = type(e).__name__, False
+            elapsed = time.monotonic() - started
+            if started < record_after:
+                continue
+            self.samples.setdefault(name, []).append(elapsed)
+            self.status_counts.setdefault(name, {}).setdefault(status, 0)
+            self.status_counts[name][status] += 1
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def run(self) -> Dict[str, Any]:
+        ops = self.operations()
+        mix = {k: float(v) for k, v in (item.split("=") for item in self.args.mix.split(","))}
+        names = [n for n in mix if n in ops and mix[n] > 0]
+        weights = [mix[n] for n in names]
+
+        limits = httpx.Limits(max_connections=self.args.concurrency * 2, max_keepalive_connections=self.args.concurrency)
+        async with httpx.AsyncClient(timeout=self.args.timeout, limits=limits) as client:
+            print(f"Setting up {self.args.doctors} doctors, {self.args.patients} patients, {self.args.appointments} appointments...")
+            await self.setup(client)
+            if self.args.fake_gemini:
+                await client.post(f"{self.args.fake_gemini}/stats/reset")
+
+            print(f"Running {', '.join(names)} for {self.args.duration}s at concurrency {self.args.concurrency}...")
+            started = time.monotonic()
+            record_after = started + self.args.warmup
+            stop_at = record_after + self.args.duration
+            await asyncio.gather(*(
+                self.worker(client, ops, names, weights, stop_at, record_after) for _ in range(self.args.concurrency)))
+            measured = time.monotonic() - record_after
+
+            gemini = None
+            if self.args.fake_gemini:
+                gemini = (await client.get(f"{self.args.fake_gemini}/stats")).json()
+
+        return self.report(measured, gemini)
+
+    def report(self, measured: float, gemini: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        endpoints = {}
+        for name, latencies in sorted(self.samples.items()):
+            ordered = sorted(latencies)
+            endpoints[name] = {
+                "requests": len(ordered),
+                "errors": self.errors.get(name, 0),
+                "statuses": self.status_counts.get(name, {}),
+                "throughput_rps": round(len(ordered) / measured, 2),
+                "p50_ms": round(percentile(ordered, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(ordered, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(ordered, 0.99) * 1000, 1),
+            }
+        total = sum(e["requests"] for e in endpoints.values())
+        return {
+            "label": self.args.label,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "config": {k: v for k, v in vars(self.args).items() if k not in ("compare",)},
+            "duration_s": round(measured, 1),
+            "total_requests": total,
+            "total_rps": round(total / measured, 2),
+            "endpoints": endpoints,
+            "fake_gemini": gemini,
+        }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(RESULTS_DIR)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"\n{result['label']} @ {result['commit']}: {result['total_requests']} requests in {result['duration_s']}s "
+          f"({result['total_rps']} req/s)")
+    print(f"{'operation':<22}{'reqs':>7}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, e in result["endpoints"].items():
+        print(f"{name:<22}{e['requests']:>7}{e['errors']:>6}{e['throughput_rps']:>9}{e['p50_ms']:>10}{e['p95_ms']:>10}{e['p99_ms']:>10}")
+    if result.get("fake_gemini"):
+        g = result["fake_gemini"]
+        print(f"Gemini stand-in: {g['requests']} calls, {g['throttled']} throttled, "
+              f"{g['prompt_tokens']} prompt / {g['output_tokens']} output tokens")
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> bool:
+    """Prints per-operation deltas; returns True if any p95 or throughput moved the wrong way by more than threshold."""
+    print(f"\nCompared with {baseline['label']} @ {baseline.get('commit')} ({baseline['timestamp']}):")
+    print(f"{'operation':<22}{'p50':>10}{'p95':>10}{'p99':>10}{'rps':>10}")
+    regressed = False
+    for name, e in result["endpoints"].items():
+        base = baseline["endpoints"].get(name)
+        if not base:
+            continue
+
+        def delta(key):
+            return (e[key] - base[key]) / base[key] if base[key] else 0.0
+
+        flags = []
+        if delta("p95_ms") > threshold:
+            flags.append("p95 REGRESSION")
+        if delta("throughput_rps") < -threshold:
+            flags.append("throughput REGRESSION")
+        regressed = regressed or bool(flags)
+        print(f"{name:<22}{delta('p50_ms'):>+10.1%}{delta('p95_ms'):>+10.1%}{delta('p99_ms'):>+10.1%}"
+              f"{delta('throughput_rps'):>+10.1%}  {' '.join(flags)}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api", default="http://127.0.0.1:8000")
+    parser.add_argument("--clinical", help="clinical_service base URL, e.g. http://127.0.0.1:8081")
+    parser.add_argument("--ai", help="healthbridge_ai base URL, e.g. http://127.0.0.1:8082")
+    parser.add_argument("--patient", help="patient_service base URL, e.g. http://127.0.0.1:8080")
+    parser.add_argument("--fake-gemini", help="fake_gemini.py base URL, to include its call/token counts")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation=weight,... (unknown or unavailable operations are skipped)")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--doctors", type=int, default=25)
+    parser.add_argument("--patients", type=int, default=50)
+    parser.add_argument("--appointments", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--compare", help="earlier result JSON to diff against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change that counts as a regression")
+    args = parser.parse_args()
+
+    result = asyncio.run(Harness(args).run())
+    print_report(result)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{result['timestamp'].replace(':', '')}-{args.label}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nSaved {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(result, json.load(f), args.threshold):
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
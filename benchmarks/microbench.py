@@ -0,0 +1,339 @@
+"""
+Microbenchmarks for pure hot functions, with a baseline kept in the repo.
+
+    python benchmarks/microbench.py                    # run and compare with microbench_baseline.json
+    python benchmarks/microbench.py -k fhir            # only cases whose name contains "fhir"
+    python benchmarks/microbench.py --update-baseline  # record the current numbers as the baseline
+
+Each case is timed over several repeats of a calibrated batch, then run once more under
+tracemalloc to record peak traced memory and the number of blocks still allocated afterwards.
+A case is flagged as a regression when its median is slower than the baseline by more than
+--threshold and a Mann-Whitney U test says the difference is significant (p < --alpha).
+Baselines are only comparable on the same machine; the file records where it was taken.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from statistics import median
+from typing import Any, Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microbench_baseline.json")
+
+sys.path[:0] = [ROOT, os.path.join(ROOT, "clinical_service"), os.path.join(ROOT, "healthbridge_ai")]
+
+CONDITIONS = ["type 2 diabetes", "hypertension", "hyperlipidaemia", "asthma", "GERD", "hypothyroidism"]
+MEDICATIONS = ["metformin 500mg BD", "lisinopril 10mg OD", "aspirin 75mg OD", "atorvastatin 20mg HS",
+               "amlodipine 5mg OD", "levothyroxine 50mcg OD", "warfarin 5mg OD", "potassium chloride 600mg BD"]
+
+
+def clinical_note(size_bytes: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    parts, total = [], 0
+    while total < size_bytes:
+        sentence = (f"History of {rng.choice(CONDITIONS)}. Continues {rng.choice(MEDICATIONS)}. "
+                    f"BP {rng.randint(110, 160)}/{rng.randint(70, 100)}. Review in {rng.randint(2, 12)} weeks.\n")
+        parts.append(sentence)
+        total += len(sentence)
+    return "".join(parts)[:size_bytes]
+
+
+def entities(count: int) -> List[Dict[str, str]]:
+    return [
+        {"text": f"entity-{i}", "type": "CONDITION" if i % 2 else "MEDICATION", "code": str(100000 + i)}
+        for i in range(count)
+    ]
+
+
+def fenced_json(entries: int) -> str:
+    payload = {
+        "clinical_summary": "Stable. " * 20,
+        "extracted_entities": {
+            "conditions": [{"clinical_text": f"condition {i}", "icd_10": f"E{i:02d}.9", "confidence": 90} for i in range(entries)],
+            "medications": [{"drug_name": f"drug {i}", "rxnorm_code": str(8000 + i), "dosage": "10mg"} for i in range(entries)],
+        },
+    }
+    return "Here is the analysis:\n```json\n" + json.dumps(payload, indent=2) + "\n```\n"
+
+
+# --- Cases ----------------------------------------------------------------------
+
+def build_cases() -> Dict[str, Callable[[], Any]]:
+    """Returns name -> zero-argument callable. Inputs are built here, outside the timed region."""
+    from fhir import map_to_fhir_bundle
+    from nlp import analyze_clinical_text
+    from gemini_client import get_mock_interactions
+    from common import deid, drugnames, llm, scheduling, slotboard, terminology
+
+    cases: Dict[str, Callable[[], Any]] = {}
+
+    for size_kb in (1, 20, 200):
+        note = clinical_note(size_kb * 1024, seed=size_kb)
+        cases[f"nlp.analyze_clinical_text[{size_kb}KB]"] = lambda note=note: analyze_clinical_text(note)
+        cases[f"deid.deidentify[{size_kb}KB]"] = lambda note=note: deid.deidentify(note)
+
+    for count in (10, 200, 1000):
+        ents = entities(count)
+        cases[f"fhir.map_to_fhir_bundle[{count}]"] = (
+            lambda ents=ents: map_to_fhir_bundle("patient-1", ents, "2026-01-01T09:00:00"))
+
+    for count in (2, 10, 50):
+        meds = [m.split()[0] for m in MEDICATIONS] * (count // len(MEDICATIONS) + 1)
+        meds = meds[:count]
+        cases[f"gemini_client.get_mock_interactions[{count}]"] = lambda meds=meds: get_mock_interactions(meds)
+
+    for count in (5, 100, 1000):
+        text = fenced_json(count)
+        cases[f"llm.parse_json_response[{count}]"] = lambda text=text: llm.parse_json_response(text)
+
+    cases["terminology.lookup[icd10cm]"] = lambda: terminology.lookup("icd10cm", "E11.9")
+    cases["terminology.best_match[rxnorm]"] = lambda: terminology.best_match("rxnorm", "Paracetamol 500mg")
+
+    # The index itself, bypassing the per-name memo
+    names = drugnames.index()
+    cases["drugnames.resolve[exact]"] = lambda: names.resolve("Tab Glycomet 500mg")
+    cases["drugnames.resolve[fuzzy]"] = lambda: names.resolve("atorvastatn 10mg")
+    cases["drugnames.resolve[miss]"] = lambda: names.resolve("xyzzy plugh")
+
+    # A doctor with 3 bookings a day over a month, weekday hours with a lunch break
+    template = scheduling.parse_availability("Mon-Fri 9am-1pm, 2pm-6pm")
+    first, last = date(2026, 1, 5), date(2026, 2, 4)
+    booked = [(i, datetime(2026, 1, 5, 9) + timedelta(days=i // 3, hours=2 * (i % 3))) for i in range(90)]
+    calendar = scheduling.DoctorCalendar(booked)
+    cases["scheduling.free_slots[month]"] = lambda: calendar.free_slots(template, first, last)
+    cases["scheduling.conflicts"] = lambda: calendar.conflicts(datetime(2026, 1, 20, 11, 15))
+
+    if slotboard.NUMPY_AVAILABLE:
+        # An organization of 500 doctors with 20 bookings each; the first days are fully booked for some
+        rng = random.Random(7)
+        specialties = ("Cardiology", "Dermatology", "Pediatrics", "Neurology", "Orthopedics")
+        doctors = [slotboard.DoctorRow(i, f"Doctor {i}", specialties[i % 5], 1, "Org", "Mon-Fri 9am-1pm, 2pm-6pm")
+                   for i in range(500)]
+        bookings = [(rng.randrange(500), datetime(2026, 1, 5, 9) + timedelta(days=rng.randrange(30), minutes=30 * rng.randrange(16)))
+                    for _ in range(10000)]
+        board = slotboard.SlotBoard(doctors, bookings, date(2026, 1, 5))
+        window = (datetime(2026, 1, 5, 8), datetime(2026, 1, 19))
+        cases["slotboard.search[500 doctors]"] = lambda: board.search(*window)
+        cases["slotboard.search[specialization]"] = lambda: board.search(*window, specialization="cardio")
+        cases["slotboard.book+release"] = lambda: (board.book(3, window[0]), board.release(3, window[0]))
+
+    cases.update(listing_cases())
+    return cases
+
+
+def listing_cases() -> Dict[str, Callable[[], Any]]:
+    """The appointment/doctor listing endpoints (query + row serialisation) on a throwaway SQLite DB."""
+    workdir = tempfile.mkdtemp(prefix="medx-microbench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import api.index as api
+    finally:
+        os.chdir(cwd)
+
+    session = api.SessionLocal()
+    org = api.Organization(name="Bench Clinic")
+    session.add(org)
+    session.commit()
+    doctors = [api.User(email=f"doc{i}@bench.local", hashed_password="x", full_name=f"Dr {i}", role="doctor",
+                        organization_id=org.id, specialization="Cardiology", availability="Mon-Fri, 9am - 5pm")
+               for i in range(100)]
+    patient = api.User(email="patient@bench.local", hashed_password="x", full_name="Patient", role="patient")
+    session.add_all(doctors + [patient])
+    session.commit()
+    start = datetime(2026, 1, 1, 9)
+    session.add_all([
+        api.Appointment(organization_id=org.id, doctor_id=doctors[i % 5].id, patient_id=patient.id,
+                        patient_name="Patient", date_time=start + timedelta(hours=i), reason="Follow-up")
+        for i in range(500)
+    ])
+    session.commit()
+    api.bump_versions(session, f"org:{org.id}")
+    current = api.listing_etag(session, "appointments", f"org:{org.id}")
+
+    loop = asyncio.new_event_loop()
+
+    def run(endpoint, **kwargs):
+        result = endpoint(db=session, **kwargs)
+        if asyncio.iscoroutine(result):
+            result = loop.run_until_complete(result)
+        return result
+
+    return {
+        "api.get_all_doctors[100]": lambda: run(api.get_all_doctors, specialization=None),
+        "api.get_doctor_appointments[100]": lambda: run(api.get_doctor_appointments, doctor_id=doctors[0].id, if_none_match=None),
+        "api.get_patient_appointments[500]": lambda: run(api.get_patient_appointments, patient_id=patient.id),
+        "api.get_appointments[500]": lambda: run(api.get_appointments, organization_id=org.id, if_none_match=None),
+        "api.get_appointments[500].not_modified": lambda: run(api.get_appointments, organization_id=org.id,
+                                                              if_none_match=current),
+    }
+
+
+# --- Measurement ------------------------------------------------------------------
+
+def calibrate(fn: Callable[[], Any], target: float) -> int:
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - started >= target or number >= 1 << 20:
+            return number
+        number *= 2
+
+
+def measure(fn: Callable[[], Any], repeats: int, target: float) -> Dict[str, Any]:
+    fn()  # warm caches and lazy imports
+    number = calibrate(fn, target)
+    samples = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            for _ in range(number):
+                fn()
+            samples.append((time.perf_counter() - started) / number * 1e6)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    base_current, _ = tracemalloc.get_traced_memory()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+    net_blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+
+    ordered = sorted(samples)
+    return {
+        "median_us": round(median(samples), 3),
+        "iqr_us": round(ordered[(3 * len(ordered)) // 4] - ordered[len(ordered) // 4], 3),
+        "samples_us": [round(s, 3) for s in samples],
+        "batch": number,
+        "peak_kib": round((peak - base_current) / 1024, 1),
+        "net_blocks": net_blocks,
+    }
+
+
+def mann_whitney_p(a: List[float], b: List[float]) -> float:
+    """Two-sided p-value of the Mann-Whitney U test (normal approximation, tie-corrected)."""
+    n1, n2 = len(a), len(b)
+    if not n1 or not n2:
+        return 1.0
+    ranked = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+    ranks = [0.0] * len(ranked)
+    tie_term = 0.0
+    i = 0
+    while i < len(ranked):
+        j = i
+        while j + 1 < len(ranked) and ranked[j + 1][0] == ranked[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        t = j - i + 1
+        tie_term += t ** 3 - t
+        i = j + 1
+    r1 = sum(rank for rank, (_, group) in zip(ranks, ranked) if group == 0)
+    u = r1 - n1 * (n1 + 1) / 2
+    mean_u = n1 * n2 / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (abs(u - mean_u) - 0.5) / math.sqrt(variance)
+    return math.erfc(max(z, 0) / math.sqrt(2))
+
+
+def compare(name: str, current: Dict[str, Any], baseline: Dict[str, Any], threshold: float, alpha: float) -> Tuple[str, float, float]:
+    change = current["median_us"] / baseline["median_us"] - 1 if baseline["median_us"] else 0.0
+    p = mann_whitney_p(current["samples_us"], baseline["samples_us"])
+    if p < alpha and change > threshold:
+        verdict = "REGRESSION"
+    elif p < alpha and change < -threshold:
+        verdict = "faster"
+    else:
+        verdict = ""
+    return verdict, change, p
+
+
+def environment() -> Dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "processor": platform.processor() or "unknown",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="pattern", default="", help="only run cases whose name contains this")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--target", type=float, default=0.05, help="seconds per timed batch")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative slowdown that counts as a regression")
+    parser.add_argument("--alpha", type=float, default=0.01)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--json", help="also write this run's results here")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("environment") != environment():
+            print(f"Note: baseline was recorded on {baseline.get('environment')}; timings may not be comparable.")
+
+    results = {}
+    regressions = 0
+    print(f"{'case':<42}{'median':>12}{'iqr':>10}{'peak KiB':>10}{'blocks':>8}{'vs base':>10}{'p':>9}")
+    for name, fn in build_cases().items():
+        if args.pattern not in name:
+            continue
+        result = measure(fn, args.repeats, args.target)
+        results[name] = result
+        line = (f"{name:<42}{result['median_us']:>10.1f}us{result['iqr_us']:>8.1f}us"
+                f"{result['peak_kib']:>10}{result['net_blocks']:>8}")
+        base = baseline.get("cases", {}).get(name)
+        if base:
+            verdict, change, p = compare(name, result, base, args.threshold, args.alpha)
+            regressions += verdict == "REGRESSION"
+            line += f"{change:>+10.1%}{p:>9.3f}  {verdict}"
+        print(line)
+
+    document = {"recorded": datetime.now().isoformat(timespec="seconds"), "environment": environment(), "cases": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(document, f, indent=2)
+    if args.update_baseline:
+        if baseline.get("cases") and args.pattern:
+            document["cases"] = dict(baseline["cases"], **results)
+        with open(args.baseline, "w") as f:
+            json.dump(document, f, indent=1)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+    elif regressions:
+        print(f"{regressions} significant regression(s)")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
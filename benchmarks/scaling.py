@@ -0,0 +1,182 @@
+"""
+Worker scaling for the API on shared state.
+
+    python benchmarks/scaling.py                         # 1, 2 and 4 uvicorn workers, 20 s each
+    python benchmarks/scaling.py --workers 1,2,4,8 --duration 30 --clients 4
+    python benchmarks/scaling.py --database-url postgresql://...   # state in Postgres instead of SQLite
+
+For each worker count a fresh API is started (uvicorn --workers N) on an empty SQLite file in
+WAL mode, or on --database-url, and driven closed-loop from --clients processes. The mix is
+mostly medication-list reads with adherence writes (--write-ratio), which go through the shared
+state store. The report gives throughput, p50/p95 latency and speedup over one worker.
+
+After each run a medication is added through one connection and read back through fresh
+connections (so through different workers). Any worker that does not see it is reported as
+stale, which would mean state is still per process.
+
+Run the clients on another machine (or leave cores free for them) for meaningful numbers:
+with the load generator on the same cores, scaling is capped by the host, not the service.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_api(workers: int, port: int, database_url: str, workdir: str) -> subprocess.Popen:
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=ROOT, GOOGLE_API_KEY="")
+    env.pop("STATE_DATABASE_URL", None)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.index:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(base: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base}/api/medications", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError(f"API at {base} did not start")
+
+
+async def drive(base: str, duration: float, concurrency: int, write_ratio: float, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    errors = 0
+    stop = time.monotonic() + duration
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                if rng.random() < write_ratio:
+                    r = await client.post(f"{base}/api/adherence", json={"medication_id": "1", "status": "Taken"})
+                else:
+                    r = await client.get(f"{base}/api/medications")
+                if r.status_code >= 400:
+                    errors += 1
+                    continue
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return {"latencies": latencies, "errors": errors}
+
+
+def client_process(base: str, duration: float, concurrency: int, write_ratio: float, seed: int, queue):
+    queue.put(asyncio.run(drive(base, duration, concurrency, write_ratio, seed)))
+
+
+def stale_workers(base: str, probes: int = 24) -> int:
+    """Adds a medication, then counts fresh connections that do not see it."""
+    name = f"scaling-probe-{time.time_ns()}"
+    with httpx.Client(timeout=10) as client:
+        client.post(f"{base}/api/medications", json={"name": name, "dosage": "1mg", "frequency": "Daily"}).raise_for_status()
+    stale = 0
+    for _ in range(probes):
+        with httpx.Client(timeout=10) as client:
+            if name not in [m["name"] for m in client.get(f"{base}/api/medications").json()]:
+                stale += 1
+    return stale
+
+
+def run(workers: int, args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="medx-scaling-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'scaling.db')}"
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    server = start_api(workers, port, database_url, workdir)
+    try:
+        wait_ready(base)
+        asyncio.run(drive(base, args.warmup, args.concurrency, args.write_ratio, 0))
+        queue = multiprocessing.Queue()
+        per_client = max(1, args.concurrency // args.clients)
+        clients = [multiprocessing.Process(target=client_process,
+                                           args=(base, args.duration, per_client, args.write_ratio, seed, queue))
+                   for seed in range(args.clients)]
+        for process in clients:
+            process.start()
+        parts = [queue.get() for _ in clients]
+        for process in clients:
+            process.join()
+        stale = stale_workers(base)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = sorted(latency for part in parts for latency in part["latencies"])
+
+    def percentile(q: float) -> float:
+        return round(latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000, 2) if latencies else 0.0
+
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": sum(part["errors"] for part in parts),
+        "rps": round(len(latencies) / args.duration, 1),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "stale_workers": stale,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated uvicorn worker counts")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--concurrency", type=int, default=64, help="open connections across all client processes")
+    parser.add_argument("--clients", type=int, default=min(4, os.cpu_count() or 1), help="load generator processes")
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--database-url", help="shared database (default: a fresh SQLite file per run)")
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs; {args.clients} client process(es), {args.concurrency} connections, "
+          f"{args.write_ratio:.0%} writes, {args.duration:.0f}s per run")
+    print(f"{'workers':>8}{'req/s':>10}{'speedup':>9}{'eff.':>7}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}{'stale':>7}")
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        result = run(workers, args)
+        results.append(result)
+        speedup = result["rps"] / results[0]["rps"] if results[0]["rps"] else 0.0
+        result["speedup"] = round(speedup, 2)
+        print(f"{workers:>8}{result['rps']:>10}{speedup:>8.2f}x{speedup / workers * results[0]['workers']:>7.0%}"
+              f"{result['p50_ms']:>9}{result['p95_ms']:>9}{result['errors']:>8}{result['stale_workers']:>7}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"cpus": os.cpu_count(), "args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
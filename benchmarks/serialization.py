@@ -0,0 +1,137 @@
+"""
+Response serialization: the path FastAPI takes by default versus the ones the services use now.
+
+    python benchmarks/serialization.py
+    python benchmarks/serialization.py -k bundle
+
+For each payload, times rendering a response body four ways:
+  default    jsonable_encoder + JSONResponse (what a plain dict/list return goes through)
+  pydantic   TypeAdapter validate + dump_json (FastAPI's path when response_model is set)
+  fast       FastJSONResponse (orjson, or compact json when orjson is missing)
+  stream     stream_json batches, consumed one at a time (the /fhir/bundle path; bundle only)
+Peak KiB and blocks come from the same tracemalloc run as microbench.py.
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [ROOT, os.path.dirname(ROOT), os.path.join(os.path.dirname(ROOT), "clinical_service")]
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, TypeAdapter
+
+from common import responses
+from fhir import BUNDLE_ENVELOPE, iter_fhir_entries
+from microbench import entities, measure
+
+
+class Appointment(BaseModel):
+    id: int
+    doctor_name: Optional[str]
+    doctor_specialization: Optional[str]
+    patient_name: Optional[str]
+    date_time: datetime
+    reason: Optional[str]
+    status: Optional[str]
+
+
+class Doctor(BaseModel):
+    id: int
+    full_name: Optional[str]
+    specialization: Optional[str]
+    availability: Optional[str]
+    organization_id: Optional[int]
+    organization_name: str
+    rating: float
+    gender: Optional[str]
+
+
+def appointments(count: int) -> List[Dict[str, Any]]:
+    start = datetime(2026, 1, 1, 9)
+    return [{"id": i, "doctor_name": f"Dr {i % 40}", "doctor_specialization": "Cardiology", "patient_name": f"Patient {i}",
+             "date_time": start + timedelta(minutes=30 * i), "reason": "Follow-up", "status": "Scheduled"}
+            for i in range(count)]
+
+
+def doctors(count: int) -> List[Dict[str, Any]]:
+    rng = random.Random(0)
+    return [{"id": i, "full_name": f"Dr {i}", "specialization": "Cardiology", "availability": "Mon-Fri, 9am - 5pm",
+             "organization_id": 1, "organization_name": "Bench Clinic", "rating": round(rng.uniform(3.5, 5.0), 1),
+             "gender": None}
+            for i in range(count)]
+
+
+def audit_logs(count: int) -> List[Dict[str, Any]]:
+    return [{"id": f"{i:08x}", "timestamp": "Just now", "action": "Clinical Note Analysis", "user": "Web Client",
+             "status": "Success"} for i in range(count)]
+
+
+def analysis(entries: int) -> Dict[str, Any]:
+    return {
+        "clinical_summary": "Stable. " * 40,
+        "extracted_entities": {
+            "conditions": [{"clinical_text": f"condition {i}", "icd_10": f"E{i:02d}.9", "snomed_ct": str(44054006 + i),
+                            "confidence": 90, "status": "active"} for i in range(entries)],
+            "medications": [{"drug_name": f"drug {i}", "rxnorm_code": str(8000 + i), "dosage": "10mg",
+                             "frequency": "daily"} for i in range(entries)],
+        },
+        "risk_flags": [{"flag": f"flag {i}", "severity": "moderate"} for i in range(entries // 4)],
+    }
+
+
+def strategies(payload: Any, model: Any = None) -> Dict[str, Callable[[], Any]]:
+    cases = {
+        "default": lambda: JSONResponse(jsonable_encoder(payload)).body,
+        "fast": lambda: responses.FastJSONResponse(payload).body,
+    }
+    if model is not None:
+        adapter = TypeAdapter(List[model])
+        cases["pydantic"] = lambda: adapter.dump_json(adapter.validate_python(payload))
+    return cases
+
+
+def build_cases() -> Dict[str, Callable[[], Any]]:
+    cases: Dict[str, Callable[[], Any]] = {}
+    for name, payload, model in [
+        ("appointments[1000]", appointments(1000), Appointment),
+        ("doctors[500]", doctors(500), Doctor),
+        ("audit_logs[2000]", audit_logs(2000), None),
+        ("analysis[200]", analysis(200), None),
+    ]:
+        for strategy, fn in strategies(payload, model).items():
+            cases[f"{name}.{strategy}"] = fn
+
+    found = entities(2000)
+    bundle = dict(BUNDLE_ENVELOPE, entry=list(iter_fhir_entries("bench", found, "2026-01-01")))
+    for strategy, fn in strategies(bundle).items():
+        cases[f"bundle[2000].{strategy}"] = fn
+    # Consumed chunk by chunk as the server sends it, so only one batch is alive at a time
+    cases["bundle[2000].stream"] = lambda: sum(map(len, responses.stream_json(BUNDLE_ENVELOPE, "entry", bundle["entry"])))
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="pattern", default="", help="only run cases whose name contains this")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--target", type=float, default=0.05, help="seconds per timed batch")
+    args = parser.parse_args()
+
+    print(f"orjson: {'yes' if responses.ORJSON_AVAILABLE else 'no (compact json fallback)'}")
+    print(f"{'case':<32}{'median':>12}{'iqr':>10}{'peak KiB':>10}{'blocks':>8}{'bytes':>10}")
+    for name, fn in build_cases().items():
+        if args.pattern not in name:
+            continue
+        result = measure(fn, args.repeats, args.target)
+        body = fn()
+        print(f"{name:<32}{result['median_us']:>10.1f}us{result['iqr_us']:>8.1f}us"
+              f"{result['peak_kib']:>10}{result['net_blocks']:>8}{body if isinstance(body, int) else len(body):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,40 @@
 from datetime import datetime
 import uuid
 
+BUNDLE_ENVELOPE = {"resourceType": "Bundle", "type": "transaction"}
+
 def map_to_fhir_bundle(patient_id: str, entities: list, note_date: str = None) -> dict:
     """Maps extracted entities to a FHIR R4 Bundle."""
+    return dict(BUNDLE_ENVELOPE, entry=list(iter_fhir_entries(patient_id, entities, note_date)))
+
+def iter_fhir_entries(patient_id: str, entities, note_date: str = None):
+    """Bundle entries one at a time, for callers that stream the bundle instead of building it."""
     timestamp = note_date or datetime.now().isoformat()
     
-    bundle = {
-        "resourceType": "Bundle",
-        "type": "transaction",
-        "entry": []
-    }
-    
     # Add Patient reference or search
     # For MVP, we just create the entries for found entities
     
     for entity in entities:
         if entity["type"] == "CONDITION":
-            bundle["entry"].append({
+            yield {
                 "resource": {
                     "resourceType": "Condition",
                     "subject": {"reference": f"Patient/{patient_id}"},
                     "code": {
-                        "coding": [{"system": "http://snomed.info/sct", "code": entity["code"], "display": entity["text"]}]
+                        "coding": [{"system": entity.get("system", "http://snomed.info/sct"), "code": entity["code"], "display": entity["text"]}]
                     },
                     "recordedDate": timestamp
                 }
-            })
+            }
         elif entity["type"] == "MEDICATION":
-            bundle["entry"].append({
+            yield {
                 "resource": {
                     "resourceType": "MedicationRequest",
                     "subject": {"reference": f"Patient/{patient_id}"},
                     "medicationCodeableConcept": {
-                        "coding": [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": entity["code"], "display": entity["text"]}]
+                        "coding": [{"system": entity.get("system", "http://www.nlm.nih.gov/research/umls/rxnorm"), "code": entity["code"], "display": entity["text"]}]
                     },
                     "authoredOn": timestamp,
                     "status": "active"
                 }
-            })
-            
-    return bundle
+            }
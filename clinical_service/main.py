@@ -1,13 +1,20 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional
 from nlp import analyze_clinical_text
-from fhir import map_to_fhir_bundle
+from fhir import BUNDLE_ENVELOPE, iter_fhir_entries, map_to_fhir_bundle
 from events import publish_event
+from common import analyses, compression, deadline, metrics, profiling, responses, terminology, tracing
 
-app = FastAPI(title="HealthBridge Clinical Intelligence")
+app = FastAPI(title="HealthBridge Clinical Intelligence", default_response_class=responses.FastJSONResponse)
 
+app.add_middleware(profiling.ProfilerMiddleware)
+app.add_middleware(deadline.DeadlineMiddleware)
+app.add_middleware(tracing.TracingMiddleware, service_name="clinical-service")
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(compression.CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -25,38 +32,86 @@ class ClinicalNote(BaseModel):
 def health_check():
     return {"status": "healthy", "service": "clinical-intelligence"}
 
+# Prometheus scrape target; set METRICS_TOKEN to require a bearer token
+app.add_route("/metrics", metrics.metrics_endpoint, include_in_schema=False)
+# Slow-request profiles and runtime profiler switch; needs PROFILER_TOKEN
+app.include_router(profiling.router)
+
 import os
 import requests
 
 AI_SERVICE_URL = os.getenv("AI_SERVICE_URL", "http://healthbridge-ai:8082")
+# Budget kept back from the AI hop so the local NLP fallback still fits inside the deadline
+LOCAL_FALLBACK_RESERVE = 0.5
+# Analyses of ingested notes; point it at the API's database to show them on its dashboards
+ANALYSIS_DATABASE_URL = os.getenv("ANALYSIS_DATABASE_URL", "sqlite:///analyses.db")
+
+analysis_store = analyses.open_store(ANALYSIS_DATABASE_URL)
+
+def publish_event_traced(event_type: str, data: dict):
+    with tracing.span("event.publish", tracing.PRODUCER, event_type=event_type):
+        return publish_event(event_type, data)
+
+async def extract_entities(note: ClinicalNote) -> list:
+    """Entities from the HealthBridge AI service, or from the local NLP if it is unavailable."""
+    # 1. Analyze via HealthBridge AI service, passing on what is left of our deadline
+    deadline.check()
+    hop_timeout = (deadline.remaining() or deadline.DEFAULT_TIMEOUT) - LOCAL_FALLBACK_RESERVE
+    try:
+        if hop_timeout <= 0:
+            raise requests.Timeout("No budget left for the AI service")
+        with tracing.span("POST /analyze-note", tracing.CLIENT, **{"peer.service": "healthbridge-ai"}) as hop:
+            ai_response = await run_in_threadpool(
+                requests.post,
+                f"{AI_SERVICE_URL}/analyze-note",
+                json=note.dict(),
+                headers=tracing.inject_headers(deadline.outgoing_headers(reserve=LOCAL_FALLBACK_RESERVE)),
+                timeout=hop_timeout
+            )
+            hop.set_attribute("http.status_code", ai_response.status_code)
+    except (requests.Timeout, requests.ConnectionError) as e:
+        print(f"AI service unavailable, using local NLP: {e}")
+        ai_response = None
+    if ai_response is None or ai_response.status_code != 200:
+        # Fallback to local NLP if AI service is down
+        with tracing.span("nlp.local_analysis"):
+            return analyze_clinical_text(note.note_text)
+
+    with tracing.span("json.parse", response_bytes=len(ai_response.content)):
+        ai_data = ai_response.json()
+    # Extract entities from standardized AI response, with codes checked against the local tables
+    with tracing.span("terminology.normalize"):
+        ai_data = terminology.normalize_analysis(ai_data)
+    entities = []
+    for cond in ai_data.get("extracted_entities", {}).get("conditions", []):
+        if cond.get("code_validation", {}).get("snomed_ct") in ("valid", "filled", "replaced"):
+            system, code = terminology.SYSTEMS["snomedct"], cond["snomed_ct"]
+        else:
+            system, code = terminology.SYSTEMS["icd10cm"], cond.get("icd_10")
+        entities.append({"text": cond["clinical_text"], "type": "CONDITION", "code": code, "system": system})
+    for med in ai_data.get("extracted_entities", {}).get("medications", []):
+        entities.append({"text": med["drug_name"], "type": "MEDICATION", "code": med.get("rxnorm_code"),
+                         "system": terminology.SYSTEMS["rxnorm"]})
+    return entities
 
 @app.post("/ingest")
 async def ingest_note(note: ClinicalNote, background_tasks: BackgroundTasks):
     """Ingests a note, analyzes it via AI service, and triggers async processing."""
     try:
-        # 1. Analyze via HealthBridge AI service
-        ai_response = requests.post(
-            f"{AI_SERVICE_URL}/analyze-note",
-            json=note.dict(),
-            timeout=30
-        )
-        if ai_response.status_code != 200:
-            # Fallback to local NLP if AI service is down
-            entities = analyze_clinical_text(note.note_text)
-        else:
-            ai_data = ai_response.json()
-            # Extract entities from standardized AI response
-            entities = []
-            for cond in ai_data.get("extracted_entities", {}).get("conditions", []):
-                entities.append({"text": cond["clinical_text"], "type": "CONDITION", "code": cond["icd_10"]})
-            for med in ai_data.get("extracted_entities", {}).get("medications", []):
-                entities.append({"text": med["drug_name"], "type": "MEDICATION", "code": med["rxnorm_code"]})
+        # A note ingested before is not sent for analysis again
+        with tracing.span("analyses.lookup"):
+            stored = await run_in_threadpool(analysis_store.get, note.patient_id, note.note_text)
+        entities = analyses.entities_of(stored) if stored else await extract_entities(note)
         
         # 2. Map to FHIR
-        bundle = map_to_fhir_bundle(note.patient_id, entities, note.note_date)
+        with tracing.span("fhir.map_bundle", entities=len(entities)):
+            bundle = map_to_fhir_bundle(note.patient_id, entities, note.note_date)
+        if not stored:
+            background_tasks.add_task(analysis_store.save, note.patient_id, note.note_text,
+                                      analyses.from_entities(entities, bundle), note_date=note.note_date, source="ingest")
         
         # 3. Publish Event (Async)
-        background_tasks.add_task(publish_event, "fhir.created", bundle)
+        background_tasks.add_task(publish_event_traced, "fhir.created", bundle)
         
         return {
             "status": "success", 
@@ -64,5 +119,19 @@ async def ingest_note(note: ClinicalNote, background_tasks: BackgroundTasks):
             "entities_detected": len(entities),
             "fhir_summary": f"Bundle with {len(bundle.get('entry', []))} resources"
         }
+    except deadline.DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/fhir/bundle")
+async def fhir_bundle(note: ClinicalNote):
+    """The note's FHIR transaction Bundle itself, streamed entry by entry."""
+    try:
+        entities = await extract_entities(note)
+    except deadline.DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    return responses.StreamingJSONResponse(
+        BUNDLE_ENVELOPE, "entry", iter_fhir_entries(note.patient_id, entities, note.note_date),
+        media_type="application/fhir+json",
+    )
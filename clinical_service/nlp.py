@@ -1,19 +1,31 @@
 # from google.cloud import language_v1
 # Note: In production, use google-cloud-healthcare for specialized medical NLP
+from functools import lru_cache
+
+from common import terminology
+
+# Simple rule-based extraction for demo purposes: keyword -> (entity type, code system, display text)
+KEYWORDS = {
+    "diabetes": ("CONDITION", "snomedct", "diabetes"),
+    "metformin": ("MEDICATION", "rxnorm", "Metformin"),
+    "lisinopril": ("MEDICATION", "rxnorm", "Lisinopril"),
+    "aspirin": ("MEDICATION", "rxnorm", "Aspirin"),
+}
+
+
+@lru_cache(maxsize=None)
+def code_for(system: str, term: str):
+    concept = terminology.best_match(system, term)
+    return concept.code if concept else None
+
 
 def analyze_clinical_text(text: str) -> list:
     """Calls Google Healthcare NLP API to extract entities."""
     # Simulation for MVP
     entities = []
-    
-    # Simple rule-based extraction for demo purposes
-    if "diabetes" in text.lower():
-        entities.append({"text": "diabetes", "type": "CONDITION", "code": "73211009"})
-    if "metformin" in text.lower():
-        entities.append({"text": "Metformin", "type": "MEDICATION", "code": "6809"})
-    if "lisinopril" in text.lower():
-        entities.append({"text": "Lisinopril", "type": "MEDICATION", "code": "29046"})
-    if "aspirin" in text.lower():
-        entities.append({"text": "Aspirin", "type": "MEDICATION", "code": "1191"})
-        
+    lowered = text.lower()
+    for keyword, (entity_type, system, display) in KEYWORDS.items():
+        if keyword in lowered:
+            entities.append({"text": display, "type": entity_type, "code": code_for(system, keyword),
+                             "system": terminology.SYSTEMS[system]})
     return entities
@@ -0,0 +1,342 @@
+"""
+Persistent history of clinical note analyses.
+Each (patient, note) pair has one stored analysis; the note is identified by a hash of its
+whitespace-normalized text, so re-submitting an unchanged note is a lookup instead of an LLM call.
+Conditions and medications are also stored as rows, indexed for queries across notes
+("active conditions for patient X", "patients on drug Y"). Saving a note again replaces only
+that note's rows.
+"""
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import (Boolean, Column, Float, Index, Integer, MetaData, String, Table, Text, UniqueConstraint,
+                        bindparam, create_engine, delete, insert, or_, select, update)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+from common import drugnames, llm, terminology
+
+HISTORY_LIMIT = int(os.getenv("ANALYSIS_HISTORY_LIMIT", "50"))
+
+metadata = MetaData()
+
+notes_table = Table(
+    "note_analyses", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("patient_id", String, nullable=False),
+    Column("note_key", String, nullable=False),
+    Column("note_date", String),
+    Column("source", String),
+    Column("summary", Text),
+    Column("analysis", Text),
+    Column("fhir_bundle", Text),
+    Column("flags", Text),
+    Column("needs_review", Boolean, nullable=False, default=False),
+    Column("created_at", Float, nullable=False),
+    Column("updated_at", Float, nullable=False),
+    UniqueConstraint("patient_id", "note_key", name="uq_note_analyses_note"),
+    Index("ix_note_analyses_patient", "patient_id", "updated_at"),
+)
+
+conditions_table = Table(
+    "analysis_conditions", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("analysis_id", Integer, nullable=False, index=True),
+    Column("patient_id", String, nullable=False),
+    Column("text", String),
+    Column("code", String),
+    Column("system", String),
+    Column("severity", String),
+    # "active", or "refuted" when the note negates it
+    Column("status", String, nullable=False),
+    Column("recorded", Float, nullable=False),
+    Index("ix_analysis_conditions_patient", "patient_id", "status"),
+    Index("ix_analysis_conditions_code", "code", "status"),
+)
+
+medications_table = Table(
+    "analysis_medications", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("analysis_id", Integer, nullable=False, index=True),
+    Column("patient_id", String, nullable=False, index=True),
+    Column("name", String),
+    # Resolved ingredient (or the cleaned name), so brand, generic and misspelt names match
+    Column("ingredient", String, index=True),
+    Column("rxnorm_code", String, index=True),
+    Column("dosage", String),
+    Column("frequency", String),
+    Column("recorded", Float, nullable=False),
+)
+
+# Per-section results of incremental re-analysis (common.notes.analyze_incremental), by unit_key
+sections_table = Table(
+    "note_section_results", metadata,
+    Column("key", String, primary_key=True),
+    Column("result", Text, nullable=False),
+    Column("created_at", Float, nullable=False),
+)
+
+_SELECT_NOTE = select(notes_table).where(
+    notes_table.c.patient_id == bindparam("patient_id"), notes_table.c.note_key == bindparam("note_key"))
+
+
+def note_key(note_text: str) -> str:
+    return hashlib.sha256(llm.normalize_text(note_text).encode("utf-8")).hexdigest()
+
+
+def _ingredient(name: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    (ingredient, rxcui) of a medication name; the cleaned name when it does not resolve. Only exact
+    names, brands and salts count: a typo corrected to a look-alike drug would put patients under
+    the wrong drug in patients_on.
+    """
+    match = drugnames.resolve(name or "", fuzzy=False)
+    if match:
+        return match.ingredient.lower(), match.rxcui
+    return " ".join(drugnames.clean(name or "")) or None, None
+
+
+def _medication_row(name: str, rxnorm_code: Optional[str], dosage: Any = None, frequency: Any = None) -> Dict[str, Any]:
+    ingredient, rxcui = _ingredient(name)
+    return {"name": name, "ingredient": ingredient, "rxnorm_code": rxnorm_code or rxcui,
+            "dosage": dosage, "frequency": frequency}
+
+
+def from_analysis(analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """Rows, flags, summary and bundle of an analyze-note result."""
+    entities = analysis.get("extracted_entities") or {}
+    conditions, medications, flags = [], [], []
+    for c in entities.get("conditions") or []:
+        if not isinstance(c, dict):
+            continue
+        if c.get("icd_10"):
+            code, system = c["icd_10"], terminology.SYSTEMS["icd10cm"]
+        else:
+            code, system = c.get("snomed_ct"), terminology.SYSTEMS["snomedct"] if c.get("snomed_ct") else None
+        conditions.append({"text": c.get("clinical_text"), "code": code, "system": system, "severity": c.get("severity"),
+                           "status": "refuted" if c.get("negated") else "active"})
+        if c.get("requires_review"):
+            flags.append({"kind": "review", "text": f"Check condition '{c.get('clinical_text')}'"})
+    for m in entities.get("medications") or []:
+        if not isinstance(m, dict):
+            continue
+        medications.append(_medication_row(m.get("drug_name"), m.get("rxnorm_code"), m.get("dosage"), m.get("frequency")))
+        if m.get("requires_review"):
+            flags.append({"kind": "review", "text": f"Check medication '{m.get('drug_name')}'"})
+    for item in analysis.get("human_review_queue") or []:
+        if isinstance(item, dict):
+            flags.append({"kind": "review", "text": item.get("reason"), "priority": item.get("priority")})
+    for barrier in (analysis.get("adherence_insights") or {}).get("barriers_identified") or []:
+        flags.append({"kind": "adherence_barrier", "text": barrier})
+    return {
+        "conditions": conditions,
+        "medications": medications,
+        "flags": flags,
+        "summary": analysis.get("clinical_summary"),
+        "fhir_bundle": analysis.get("fhir_resources"),
+    }
+
+
+def from_entities(entities: List[Dict[str, Any]], bundle: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Rows of the clinical service's entity list ({"text", "type", "code", "system"})."""
+    conditions = [{"text": e["text"], "code": e.get("code"), "system": e.get("system"), "severity": None,
+                   "status": "active"} for e in entities if e["type"] == "CONDITION"]
+    medications = [_medication_row(e["text"], e.get("code")) for e in entities if e["type"] == "MEDICATION"]
+    return {"conditions": conditions, "medications": medications, "flags": [], "summary": None, "fhir_bundle": bundle}
+
+
+def entities_of(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """A stored analysis back in the clinical service's entity form."""
+    entities = [{"text": c["text"], "type": "CONDITION", "code": c["code"], "system": c["system"]}
+                for c in record["conditions"] if c["status"] == "active"]
+    entities += [{"text": m["name"], "type": "MEDICATION", "code": m["rxnorm_code"],
+                  "system": terminology.SYSTEMS["rxnorm"]} for m in record["medications"]]
+    return entities
+
+
+def _condition_key(row: Dict[str, Any]) -> str:
+    return row["code"] or (row["text"] or "").strip().lower()
+
+
+class SectionResults:
+    """notes.SectionCache on the store's database, so every worker reuses the same section results."""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    def get_many(self, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        if not keys:
+            return {}
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(sections_table.c.key, sections_table.c.result)
+                                .where(sections_table.c.key.in_(keys))).all()
+        return {key: json.loads(result) for key, result in rows}
+
+    def put(self, key: str, result: Dict[str, Any]):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(insert(sections_table).values(key=key, result=json.dumps(result, default=str),
+                                                           created_at=time.time()))
+        except IntegrityError:
+            # Another worker stored the same section first; results for a key are interchangeable
+            pass
+
+
+class AnalysisStore:
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.sections = SectionResults(engine)
+        metadata.create_all(engine, checkfirst=True)
+
+    def get(self, patient_id: str, note_text: str) -> Optional[Dict[str, Any]]:
+        """The stored analysis of this exact note (whitespace aside), or None."""
+        with self.engine.connect() as conn:
+            row = conn.execute(_SELECT_NOTE, {"patient_id": str(patient_id), "note_key": note_key(note_text)}).first()
+            return self._record(conn, row) if row else None
+
+    def record(self, patient_id: str, analysis_id: int) -> Optional[Dict[str, Any]]:
+        with self.engine.connect() as conn:
+            row = conn.execute(select(notes_table).where(
+                notes_table.c.id == analysis_id, notes_table.c.patient_id == str(patient_id))).first()
+            return self._record(conn, row) if row else None
+
+    def save(self, patient_id: str, note_text: str, parts: Dict[str, Any], analysis: Optional[Dict[str, Any]] = None,
+             note_date: Optional[str] = None, source: str = "api") -> int:
+        """Stores (or replaces) the analysis of one note; parts comes from from_analysis/from_entities."""
+        patient_id, key, now = str(patient_id), note_key(note_text), time.time()
+        values = {
+            "note_date": note_date,
+            "source": source,
+            "summary": parts.get("summary"),
+            "analysis": json.dumps(analysis, default=str) if analysis is not None else None,
+            "fhir_bundle": json.dumps(parts["fhir_bundle"], default=str) if parts.get("fhir_bundle") else None,
+            "flags": json.dumps(parts["flags"], default=str),
+            "needs_review": any(f["kind"] == "review" for f in parts["flags"]),
+            "updated_at": now,
+        }
+        with self.engine.begin() as conn:
+            analysis_id = self._upsert(conn, patient_id, key, values)
+            conn.execute(delete(conditions_table).where(conditions_table.c.analysis_id == analysis_id))
+            conn.execute(delete(medications_table).where(medications_table.c.analysis_id == analysis_id))
+            common = {"analysis_id": analysis_id, "patient_id": patient_id, "recorded": now}
+            if parts["conditions"]:
+                conn.execute(insert(conditions_table), [dict(c, **common) for c in parts["conditions"]])
+            if parts["medications"]:
+                conn.execute(insert(medications_table), [dict(m, **common) for m in parts["medications"]])
+        return analysis_id
+
+    def _upsert(self, conn, patient_id: str, key: str, values: Dict[str, Any]) -> int:
+        scope = {"patient_id": patient_id, "note_key": key}
+        for _ in range(2):
+            existing = conn.execute(select(notes_table.c.id).where(
+                notes_table.c.patient_id == patient_id, notes_table.c.note_key == key)).scalar()
+            if existing:
+                conn.execute(update(notes_table).where(notes_table.c.id == existing).values(**values))
+                return existing
+            try:
+                with conn.begin_nested():
+                    return conn.execute(insert(notes_table).values(
+                        created_at=values["updated_at"], **scope, **values)).inserted_primary_key[0]
+            except IntegrityError:
+                # The same note was saved concurrently; update that row instead
+                continue
+        raise RuntimeError(f"Could not store analysis for patient {patient_id}")
+
+    def history(self, patient_id: str, limit: int = HISTORY_LIMIT) -> List[Dict[str, Any]]:
+        """The patient's analyses, newest first, without the full analysis and bundle bodies."""
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(notes_table).where(notes_table.c.patient_id == str(patient_id))
+                                .order_by(notes_table.c.updated_at.desc()).limit(limit)).all()
+            conditions, medications = self._children(conn, [r.id for r in rows])
+        return [self._summary(r, conditions.get(r.id, []), medications.get(r.id, [])) for r in rows]
+
+    def active_conditions(self, patient_id: str) -> List[Dict[str, Any]]:
+        """Conditions whose latest mention for the patient was not negated, most recent first."""
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(conditions_table).where(conditions_table.c.patient_id == str(patient_id))
+                                .order_by(conditions_table.c.recorded.desc(), conditions_table.c.id.desc())).mappings().all()
+        latest: Dict[str, Dict[str, Any]] = {}
+        for row in rows:
+            latest.setdefault(_condition_key(row), row)
+        return [self._condition(row) for row in latest.values() if row["status"] == "active"]
+
+    def patients_on(self, drug: str) -> List[Dict[str, Any]]:
+        """Patients with a medication matching drug (by exact ingredient, brand or RxNorm code) in any analysis."""
+        ingredient, rxcui = _ingredient(drug)
+        matches = [medications_table.c.ingredient == ingredient] if ingredient else []
+        if rxcui:
+            matches.append(medications_table.c.rxnorm_code == rxcui)
+        if not matches:
+            return []
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(medications_table).where(or_(*matches))
+                                .order_by(medications_table.c.recorded.desc(), medications_table.c.id.desc())).mappings().all()
+        patients: Dict[str, Dict[str, Any]] = {}
+        for row in rows:
+            entry = patients.setdefault(row["patient_id"], {"patient_id": row["patient_id"], "last_recorded": row["recorded"],
+                                                            "medications": []})
+            if row["name"] not in entry["medications"]:
+                entry["medications"].append(row["name"])
+        return list(patients.values())
+
+    def iter_rows(self, table: Table, batch: int = 500) -> Iterator[Dict[str, Any]]:
+        """Every row of a child table, in keyset pages (for bulk export)."""
+        after = 0
+        while True:
+            with self.engine.connect() as conn:
+                page = conn.execute(select(table).where(table.c.id > after).order_by(table.c.id).limit(batch)).mappings().all()
+            yield from page
+            if len(page) < batch:
+                return
+            after = page[-1]["id"]
+
+    def _children(self, conn, ids: List[int]) -> Tuple[Dict[int, list], Dict[int, list]]:
+        conditions: Dict[int, list] = {}
+        medications: Dict[int, list] = {}
+        if ids:
+            for row in conn.execute(select(conditions_table).where(conditions_table.c.analysis_id.in_(ids))
+                                    .order_by(conditions_table.c.id)).mappings():
+                conditions.setdefault(row["analysis_id"], []).append(self._condition(row))
+            for row in conn.execute(select(medications_table).where(medications_table.c.analysis_id.in_(ids))
+                                    .order_by(medications_table.c.id)).mappings():
+                medications.setdefault(row["analysis_id"], []).append(
+                    {k: row[k] for k in ("name", "ingredient", "rxnorm_code", "dosage", "frequency")})
+        return conditions, medications
+
+    @staticmethod
+    def _condition(row) -> Dict[str, Any]:
+        return {k: row[k] for k in ("text", "code", "system", "severity", "status", "recorded")}
+
+    @staticmethod
+    def _summary(row, conditions: list, medications: list) -> Dict[str, Any]:
+        return {
+            "id": row.id,
+            "patient_id": row.patient_id,
+            "note_key": row.note_key,
+            "note_date": row.note_date,
+            "source": row.source,
+            "summary": row.summary,
+            "flags": json.loads(row.flags or "[]"),
+            "needs_review": row.needs_review,
+            "conditions": conditions,
+            "medications": medications,
+            "created_at": row.created_at,
+            "updated_at": row.updated_at,
+        }
+
+    def _record(self, conn, row) -> Dict[str, Any]:
+        conditions, medications = self._children(conn, [row.id])
+        record = self._summary(row, conditions.get(row.id, []), medications.get(row.id, []))
+        record["analysis"] = json.loads(row.analysis) if row.analysis else None
+        record["fhir_bundle"] = json.loads(row.fhir_bundle) if row.fhir_bundle else None
+        return record
+
+
+def open_store(url: str) -> AnalysisStore:
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+    return AnalysisStore(create_engine(url, connect_args=connect_args))
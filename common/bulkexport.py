@@ -0,0 +1,340 @@
+"""
+Bulk data export in the style of FHIR $export.
+A job writes NDJSON files per resource type under EXPORT_DIR/<job id>/. Sources are read as
+streams (server-side cursors, keyset pages) and every resource is written as soon as it is
+built, so memory stays flat however large the population is. Types larger than
+EXPORT_FILE_MAX_RESOURCES are split into several files that can be downloaded in parallel.
+Progress and the final manifest live in manifest.json next to the files, so any worker on the
+host can answer status polls; the directory must be shared storage to span hosts.
+"""
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from zoneinfo import ZoneInfo
+
+from fastapi import HTTPException
+
+from common import responses, scheduling
+
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+EXPORT_DIR = Path(os.getenv("EXPORT_DIR", "exports"))
+FILE_MAX_RESOURCES = int(os.getenv("EXPORT_FILE_MAX_RESOURCES", "100000"))
+RETENTION_HOURS = float(os.getenv("EXPORT_RETENTION_HOURS", "24"))
+# Appointments are stored as clinic wall-clock times; FHIR instants need an offset
+EXPORT_TIMEZONE = os.getenv("EXPORT_TIMEZONE", scheduling.CLINIC_TIMEZONE)
+PROGRESS_EVERY = 1000
+
+NDJSON = "application/fhir+ndjson"
+JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+# Resource type -> callable returning an iterable of resources
+Source = Callable[[], Iterable[Dict[str, Any]]]
+
+
+class Cancelled(Exception):
+    pass
+
+
+def require_export_token(authorization: Optional[str]):
+    if not EXPORT_TOKEN:
+        raise HTTPException(status_code=404, detail="Bulk export is disabled (EXPORT_TOKEN not set)")
+    if authorization != f"Bearer {EXPORT_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid export token")
+
+
+# --- Jobs -------------------------------------------------------------------------
+
+def job_dir(job_id: str) -> Path:
+    if not JOB_ID.match(job_id):
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return EXPORT_DIR / job_id
+
+
+def read_manifest(job_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(job_dir(job_id) / "manifest.json") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_manifest(manifest: Dict[str, Any]):
+    directory = job_dir(manifest["id"])
+    if not directory.is_dir():
+        raise Cancelled()
+    temp = directory / f".manifest.{os.getpid()}.tmp"
+    with open(temp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temp, directory / "manifest.json")
+
+
+def create_job(request_url: str, types: List[str]) -> Dict[str, Any]:
+    remove_expired()
+    manifest = {
+        "id": uuid.uuid4().hex,
+        "status": "in-progress",
+        "transactionTime": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "request": request_url,
+        "requiresAccessToken": bool(EXPORT_TOKEN),
+        "types": types,
+        "progress": {t: 0 for t in types},
+        "output": [],
+        "error": [],
+        "created": time.time(),
+    }
+    job_dir(manifest["id"]).mkdir(parents=True)
+    write_manifest(manifest)
+    return manifest
+
+
+def delete_job(job_id: str) -> bool:
+    directory = job_dir(job_id)
+    if not directory.is_dir():
+        return False
+    # A running job notices the missing directory at its next progress update and stops
+    shutil.rmtree(directory, ignore_errors=True)
+    return True
+
+
+def remove_expired():
+    if not EXPORT_DIR.is_dir():
+        return
+    cutoff = time.time() - RETENTION_HOURS * 3600
+    for directory in EXPORT_DIR.iterdir():
+        if directory.is_dir() and JOB_ID.match(directory.name) and directory.stat().st_mtime < cutoff:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class _NDJSONWriter:
+    """Writes one resource type, starting a new numbered file every FILE_MAX_RESOURCES lines."""
+
+    def __init__(self, directory: Path, resource_type: str):
+        self.directory = directory
+        self.resource_type = resource_type
+        self.files: List[Dict[str, Any]] = []
+        self._file = None
+        self._count = 0
+
+    def write(self, resource: Dict[str, Any]):
+        if self._file is None or self._count >= FILE_MAX_RESOURCES:
+            self._rotate()
+        self._file.write(responses.dumps(resource) + b"\n")
+        self._count += 1
+
+    def _rotate(self):
+        self.close()
+        name = f"{self.resource_type}.{len(self.files) + 1}.ndjson"
+        # Written under a temporary name; a listed file is always complete
+        self._file = open(self.directory / (name + ".part"), "wb", buffering=1 << 16)
+        self._name = name
+        self._count = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        try:
+            os.replace(self.directory / (self._name + ".part"), self.directory / self._name)
+        except FileNotFoundError:
+            raise Cancelled()
+        self.files.append({"type": self.resource_type, "file": self._name, "count": self._count})
+
+
+def run(job_id: str, sources: Dict[str, Source]):
+    """Runs an export created by create_job (meant for a background task)."""
+    manifest = read_manifest(job_id)
+    if manifest is None:
+        return
+    directory = job_dir(job_id)
+    started = time.perf_counter()
+    try:
+        for resource_type in manifest["types"]:
+            manifest["current"] = resource_type
+            writer = _NDJSONWriter(directory, resource_type)
+            try:
+                for count, resource in enumerate(sources[resource_type](), 1):
+                    writer.write(resource)
+                    if count % PROGRESS_EVERY == 0:
+                        manifest["progress"][resource_type] = count
+                        write_manifest(manifest)
+            except Cancelled:
+                raise
+            except Exception as e:
+                print(f"Bulk export {job_id}: {resource_type} failed: {e}")
+                manifest["error"].append({"type": "OperationOutcome", "resource_type": resource_type, "diagnostics": str(e)})
+            finally:
+                writer.close()
+            manifest["output"] += writer.files
+            manifest["progress"][resource_type] = sum(f["count"] for f in writer.files)
+            write_manifest(manifest)
+        manifest["status"] = "completed"
+        manifest["current"] = None
+        manifest["duration_s"] = round(time.perf_counter() - started, 2)
+        write_manifest(manifest)
+        print(f"Bulk export {job_id}: {sum(manifest['progress'].values())} resources in {manifest['duration_s']}s")
+    except Cancelled:
+        shutil.rmtree(directory, ignore_errors=True)
+        print(f"Bulk export {job_id}: cancelled")
+
+
+def completion_manifest(manifest: Dict[str, Any], base_url: str) -> Dict[str, Any]:
+    """The $export completion response: one entry (with a download URL) per file."""
+    url = f"{base_url.rstrip('/')}/api/fhir/export/{manifest['id']}"
+    return {
+        "transactionTime": manifest["transactionTime"],
+        "request": manifest["request"],
+        "requiresAccessToken": manifest["requiresAccessToken"],
+        "output": [{"type": f["type"], "url": f"{url}/{f['file']}", "count": f["count"]} for f in manifest["output"]],
+        "error": manifest["error"],
+    }
+
+
+def progress_header(manifest: Dict[str, Any]) -> str:
+    """X-Progress while a job runs, e.g. "Appointment (3/4 types), 120000 resources written"."""
+    current = manifest.get("current") or manifest["types"][0]
+    position = manifest["types"].index(current) + 1
+    return f"{current} ({position}/{len(manifest['types'])} types), {sum(manifest['progress'].values())} resources written"
+
+
+# --- FHIR resources ---------------------------------------------------------------
+
+GENDERS = {"male": "male", "m": "male", "female": "female", "f": "female", "other": "other"}
+APPOINTMENT_STATUSES = {"Scheduled": "booked", "Completed": "fulfilled", "Cancelled": "cancelled"}
+try:
+    _zone = ZoneInfo(EXPORT_TIMEZONE)
+except Exception:
+    print(f"Warning: unknown EXPORT_TIMEZONE {EXPORT_TIMEZONE!r}. Appointment times are exported as UTC.")
+    _zone = timezone.utc
+
+
+def instant(value: datetime) -> str:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=_zone)
+    return value.isoformat()
+
+
+def _birth_date(value: Optional[str]) -> Optional[str]:
+    try:
+        return date.fromisoformat((value or "")[:10]).isoformat()
+    except ValueError:
+        return None
+
+
+def _without_empty(resource: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in resource.items() if v not in (None, "", [], {})}
+
+
+def patient_resource(row: Any) -> Dict[str, Any]:
+    """A users row (id, medx_id, full_name, gender, dob, email, contact_number, address)."""
+    telecom = []
+    if row.email:
+        telecom.append({"system": "email", "value": row.email})
+    if row.contact_number:
+        telecom.append({"system": "phone", "value": row.contact_number})
+    return _without_empty({
+        "resourceType": "Patient",
+        "id": str(row.id),
+        "identifier": [{"system": "urn:medx:id", "value": row.medx_id}] if row.medx_id else None,
+        "name": [{"text": row.full_name}] if row.full_name else None,
+        "gender": GENDERS.get((row.gender or "").strip().lower(), "unknown" if row.gender else None),
+        "birthDate": _birth_date(row.dob),
+        "telecom": telecom,
+        "address": [{"text": row.address}] if row.address else None,
+    })
+
+
+def practitioner_resource(row: Any) -> Dict[str, Any]:
+    """A doctor row (id, full_name, gender, specialization, organization_id)."""
+    return _without_empty({
+        "resourceType": "Practitioner",
+        "id": str(row.id),
+        "name": [{"text": row.full_name}] if row.full_name else None,
+        "gender": GENDERS.get((row.gender or "").strip().lower(), "unknown" if row.gender else None),
+        "qualification": [{"code": {"text": row.specialization}}] if row.specialization else None,
+    })
+
+
+def appointment_resource(row: Any) -> Dict[str, Any]:
+    """An appointments row (id, status, reason, date_time, patient_id, patient_name, doctor_id)."""
+    participants = [{
+        "actor": _without_empty({"reference": f"Patient/{row.patient_id}" if row.patient_id else None,
+                                 "display": row.patient_name}),
+        "status": "accepted",
+    }]
+    if row.doctor_id:
+        participants.append({"actor": {"reference": f"Practitioner/{row.doctor_id}"}, "status": "accepted"})
+    resource = {
+        "resourceType": "Appointment",
+        "id": str(row.id),
+        "status": APPOINTMENT_STATUSES.get(row.status, "proposed"),
+        "description": row.reason,
+        "participant": participants,
+    }
+    if row.date_time:
+        resource["start"] = instant(row.date_time)
+        resource["end"] = instant(row.date_time + timedelta(minutes=scheduling.APPOINTMENT_MINUTES))
+        resource["minutesDuration"] = scheduling.APPOINTMENT_MINUTES
+    return _without_empty(resource)
+
+
+def medication_statement(owner: str, medication: Dict[str, Any]) -> Dict[str, Any]:
+    """A stored medication-list entry of patient owner."""
+    coding = [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": medication["rxnorm_code"],
+               "display": medication.get("ingredient") or medication.get("name")}] if medication.get("rxnorm_code") else None
+    dosage = " ".join(str(medication[k]) for k in ("dosage", "frequency") if medication.get(k))
+    return _without_empty({
+        "resourceType": "MedicationStatement",
+        "id": str(medication.get("id") or uuid.uuid4()),
+        "status": "active",
+        "medicationCodeableConcept": _without_empty({"coding": coding, "text": medication.get("name")}),
+        "subject": {"reference": f"Patient/{owner}"},
+        "dosage": [{"text": dosage}] if dosage else None,
+    })
+
+
+def _recorded(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="seconds")
+
+
+def condition_resource(row: Dict[str, Any]) -> Dict[str, Any]:
+    """A stored analysis condition (common.analyses.conditions_table)."""
+    coding = [_without_empty({"system": row["system"], "code": row["code"], "display": row["text"]})] if row["code"] else None
+    return _without_empty({
+        "resourceType": "Condition",
+        "id": f"analysis-condition-{row['id']}",
+        "clinicalStatus": {"coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/condition-clinical", "code": "active",
+        }]} if row["status"] == "active" else None,
+        "verificationStatus": {"coding": [{
+            "system": "http://terminology.hl7.org/CodeSystem/condition-ver-status",
+            "code": "refuted" if row["status"] == "refuted" else "unconfirmed",
+        }]},
+        "severity": {"text": row["severity"]} if row["severity"] else None,
+        "code": _without_empty({"coding": coding, "text": row["text"]}),
+        "subject": {"reference": f"Patient/{row['patient_id']}"},
+        "recordedDate": _recorded(row["recorded"]),
+    })
+
+
+def medication_request(row: Dict[str, Any]) -> Dict[str, Any]:
+    """A stored analysis medication (common.analyses.medications_table)."""
+    coding = [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": row["rxnorm_code"],
+               "display": row["ingredient"] or row["name"]}] if row["rxnorm_code"] else None
+    dosage = " ".join(str(row[k]) for k in ("dosage", "frequency") if row[k])
+    return _without_empty({
+        "resourceType": "MedicationRequest",
+        "id": f"analysis-medication-{row['id']}",
+        "status": "active",
+        "intent": "order",
+        "medicationCodeableConcept": _without_empty({"coding": coding, "text": row["name"]}),
+        "subject": {"reference": f"Patient/{row['patient_id']}"},
+        "authoredOn": _recorded(row["recorded"]),
+        "dosageInstruction": [{"text": dosage}] if dosage else None,
+    })
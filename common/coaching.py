@@ -0,0 +1,186 @@
+"""
+Precomputed patient coaching cards.
+Cards depend on a patient's medications and the rest of their coaching context (age, adherence
+barriers), so they are generated in the background when that changes and served from the store
+afterwards. Each stored set carries a fingerprint of the context it was generated for; a mismatch
+means the cards are stale. Bursts of changes are debounced into one regeneration per patient.
+Generators raise on failure: the previous cards stay in place and the next read retries, and
+callers substitute their default cards only when nothing has been generated yet.
+Cards are kept in the shared state store when the service has one, so every worker serves the same
+cards; without it they live in process memory and each worker generates its own. The debounce
+timers and in-flight bookkeeping are always per process.
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from common import drugnames, statestore
+
+# Wait this long after the last medication change before regenerating
+DEBOUNCE_SECONDS = float(os.getenv("COACHING_DEBOUNCE_SECONDS", "2"))
+
+# (patient_id, patient context with "medications") -> cards
+Generator = Callable[[str, Dict[str, Any]], Awaitable[List[Dict[str, Any]]]]
+
+
+def patient_context(request: Dict[str, Any]) -> Dict[str, Any]:
+    """The coaching-relevant fields of a request body: everything except the patient id and medications."""
+    return {k: v for k, v in request.items() if k not in ("patient_id", "medications") and v is not None}
+
+
+def fingerprint(medications: List[Any], context: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Order- and case-insensitive hash of the medication set (canonical name, dosage, frequency),
+    plus the rest of the patient context when given.
+    """
+    entries = sorted(
+        "|".join([drugnames.canonical_key(str(m.get("name") or m.get("drug_name") or ""))]
+                 + [str(v or "").strip().lower() for v in (m.get("dosage"), m.get("frequency"))])
+        if isinstance(m, dict) else drugnames.canonical_key(str(m))
+        for m in medications
+    )
+    if context:
+        entries.append(json.dumps(context, sort_keys=True, default=str))
+    return hashlib.sha256(json.dumps(entries).encode("utf-8")).hexdigest()[:16]
+
+
+class CoachingStore:
+    """
+    patient_id -> {"fingerprint", "cards", "generated_at"}. With a state store the record is shared by
+    every worker using that database; without one it is kept in this process only, which is fine for a
+    single worker but makes each worker of a multi-worker service regenerate and serve its own cards.
+    """
+
+    COLLECTION = "coaching"
+
+    def __init__(self, state: Optional[statestore.SQLStateStore] = None):
+        self.state = state
+        self._records: Dict[str, Dict[str, Any]] = {}
+
+    def get(self, patient_id: str) -> Optional[Dict[str, Any]]:
+        if self.state is None:
+            return self._records.get(patient_id)
+        stored = self.state.list(self.COLLECTION, patient_id)
+        return stored[-1] if stored else None
+
+    def put(self, patient_id: str, medications_fingerprint: str, cards: List[Dict[str, Any]]):
+        record = {
+            "fingerprint": medications_fingerprint,
+            "cards": cards,
+            "generated_at": time.time(),
+        }
+        if self.state is None:
+            self._records[patient_id] = record
+        else:
+            self.state.replace(self.COLLECTION, patient_id, [dict(record, id="cards")])
+
+
+class CoachingWorker:
+    def __init__(self, generate: Generator, store: Optional[CoachingStore] = None, debounce: float = DEBOUNCE_SECONDS):
+        self.generate = generate
+        self.store = store or CoachingStore()
+        self.debounce = debounce
+        self._pending: Dict[str, asyncio.Task] = {}
+        # patient_id -> fingerprint currently being generated
+        self._running: Dict[str, str] = {}
+        self._medications: Dict[str, List[Dict[str, Any]]] = {}
+        self._contexts: Dict[str, Dict[str, Any]] = {}
+        self._stats = {"scheduled": 0, "generated": 0, "skipped": 0, "failed": 0}
+
+    def _fingerprint(self, patient_id: str) -> str:
+        return fingerprint(self._medications.get(patient_id, []), self._contexts.get(patient_id))
+
+    def _record(self, patient_id: str, medications: List[Dict[str, Any]], context: Optional[Dict[str, Any]]):
+        self._medications[patient_id] = list(medications)
+        if context is not None:
+            self._contexts[patient_id] = dict(context)
+
+    def schedule(self, patient_id: str, medications: List[Dict[str, Any]], context: Optional[Dict[str, Any]] = None):
+        """
+        Records the patient's new medication list and (re)starts their debounce timer.
+        Without a context the patient's last known one (age, barriers, ...) is kept.
+        """
+        self._record(patient_id, medications, context)
+        self._stats["scheduled"] += 1
+        task = self._pending.get(patient_id)
+        if task is not None and not task.done():
+            task.cancel()
+        # A fresh context: the refresh outlives the request that triggered it, so it must not inherit
+        # that request's deadline (it would be dropped once the request times out) or trace span
+        self._pending[patient_id] = contextvars.Context().run(asyncio.ensure_future, self._refresh_later(patient_id))
+
+    async def _refresh_later(self, patient_id: str):
+        try:
+            await asyncio.sleep(self.debounce)
+        except asyncio.CancelledError:
+            return
+        # From here on the regeneration is not cancelled by newer changes; they re-run it afterwards
+        self._pending.pop(patient_id, None)
+        await self.refresh(patient_id)
+
+    async def refresh(self, patient_id: str, wait_for_running: bool = False):
+        medications = self._medications.get(patient_id, [])
+        current = self._fingerprint(patient_id)
+        record = self.store.get(patient_id)
+        # Generators coalesce identical Gemini calls, so a caller that needs the result can run alongside
+        if (record and record["fingerprint"] == current) or (self._running.get(patient_id) == current and not wait_for_running):
+            self._stats["skipped"] += 1
+            return
+        self._running[patient_id] = current
+        try:
+            context = dict(self._contexts.get(patient_id, {}), medications=medications)
+            cards = await self.generate(patient_id, context) if medications else []
+        except Exception as e:
+            # Keep the previous cards; they stay stale, so the next cards() call schedules a retry
+            self._stats["failed"] += 1
+            print(f"Coaching refresh failed for {patient_id}: {e}")
+            return
+        finally:
+            if self._running.get(patient_id) == current:
+                del self._running[patient_id]
+        # A slower run for an older medication list must not overwrite a newer one
+        if record is None or current == self._fingerprint(patient_id):
+            self.store.put(patient_id, current, cards)
+        self._stats["generated"] += 1
+
+    def cards(self, patient_id: str, medications: Optional[List[Dict[str, Any]]] = None,
+              context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Stored cards for a patient, without waiting for Gemini. If medications are given and they (or
+        the context) differ from what the cards were made for, a refresh is scheduled and the old
+        cards returned as stale. "generated_at" is None when nothing has been generated yet.
+        """
+        record = self.store.get(patient_id)
+        stale = record is None
+        if medications is not None:
+            if context is None:
+                context = self._contexts.get(patient_id)
+            current = fingerprint(medications, context)
+            stale = record is None or record["fingerprint"] != current
+            if stale and patient_id not in self._pending and self._running.get(patient_id) != current:
+                self.schedule(patient_id, medications, context)
+        return {
+            "coaching_messages": record["cards"] if record else [],
+            "generated_at": record["generated_at"] if record else None,
+            "stale": stale,
+        }
+
+    async def fetch(self, patient_id: str, medications: List[Dict[str, Any]],
+                    context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Like cards(), but a patient with nothing stored yet waits for their first generation."""
+        result = self.cards(patient_id, medications, context)
+        if result["generated_at"] is None and medications:
+            task = self._pending.pop(patient_id, None)
+            if task is not None:
+                task.cancel()
+            self._record(patient_id, medications, context)
+            await self.refresh(patient_id, wait_for_running=True)
+            result = self.cards(patient_id, medications, context)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self._stats, pending=len(self._pending), running=len(self._running))
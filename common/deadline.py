@@ -0,0 +1,121 @@
+"""
+Request deadlines that travel across service hops.
+The remaining budget is sent as X-Request-Timeout-Ms (like grpc-timeout), so clocks on
+different hosts never have to agree. Work that outlives its deadline is abandoned.
+"""
+import asyncio
+import contextvars
+import os
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, Optional
+
+from starlette.responses import JSONResponse
+
+DEADLINE_HEADER = "X-Request-Timeout-Ms"
+DEFAULT_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "30"))
+
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+stats = {"deadline_misses": 0}
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message: str = "Request deadline exceeded"):
+        super().__init__(message)
+
+
+def set_timeout(seconds: float):
+    """Starts a deadline `seconds` from now; returns a token for reset()."""
+    return _deadline.set(time.monotonic() + seconds)
+
+
+def reset(token):
+    _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check():
+    left = remaining()
+    if left is not None and left <= 0:
+        stats["deadline_misses"] += 1
+        raise DeadlineExceeded()
+
+
+def without_deadline() -> contextvars.Context:
+    """A copy of the current context with no deadline, for work that outlives the request starting it."""
+    context = contextvars.copy_context()
+    context.run(_deadline.set, None)
+    return context
+
+
+def outgoing_headers(reserve: float = 0.0) -> Dict[str, str]:
+    """Header carrying what is left of the budget, minus time kept back for local work."""
+    left = remaining()
+    if left is None:
+        return {}
+    return {DEADLINE_HEADER: str(max(int((left - reserve) * 1000), 0))}
+
+
+async def bounded(awaitable: Awaitable[Any]) -> Any:
+    """Awaits within the current deadline, cancelling the work when it runs out."""
+    left = remaining()
+    if left is None:
+        return await awaitable
+    if left <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        stats["deadline_misses"] += 1
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        stats["deadline_misses"] += 1
+        raise DeadlineExceeded()
+
+
+class DeadlineMiddleware:
+    """Starts each request's deadline from the incoming header, or the default timeout."""
+
+    def __init__(self, app, default_timeout: float = DEFAULT_TIMEOUT):
+        self.app = app
+        self.default_timeout = default_timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timeout = self.default_timeout
+        header = DEADLINE_HEADER.lower().encode()
+        for name, value in scope["headers"]:
+            if name == header:
+                try:
+                    timeout = int(value) / 1000
+                except ValueError:
+                    pass
+                break
+
+        token = set_timeout(timeout)
+        started = False
+
+        async def send_wrapper(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except DeadlineExceeded as e:
+            if started:
+                raise
+            await JSONResponse({"detail": str(e)}, status_code=504)(scope, receive, send)
+        finally:
+            reset(token)
@@ -0,0 +1,351 @@
+"""
+Local HIPAA Safe Harbor de-identification.
+All identifier families are compiled into one alternation and found in a single regex pass;
+person names come from title/label cues plus a first/last-name gazetteer (possessives such as
+"Smith's" are looked up without the "'s"). Places smaller than a state are facility names after
+"at/in/from/to" plus a city gazetteer; city names that are also common words (Phoenix, Mobile,
+Reading) are left to the second pass. Adjacent name tokens are merged into one span, and every
+distinct identifier gets a stable surrogate such as
+[NAME_1], so the same person or date reads consistently through the note. Nothing leaves the
+process unless the optional Gemini second pass is switched on, and that pass only sees
+already-redacted sentences that still look suspicious.
+"""
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Sends residual (already redacted) sentences to Gemini for a second look; off by default
+LLM_SECOND_PASS = os.getenv("DEID_LLM_SECOND_PASS", "false").lower() in ("1", "true", "yes")
+# Optional extra gazetteer, one name per line
+NAMES_FILE = os.getenv("DEID_NAMES_FILE")
+
+FIRST_NAMES = """
+aaron abigail adam adrian aisha alan albert alex alexander alice alicia amanda amelia amit amy ana
+andrea andrew angela anita ann anna anthony arjun arthur ashley barbara benjamin beth betty brandon
+brenda brian carl carlos carol caroline catherine charles charlotte chen cheryl christina christine
+christopher cynthia daniel david deborah debra dennis diana diane donald donna dorothy douglas edward
+elena elizabeth emily emma eric eugene evelyn frances frank gary george gloria gregory hannah harold
+heather helen henry isabella jack jacob james janet janice jason jean jeffrey jennifer jeremy jerry
+jessica joan john jonathan jose joseph joshua joyce juan judith julia julie justin karen kathleen
+katherine keith kelly kenneth kevin kimberly larry laura lauren lawrence linda lisa lucas madison
+manoj margaret maria marie marilyn martha mary matthew megan melissa michael michelle mohammed
+nancy natalie nathan nicholas nicole noah olivia pamela patricia paul peter priya rachel rahul raj
+ralph ramesh raymond rebecca richard robert roger ronald rose roy russell ruth ryan samantha samuel
+sandra sara sarah scott sean sharon shirley sophia stephanie stephen steven sunita susan suresh
+teresa terry thomas timothy tyler victoria vikram vincent virginia walter wayne william zachary
+""".split()
+
+LAST_NAMES = """
+adams agarwal ahmed ali allen alvarez anderson bailey baker banerjee barnes bell bennett brooks
+butler campbell carter castillo chatterjee chavez clark collins cook cooper cox cruz das davis diaz
+edwards evans fisher flores foster garcia gomez gonzalez gray green gupta gutierrez hall harris
+hernandez hill howard hughes iyer jackson james jenkins johnson jones kelly khan kim king kumar lee
+lewis lopez martin martinez mehta miller mitchell moore morales morgan morris murphy myers nair
+nelson nguyen ortiz parker patel perez perry peterson phillips powell price ramirez reddy reed
+reyes richardson rivera roberts robinson rodriguez rogers ross russell sanchez sanders scott sharma
+shah singh smith stewart sullivan taylor thomas thompson torres turner walker ward watson williams
+wilson wood wright yadav young
+""".split()
+
+# Gazetteer names that are also everyday or clinical words; only redacted next to another name or a cue
+AMBIGUOUS_NAMES = {
+    "will", "mark", "bill", "hope", "may", "grace", "rose", "faith", "joy", "young", "brown", "white",
+    "green", "gray", "king", "long", "wood", "bell", "cook", "price", "reed", "ward", "james", "thomas",
+    "scott", "kelly", "russell", "morgan", "parker", "turner", "carter", "foster", "powell", "hall",
+}
+
+# Cities redacted wherever they appear; names that double as everyday words are left out on purpose
+CITIES = """
+Ahmedabad|Albuquerque|Atlanta|Austin|Baltimore|Bangalore|Bengaluru|Bhopal|Boston|Chandigarh|Charlotte|
+Chennai|Chicago|Cincinnati|Cleveland|Coimbatore|Columbus|Dallas|Delhi|Denver|Detroit|El Paso|Fort Worth|
+Fresno|Houston|Hyderabad|Indianapolis|Indore|Jacksonville|Jaipur|Kansas City|Kochi|Kolkata|Las Vegas|
+London|Los Angeles|Louisville|Lucknow|Madurai|Memphis|Miami|Milwaukee|Minneapolis|Mumbai|Mysore|Mysuru|
+Nagpur|Nashville|New Delhi|New Orleans|New York|Newark|Noida|Oakland|Oklahoma City|Omaha|Philadelphia|
+Pittsburgh|Portland|Pune|Raleigh|Sacramento|San Antonio|San Diego|San Francisco|San Jose|Seattle|
+St. Louis|Surat|Tampa|Thane|Toronto|Tucson|Vadodara|Visakhapatnam|Washington|Bronx|Brooklyn|Manhattan|
+Queens|Cambridge|Somerville|Gurgaon|Gurugram|Secunderabad|Navi Mumbai
+""".replace("\n", "").split("|")
+FACILITY_SUFFIX = (r"(?:Hospital|Clinic|Medical[ \t]+Cent(?:er|re)|Health[ \t]+Cent(?:er|re)|Infirmary|Hospice|"
+                   r"Nursing[ \t]+Home|Rehab(?:ilitation)?[ \t]+Cent(?:er|re)|Care[ \t]+Home)")
+# Checked only when a candidate token is one of these words, so facility names cost nothing elsewhere
+FACILITY_WORDS = {"hospital", "clinic", "center", "centre", "infirmary", "hospice", "home"}
+FACILITY_BEFORE = re.compile(r"(?i:\b(?:at|in|from|to)\s+(?:the\s+)?)(?P<name>(?:[A-Z][a-zA-Z'\-]*\.?[ \t]+){1,4}"
+                             + FACILITY_SUFFIX + r")$")
+
+MONTHS = (r"(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|jun(?:e)?|jul(?:y)?|aug(?:ust)?|"
+          r"sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)")
+STREET_SUFFIX = (r"(?:street|st|avenue|ave|road|rd|boulevard|blvd|lane|ln|drive|dr|court|ct|place|pl|"
+                 r"way|terrace|parkway|pkwy|highway|hwy|circle|cir|nagar|marg)")
+# Title-case words continue a name after a cue; all-caps acronyms (MRN, BP) do not
+# (O'Neil, O'Brien and Mc/Mac names included)
+NAME_TOKEN = r"[A-Z](?:[a-z]|'[A-Z])[a-zA-Z'\-]*"
+NAME_RUN = NAME_TOKEN + r"(?:[ \t]+" + NAME_TOKEN + r"){0,2}"
+
+# (category, possible first characters, pattern). Order matters: earlier families win where matches would
+# start at the same place. The first-character class lets the scanner skip a family without trying it.
+FAMILIES: List[Tuple[str, str, str]] = [
+    ("EMAIL", r"\w", r"[\w.+\-]+@[\w\-]+(?:\.[\w\-]+)+"),
+    ("URL", "hHwW", r"\b(?:https?://|www\.)[^\s<>\"]+"),
+    ("IP", r"\d", r"\b(?:\d{1,3}\.){3}\d{1,3}\b"),
+    ("SSN", r"\d", r"\b\d{3}-\d{2}-\d{4}\b"),
+    ("MRN", "mMpPcC", r"(?i:\b(?:mrn|medical\s+record(?:\s+(?:no|number))?|patient\s+id|chart\s+(?:no|number))\b[\s:#.]*)(?P<MRN_v>[A-Z0-9][A-Z0-9\-]{3,})"),
+    ("ACCOUNT", "aApPmMbBhHiI", r"(?i:\b(?:account|acct|policy|member\s+id|member|beneficiary|health\s+plan|insurance\s+id)\b(?:\s+(?:no|number|#))?[\s:#.]*)(?P<ACCOUNT_v>[A-Z0-9][A-Z0-9\-]{4,})"),
+    ("LICENSE", "lLdDnNcC", r"(?i:\b(?:license|licence|lic|dea|npi|certificate)\b(?:\s+(?:no|number|#))?[\s:#.]*)(?P<LICENSE_v>[A-Z0-9][A-Z0-9\-]{4,})"),
+    ("DEVICE", "sSdDiI", r"(?i:\b(?:serial|device\s+id|implant\s+id|s/n)\b(?:\s+(?:no|number|#))?[\s:#.]*)(?P<DEVICE_v>[A-Z0-9][A-Z0-9\-]{4,})"),
+    ("VEHICLE", "vVlLpP", r"(?i:\b(?:vin|licen[cs]e\s+plate|plate)\b[\s:#.]*)(?P<VEHICLE_v>[A-Z0-9][A-Z0-9\-]{4,})"),
+    ("FAX", "fF", r"(?i:\bfax\b[\s:#.]*)(?P<FAX_v>(?:\+?\d{1,3}[\s.\-]?)?\(?\d{3}\)?[\s.\-]?\d{3}[\s.\-]?\d{4})"),
+    ("PHONE", r"\d(+", r"(?<![\w/])(?:\+?\d{1,3}[\s.\-]?)?\(?\d{3}\)?[\s.\-]\d{3}[\s.\-]\d{4}\b|(?<![\w/])\+91[\s\-]?\d{5}[\s\-]?\d{5}\b"),
+    ("DATE", r"\dJFMASONDjfmasond", r"\b\d{4}-\d{1,2}-\d{1,2}\b|\b\d{1,2}[/.\-]\d{1,2}[/.\-]\d{2,4}\b|"
+             r"(?i:\b\d{1,2}(?:st|nd|rd|th)?\s+" + MONTHS + r"\.?,?\s+\d{4}\b)|"
+             r"(?i:\b" + MONTHS + r"\.?\s+\d{1,2}(?:st|nd|rd|th)?,?\s+\d{4}\b)|"
+             r"(?i:\b" + MONTHS + r"\.?\s+\d{1,2}(?:st|nd|rd|th)?\b)|"
+             r"(?i:\b" + MONTHS + r"\.?\s+\d{4}\b)"),
+    ("ADDRESS", r"\d", r"\b\d{1,6}\s+(?:[A-Z][a-zA-Z]+\s+){1,4}(?i:" + STREET_SUFFIX + r")\b\.?(?:,?\s+(?:apt|suite|unit|#)\s*\w+)?"
+                r"(?:,[ \t]*[A-Z][a-z]+(?:[ \t][A-Z][a-z]+)?)?(?:,[ \t]*[A-Z]{2})?(?:[ \t]+\d{5,6}(?:-\d{4})?)?"),
+    ("ZIP", r"zZpP\d", r"(?i:\b(?:zip|postal\s+code|pin\s*code)\b[\s:#.]*)(?P<ZIP_v>\d{5,6}(?:-\d{4})?)|"
+            r"(?<=[A-Z]{2}\s)(?P<ZIP_s>\d{5}(?:-\d{4})?)\b"),
+    # Safe Harbor: ages over 89 must be aggregated
+    ("AGE", r"\daA", r"(?i:\b(?P<AGE_v>(?:9\d|1[0-4]\d))(?=[\s\-]*(?:years?|yrs?|y/?o|year-old)\b))|"
+            r"(?i:\b(?:aged?|age:)\s*(?P<AGE_w>(?:9\d|1[0-4]\d))\b)"),
+    ("NAME", "A-Za-z", r"(?:\b(?:Dr|Mr|Mrs|Ms|Miss|Mx|Prof|Sri|Smt)\.?\s+)(?P<NAME_t>" + NAME_RUN + ")|"
+             r"(?i:\b(?:patient(?:\s+name)?|name|pt|seen\s+by|referred\s+by|signed\s+by|attending|nok|next\s+of\s+kin)\s*:\s*)"
+             "(?P<NAME_l>" + NAME_RUN + ")"),
+    ("NAME_CANDIDATE", "A-Z", r"[A-Z][a-zA-Z'\-]+"),
+]
+
+# Sub-groups that hold the identifier itself when the match includes a cue word
+VALUE_GROUPS = {
+    "MRN": ("MRN_v",), "ACCOUNT": ("ACCOUNT_v",), "LICENSE": ("LICENSE_v",), "DEVICE": ("DEVICE_v",),
+    "VEHICLE": ("VEHICLE_v",), "FAX": ("FAX_v",), "ZIP": ("ZIP_v", "ZIP_s"), "AGE": ("AGE_v", "AGE_w"),
+    "NAME": ("NAME_t", "NAME_l"),
+}
+# "Smith's" -> "Smith"
+POSSESSIVE = ("'s", "\u2019s")
+
+
+@dataclass
+class PHISpan:
+    start: int
+    end: int
+    category: str
+    text: str
+    surrogate: str = ""
+
+
+@dataclass
+class DeidResult:
+    text: str
+    spans: List[PHISpan] = field(default_factory=list)
+
+    def counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for span in self.spans:
+            counts[span.category] = counts.get(span.category, 0) + 1
+        return counts
+
+
+def _normalize(value: str) -> str:
+    return re.sub(r"[\W_]+", "", value).lower()
+
+
+class SurrogateMap:
+    """Same identifier -> same placeholder, within one note (or across notes if the map is reused)."""
+
+    def __init__(self):
+        self._by_key: Dict[Tuple[str, str], str] = {}
+        self._counters: Dict[str, int] = {}
+
+    def get(self, category: str, value: str) -> str:
+        key = (category, _normalize(value))
+        surrogate = self._by_key.get(key)
+        if surrogate is None:
+            if category == "NAME" and " " not in value.strip():
+                # A later bare surname or first name maps to the full name seen earlier
+                surrogate = next((self._by_key[("NAME", t)] for t in map(_normalize, value.split())
+                                  if ("NAME", t) in self._by_key), None)
+            if category == "AGE":
+                surrogate = "90+"
+            if surrogate is None:
+                self._counters[category] = self._counters.get(category, 0) + 1
+                surrogate = f"[{category}_{self._counters[category]}]"
+            self._by_key[key] = surrogate
+        if category == "NAME":
+            for token in value.split():
+                self._by_key.setdefault(("NAME", _normalize(token)), surrogate)
+        return surrogate
+
+
+class Deidentifier:
+    def __init__(self, first_names: Iterable[str] = FIRST_NAMES, last_names: Iterable[str] = LAST_NAMES,
+                 extra_names: Optional[Iterable[str]] = None, cities: Iterable[str] = CITIES):
+        self.names: Set[str] = {n.lower() for n in first_names} | {n.lower() for n in last_names}
+        if extra_names:
+            self.names |= {n.strip().lower() for n in extra_names if n.strip()}
+        # First word of a city -> what must follow it ("new" -> " York", " Delhi", ...), longest first
+        self.cities: Dict[str, List[re.Pattern]] = {}
+        for city in sorted(cities, key=len, reverse=True):
+            first = re.match(r"[A-Za-z]+", city).group()
+            rest = re.escape(city[len(first):]).replace(r"\ ", r"[ \t]+")
+            self.cities.setdefault(first.lower(), []).append(re.compile(rest + r"\b"))
+        self.places = set(self.cities) | FACILITY_WORDS
+        # Identifiers never start inside a word, which rules out most positions before any family is tried
+        self.pattern = re.compile(r"(?<![\w@.\-])(?:" + "|".join(
+            f"(?=[{first}])(?P<{category}>{regex})" for category, first, regex in FAMILIES) + ")")
+
+    def find(self, text: str) -> List[PHISpan]:
+        spans: List[PHISpan] = []
+        covered = 0
+        for match in self.pattern.finditer(text):
+            category = match.lastgroup
+            if category == "NAME_CANDIDATE":
+                start = match.start()
+                if start < covered:
+                    continue
+                token = match.group()
+                if token.endswith(POSSESSIVE):
+                    token = token[:-2]
+                lower = token.lower()
+                if lower in self.places:
+                    place = self._place(text, start, start + len(token), lower, spans)
+                    if place is not None:
+                        spans.append(place)
+                        covered = place.end
+                        continue
+                if lower in self.names:
+                    spans.append(PHISpan(start, start + len(token), "NAME_CANDIDATE", token))
+                continue
+            if match.start() < covered:
+                continue
+            start, end = match.span()
+            for group in VALUE_GROUPS.get(category, ()):
+                if match.group(group) is not None:
+                    start, end = match.span(group)
+                    break
+            if category == "NAME" and text.endswith(POSSESSIVE, start, end):
+                end -= 2
+            spans.append(PHISpan(start, end, category, text[start:end]))
+        return self._merge_names(text, spans)
+
+    def _place(self, text: str, start: int, end: int, lower: str, spans: List[PHISpan]) -> Optional[PHISpan]:
+        """A city starting at the token, or a facility name ending with it (earlier spans inside it are dropped)."""
+        for rest in self.cities.get(lower, ()):
+            found = rest.match(text, end)
+            if found:
+                return PHISpan(start, found.end(), "LOCATION", text[start:found.end()])
+        if lower in FACILITY_WORDS:
+            window = max(0, start - 120)
+            found = FACILITY_BEFORE.search(text, window, end)
+            if found:
+                begin = found.start("name")
+                while spans and spans[-1].start >= begin:
+                    spans.pop()
+                return PHISpan(begin, end, "LOCATION", text[begin:end])
+        return None
+
+    def _merge_names(self, text: str, spans: List[PHISpan]) -> List[PHISpan]:
+        """Joins runs of name tokens separated only by spaces; lone ambiguous tokens are dropped."""
+        merged: List[PHISpan] = []
+        for span in spans:
+            previous = merged[-1] if merged else None
+            if (previous is not None and span.category in ("NAME", "NAME_CANDIDATE")
+                    and previous.category in ("NAME", "NAME_CANDIDATE")
+                    and text[previous.end:span.start].strip(" ") == ""):
+                previous.end = span.end
+                previous.text = text[previous.start:previous.end]
+                previous.category = "NAME"
+                continue
+            merged.append(span)
+
+        result = []
+        for span in merged:
+            if span.category == "NAME_CANDIDATE":
+                if span.text.lower() in AMBIGUOUS_NAMES:
+                    continue
+                span.category = "NAME"
+            result.append(span)
+        return result
+
+    def deidentify(self, text: str, surrogates: Optional[SurrogateMap] = None) -> DeidResult:
+        surrogates = surrogates or SurrogateMap()
+        spans = self.find(text)
+        out = []
+        cursor = 0
+        for span in spans:
+            span.surrogate = surrogates.get(span.category, span.text)
+            out.append(text[cursor:span.start])
+            out.append(span.surrogate)
+            cursor = span.end
+        out.append(text[cursor:])
+        return DeidResult("".join(out), spans)
+
+
+def _load_default() -> Deidentifier:
+    extra = None
+    if NAMES_FILE and os.path.exists(NAMES_FILE):
+        with open(NAMES_FILE) as f:
+            extra = f.read().splitlines()
+    return Deidentifier(extra_names=extra)
+
+
+engine = _load_default()
+
+
+def deidentify(text: str) -> DeidResult:
+    return engine.deidentify(text)
+
+
+# --- Optional Gemini second pass ----------------------------------------------
+
+SENTENCE = re.compile(r"[^.!?\n]+[.!?]?")
+PLACEHOLDER = re.compile(r"\[[A-Z]+_\d+\]")
+# Capitalised words that are expected in clinical prose and say nothing about identity
+COMMON_CAPITALISED = {
+    "patient", "pt", "history", "plan", "assessment", "medications", "allergies", "diagnosis", "hpi",
+    "exam", "labs", "impression", "follow", "continue", "start", "stop", "discharge", "admitted", "no",
+    "the", "he", "she", "they", "his", "her", "bp", "hr", "rr", "spo2", "temp", "a", "an", "on", "in",
+    "blood", "pressure", "type", "diabetes", "hypertension", "denies", "reports", "review",
+}
+
+
+def residual_sentences(redacted: str, limit: int = 40) -> List[str]:
+    """Redacted sentences that still contain unexplained capitalised words or long digit runs."""
+    suspicious = []
+    for match in SENTENCE.finditer(redacted):
+        sentence = PLACEHOLDER.sub("", match.group()).strip()
+        if not sentence:
+            continue
+        words = re.findall(r"\b[A-Z][a-zA-Z'\-]+\b", sentence)
+        if any(w.lower() not in COMMON_CAPITALISED for w in words[1:]) or re.search(r"\d{5,}", sentence):
+            suspicious.append(match.group().strip())
+        if len(suspicious) >= limit:
+            break
+    return suspicious
+
+
+async def llm_second_pass(result: DeidResult, model) -> DeidResult:
+    """
+    Asks Gemini which strings in the residual sentences are still identifiers and redacts
+    them locally. Only text that has already been through the local pass is sent.
+    """
+    from common import llm
+
+    sentences = residual_sentences(result.text)
+    if not sentences:
+        return result
+    prompt = (
+        "These sentences come from a clinical note that has already been de-identified; placeholders like "
+        "[NAME_1] are redacted values. List any remaining HIPAA Safe Harbor identifiers (names, places, "
+        "dates, numbers that identify a person) exactly as they appear.\n"
+        'Return ONLY JSON: {"identifiers": ["..."]}\n\n' + "\n".join(sentences)
+    )
+    response = await llm.generate(model, prompt, llm.Priority.STANDARD, kind="de_identify")
+    found = [s for s in llm.parse_json_response(response.text).get("identifiers", []) if isinstance(s, str) and s.strip()]
+    text = result.text
+    spans = list(result.spans)
+    for i, value in enumerate(sorted(set(found), key=len, reverse=True), start=1):
+        if value in text and not PLACEHOLDER.fullmatch(value):
+            surrogate = f"[OTHER_{i}]"
+            text = text.replace(value, surrogate)
+            spans.append(PHISpan(-1, -1, "OTHER", value, surrogate))
+    return DeidResult(text, spans)
@@ -0,0 +1,266 @@
+"""
+Medication-name normalization.
+Free-text names ("Tab Glycomet 500mg", "metfromin", "Metformin HCl ER") are resolved to a
+canonical ingredient RxCUI using the bundled drug vocabulary (ingredients plus brand and
+international names). Exact names are a dict lookup; anything else goes through a trigram
+index whose candidates are confirmed by edit distance. Look-alike drugs are one or two letters
+apart, so a fuzzy hit needs a long name, a single edit, and no other ingredient nearby.
+Combinations ("Amlodipine/Atorvastatin") are resolved per ingredient and never to just one of
+them. Results are memoised per input string.
+"""
+import heapq
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from common import terminology
+
+# Extra vocabulary in the terminology seed format (RxCUI<TAB>ingredient<TAB>synonyms)
+VOCABULARY_FILE = os.getenv("DRUG_VOCABULARY_FILE")
+# Fuzzy matching only corrects one typo, in names at least this long; shorter names must match exactly
+FUZZY_MIN_LENGTH = 8
+FUZZY_MAX_EDITS = 1
+# A fuzzy hit is refused if a different ingredient is within this many edits of the input as well
+AMBIGUITY_EDITS = 2
+# Separators between the ingredients of a combination product
+COMBINATION = re.compile(r"\s*[/+]\s*")
+
+# Dose forms, routes and sig abbreviations that often trail a drug name
+NOISE_WORDS = {
+    "tab", "tabs", "tablet", "tablets", "cap", "caps", "capsule", "capsules", "inj", "injection", "syp", "syrup",
+    "susp", "suspension", "sol", "solution", "cream", "ointment", "gel", "drops", "inhaler", "spray", "patch",
+    "oral", "po", "iv", "im", "sc", "sl", "er", "xr", "sr", "cr", "xl", "la", "dr", "ec", "od", "bd", "bid", "tid",
+    "qid", "qd", "hs", "prn", "stat", "daily", "once", "twice", "mg", "mcg", "g", "ml", "units", "iu", "rx",
+}
+# Salt and ester names that do not change the ingredient
+SALT_WORDS = {
+    "hydrochloride", "hcl", "sodium", "potassium", "calcium", "magnesium", "besylate", "maleate", "succinate",
+    "tartrate", "mesylate", "fumarate", "sulfate", "sulphate", "acetate", "citrate", "bromide", "dihydrate",
+    "monohydrate", "trihydrate", "phosphate",
+}
+
+
+class DrugMatch(NamedTuple):
+    rxcui: str
+    ingredient: str
+    matched: str
+    score: float
+    method: str
+
+
+def clean(name: str) -> List[str]:
+    """Lower-cased name tokens with strengths, dose forms and sig abbreviations removed."""
+    tokens = re.findall(r"[a-z0-9]+", (name or "").lower())
+    return [t for t in tokens if t not in NOISE_WORDS and not any(c.isdigit() for c in t)]
+
+
+def trigrams(term: str) -> List[str]:
+    padded = f"  {term} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Optimal string alignment distance (adjacent transpositions count once), giving up above limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        ca = a[i - 1]
+        current = [i]
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cb = b[j - 1]
+            value = previous[j - 1] + (ca != cb)
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb and previous2[j - 2] + 1 < value:
+                value = previous2[j - 2] + 1
+            current.append(value)
+            if value < row_min:
+                row_min = value
+        if row_min > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class DrugNameIndex:
+    def __init__(self, rows: Iterable[Tuple[str, str, List[str]]]):
+        # term -> (rxcui, ingredient)
+        self.terms: Dict[str, Tuple[str, str]] = {}
+        for rxcui, ingredient, synonyms in rows:
+            for term in [ingredient] + synonyms:
+                key = " ".join(clean(term))
+                if key:
+                    self.terms.setdefault(key, (rxcui, ingredient))
+        self._term_list = list(self.terms)
+        self._gram_counts: List[int] = []
+        self._postings: Dict[str, List[int]] = {}
+        for i, term in enumerate(self._term_list):
+            grams = set(trigrams(term))
+            self._gram_counts.append(len(grams))
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(i)
+
+    def _fuzzy(self, text: str) -> Optional[Tuple[str, float]]:
+        """The one term a typo of text is for, or None if none or several ingredients are close."""
+        if len(text) < FUZZY_MIN_LENGTH - FUZZY_MAX_EDITS:
+            return None
+        grams = set(trigrams(text))
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for i in self._postings.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        if not shared:
+            return None
+        # Dice coefficient picks a handful of candidates; edit distance decides
+        ranked = heapq.nlargest(10, shared, key=lambda i: shared[i] / (len(grams) + self._gram_counts[i]))
+        best, best_distance = None, AMBIGUITY_EDITS + 1
+        near = set()
+        for i in ranked:
+            if 2 * shared[i] / (len(grams) + self._gram_counts[i]) < 0.3:
+                break
+            term = self._term_list[i]
+            distance = edit_distance(text, term, AMBIGUITY_EDITS)
+            if distance > AMBIGUITY_EDITS:
+                continue
+            near.add(self.terms[term][0])
+            if distance < best_distance:
+                best, best_distance = term, distance
+        if best is None or best_distance > FUZZY_MAX_EDITS or len(best) < FUZZY_MIN_LENGTH or len(near) > 1:
+            return None
+        return best, 1 - best_distance / max(len(best), len(text))
+
+    def word_matches(self, name: str) -> List[DrugMatch]:
+        """Exact matches of the single words of a name, one per ingredient, in name order."""
+        found: Dict[str, DrugMatch] = {}
+        for word in clean(name):
+            if word in self.terms and word not in SALT_WORDS:
+                rxcui, ingredient = self.terms[word]
+                found.setdefault(rxcui, DrugMatch(rxcui, ingredient, word, 1.0, "exact"))
+        return list(found.values())
+
+    def resolve(self, name: str, fuzzy: bool = True) -> Optional[DrugMatch]:
+        """The one ingredient a name stands for; None if unknown or if it names several (a combination)."""
+        if len(combination_parts(name)) > 1:
+            return None
+        tokens = clean(name)
+        if not tokens:
+            return None
+        without_salts = [t for t in tokens if t not in SALT_WORDS] or tokens
+        phrases = [" ".join(tokens), " ".join(without_salts)]
+        for phrase in phrases:
+            if phrase in self.terms:
+                rxcui, ingredient = self.terms[phrase]
+                return DrugMatch(rxcui, ingredient, phrase, 1.0, "exact")
+        # Single words next ("Tab Glycomet GP" -> "glycomet"), unless they name different ingredients
+        words = self.word_matches(name)
+        if len(words) > 1:
+            return None
+        if words:
+            return words[0]
+        if not fuzzy:
+            return None
+        best = None
+        for phrase in list(dict.fromkeys(phrases + sorted(set(without_salts), key=len, reverse=True))):
+            found = self._fuzzy(phrase)
+            if found and (best is None or found[1] > best[1]):
+                best = found
+        if best is None:
+            return None
+        rxcui, ingredient = self.terms[best[0]]
+        return DrugMatch(rxcui, ingredient, best[0], round(best[1], 3), "fuzzy")
+
+    def ingredients(self, name: str, fuzzy: bool = True) -> List[DrugMatch]:
+        """Every ingredient a name resolves to: one per part of a combination, in name order."""
+        found: Dict[str, DrugMatch] = {}
+        for part in combination_parts(name):
+            match = self.resolve(part, fuzzy)
+            for m in [match] if match else self.word_matches(part):
+                found.setdefault(m.rxcui, m)
+        return list(found.values())
+
+
+def combination_parts(name: str) -> List[str]:
+    """The ingredient names of a combination ("Amlodipine/Atorvastatin 5/10mg"); [name] otherwise."""
+    parts = [p for p in COMBINATION.split(name or "") if clean(p)]
+    return parts if len(parts) > 1 else [name]
+
+
+def _load() -> DrugNameIndex:
+    rows = list(terminology.read_seed(os.path.join(terminology.DATA_DIR, terminology.SEED_FILES["rxnorm"])))
+    if VOCABULARY_FILE and os.path.exists(VOCABULARY_FILE):
+        rows += list(terminology.read_seed(VOCABULARY_FILE))
+    return DrugNameIndex(rows)
+
+
+_index: Optional[DrugNameIndex] = None
+
+
+def index() -> DrugNameIndex:
+    global _index
+    if _index is None:
+        _index = _load()
+    return _index
+
+
+@lru_cache(maxsize=8192)
+def resolve(name: str, fuzzy: bool = True) -> Optional[DrugMatch]:
+    """The single ingredient of a name. Pass fuzzy=False where only exact names may match."""
+    return index().resolve(name, fuzzy)
+
+
+@lru_cache(maxsize=8192)
+def ingredients(name: str) -> Tuple[DrugMatch, ...]:
+    return tuple(index().ingredients(name))
+
+
+def resolve_many(names: Iterable[str]) -> List[Optional[DrugMatch]]:
+    return [resolve(name) for name in names]
+
+
+def canonical_key(name: str) -> str:
+    """
+    Cache/lookup key for a medication: its ingredient RxCUI when known, else the cleaned name.
+    Combinations join the keys of all their parts, so they never collide with one ingredient.
+    """
+    parts = combination_parts(name)
+    if len(parts) > 1:
+        return "+".join(sorted(canonical_key(part) for part in parts))
+    match = resolve(name)
+    return f"rxcui:{match.rxcui}" if match else " ".join(clean(name)) or (name or "").strip().lower()
+
+
+def normalize_many(names: Iterable[str]) -> List[Dict]:
+    """
+    Batch form for the API: one result per input name, rxcui None when nothing (or a combination)
+    matched. "ingredients" lists every resolved ingredient, including each part of a combination.
+    """
+    names = list(names)
+    results = []
+    for name, match in zip(names, resolve_many(names)):
+        entry: Dict = {"input": name, "rxcui": None, "ingredient": None, "matched": None, "score": 0.0, "method": None}
+        if match:
+            entry.update(match._asdict())
+        entry["ingredients"] = [{"rxcui": m.rxcui, "ingredient": m.ingredient} for m in ingredients(name)]
+        results.append(entry)
+    return results
+
+
+def annotate(medication: Dict, field: str = "name") -> Dict:
+    """
+    Adds rxnorm_code/ingredient to a medication dict whose name resolves (in place, also returned).
+    A combination gets an "ingredients" list instead, since no single ingredient code applies.
+    """
+    name = str(medication.get(field) or "")
+    match = resolve(name)
+    if match:
+        medication.setdefault("rxnorm_code", match.rxcui)
+        medication.setdefault("ingredient", match.ingredient)
+    elif len(combination_parts(name)) > 1 and ingredients(name):
+        medication.setdefault("ingredients", [{"rxcui": m.rxcui, "ingredient": m.ingredient} for m in ingredients(name)])
+    return medication
@@ -0,0 +1,181 @@
+"""
+Prescription image preprocessing.
+Phone photos are normalised (orientation, grayscale, crop, downscale) and re-encoded in a worker
+pool before they go to the vision model, and fingerprinted with a perceptual hash so that
+re-scans of the same prescription can be answered from cache.
+"""
+import asyncio
+import io
+import os
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+from common import metrics
+
+try:
+    from PIL import Image, ImageChops, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+    print("Warning: Pillow not installed. Prescription images are sent unprocessed.")
+
+# Gemini tiles images at 768px; 1600px on the long edge keeps small print legible
+MAX_EDGE = int(os.getenv("SCAN_MAX_EDGE", "1600"))
+JPEG_QUALITY = int(os.getenv("SCAN_JPEG_QUALITY", "80"))
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime_type: str
+    phash: Optional[int]
+    original_size: int
+    signature: Optional[bytes] = None
+
+
+def dhash(image, hash_size: int = 8) -> int:
+    """64-bit difference hash: robust to rescaling, recompression and small exposure changes."""
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+SIGNATURE_SIZE = 512
+SIGNATURE_BLOCK = 4
+
+
+def thumbnail_signature(image) -> bytes:
+    """Mid-resolution grayscale copy (zlib-compressed) used to confirm a hash match before reusing a result."""
+    thumb = image.convert("L").resize((SIGNATURE_SIZE, SIGNATURE_SIZE), Image.BILINEAR)
+    return zlib.compress(thumb.tobytes(), 1)
+
+
+def signature_distance(a: bytes, b: bytes) -> int:
+    """
+    Worst mean absolute difference over small blocks. A single changed dose digit is a local
+    difference, so a whole-image average would hide it.
+    """
+    size = (SIGNATURE_SIZE, SIGNATURE_SIZE)
+    x = Image.frombytes("L", size, zlib.decompress(a))
+    y = Image.frombytes("L", size, zlib.decompress(b))
+    blocks = SIGNATURE_SIZE // SIGNATURE_BLOCK
+    return ImageChops.difference(x, y).resize((blocks, blocks), Image.BOX).getextrema()[1]
+
+
+def _content_bbox(gray, margin: float = 0.03):
+    """Bounding box of the ink on the page, found on a small thumbnail to keep it cheap."""
+    probe = gray.copy()
+    probe.thumbnail((256, 256))
+    probe = ImageOps.autocontrast(probe, cutoff=2)
+    ink = probe.point(lambda p: 255 if p < 96 else 0)
+    bbox = ink.getbbox()
+    if not bbox:
+        return None
+    sx, sy = gray.width / probe.width, gray.height / probe.height
+    pad_x, pad_y = gray.width * margin, gray.height * margin
+    left = max(int(bbox[0] * sx - pad_x), 0)
+    top = max(int(bbox[1] * sy - pad_y), 0)
+    right = min(int(bbox[2] * sx + pad_x), gray.width)
+    bottom = min(int(bbox[3] * sy + pad_y), gray.height)
+    # Don't trust tiny boxes; that is usually a stray shadow rather than the prescription
+    if (right - left) * (bottom - top) < 0.2 * gray.width * gray.height:
+        return None
+    return left, top, right, bottom
+
+
+def preprocess_image(data: bytes, max_edge: int = MAX_EDGE, quality: int = JPEG_QUALITY) -> PreparedImage:
+    """Runs in a worker process. Falls back to the original bytes if the image can't be decoded."""
+    if not PIL_AVAILABLE:
+        return PreparedImage(data, "application/octet-stream", None, len(data))
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Let the JPEG decoder downscale by a power of two while decoding; far cheaper than resizing later
+        image.draft("L", (max_edge * 2, max_edge * 2))
+        image = ImageOps.exif_transpose(image)
+        gray = image.convert("L")
+        bbox = _content_bbox(gray)
+        if bbox:
+            gray = gray.crop(bbox)
+        gray.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        gray = ImageOps.autocontrast(gray, cutoff=1)
+
+        out = io.BytesIO()
+        gray.save(out, "JPEG", quality=quality, optimize=True)
+        return PreparedImage(out.getvalue(), "image/jpeg", dhash(gray), len(data), thumbnail_signature(gray))
+    except Exception as e:
+        print(f"Image preprocessing failed, sending original: {e}")
+        return PreparedImage(data, "application/octet-stream", None, len(data))
+
+
+_pool: Optional[Executor] = None
+
+
+def _get_pool() -> Executor:
+    global _pool
+    if _pool is None:
+        try:
+            _pool = ProcessPoolExecutor(max_workers=SCAN_WORKERS)
+        except (OSError, NotImplementedError):
+            # Serverless runtimes (no /dev/shm) can't create process pools
+            _pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+    return _pool
+
+
+async def prepare_image(data: bytes, mime_type: Optional[str] = None) -> PreparedImage:
+    loop = asyncio.get_running_loop()
+    prepared = await loop.run_in_executor(_get_pool(), preprocess_image, data)
+    if prepared.phash is None and mime_type:
+        prepared.mime_type = mime_type
+    return prepared
+
+
+class PerceptualCache:
+    """
+    Bounded LRU of results keyed by perceptual hash. A stored hash within max_distance bits
+    is only a candidate; the thumbnail signatures must also agree, because prescriptions
+    printed on the same clinic template hash alike while naming different drugs.
+    """
+
+    def __init__(self, max_entries: int = 512, max_distance: int = 6, max_signature_distance: int = 10, name: str = "perceptual"):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.max_signature_distance = max_signature_distance
+        self._entries: "OrderedDict[int, Tuple[bytes, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, phash: int, signature: bytes) -> Optional[Any]:
+        candidates = sorted(
+            (distance, key) for key in self._entries
+            for distance in (hamming(key, phash),) if distance <= self.max_distance
+        )
+        for _, key in candidates:
+            stored_signature, value = self._entries[key]
+            if signature_distance(stored_signature, signature) <= self.max_signature_distance:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.CACHE_REQUESTS.inc(self.name, "hit")
+                return value
+        self.misses += 1
+        metrics.CACHE_REQUESTS.inc(self.name, "miss")
+        return None
+
+    def put(self, phash: int, signature: bytes, value: Any):
+        self._entries[phash] = (signature, value)
+        self._entries.move_to_end(phash)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,192 @@
+"""
+Helpers shared by every Gemini call site in the API and the AI service.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from common import deadline, drugnames, metrics, tracing
+from common.scheduler import Priority, is_quota_error, scheduler_from_env
+from common.singleflight import SingleFlight
+
+coalescer = SingleFlight()
+scheduler = scheduler_from_env()
+
+metrics.Gauge(
+    "medx_gemini_queue_depth", "Gemini requests waiting for quota by priority", ("priority",),
+    collect=lambda: {(name,): depth for name, depth in scheduler.stats()["queue_depth"].items()})
+metrics.Gauge(
+    "medx_gemini_rate_per_minute", "Current paced Gemini request rate",
+    collect=lambda: {(): scheduler.rate * 60})
+
+# Alternative Gemini REST endpoint, e.g. the local stand-in in benchmarks/fake_gemini.py
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+
+# Hedging sends a second copy of a slow call after the p95 delay; off by default since it costs quota
+HEDGE_ENABLED = os.getenv("GEMINI_HEDGE", "false").lower() in ("1", "true", "yes")
+HEDGE_MIN_SAMPLES = 20
+hedge_stats = {"hedges_sent": 0, "hedge_wins": 0}
+
+
+def configure_gemini(genai, api_key: str):
+    if GEMINI_API_ENDPOINT:
+        genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+    else:
+        genai.configure(api_key=api_key)
+
+
+def strip_json_fences(text: str) -> str:
+    """Removes the markdown code fences Gemini likes to wrap JSON in."""
+    if "```json" in text:
+        text = text.split("```json")[1].split("```")[0]
+    elif "```" in text:
+        text = text.split("```")[1].split("```")[0]
+    return text.strip()
+
+
+def parse_json_response(text: str) -> Any:
+    with tracing.span("json.parse", response_chars=len(text)):
+        return json.loads(strip_json_fences(text))
+
+
+def normalize_text(text: str) -> str:
+    """Whitespace-insensitive form of free text, so re-submitted notes coalesce."""
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def normalize_medications(medications) -> list:
+    """Canonical medication keys (ingredient RxCUI when resolvable), so brand/generic/typo variants share a key."""
+    return sorted({drugnames.canonical_key(normalize_text(m)) for m in medications if m and m.strip()})
+
+
+def request_key(kind: str, payload: Any) -> str:
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return kind + ":" + hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+async def coalesced(kind: str, payload: Any, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Shares one Gemini call between concurrent requests with the same normalized payload.
+    The result object is shared too, so callers must copy before mutating it.
+    """
+    # Each waiter is bounded by its own deadline; the shared call keeps running for the others
+    return await deadline.bounded(coalescer.do(request_key(kind, payload), fn, kind))
+
+
+class LatencyTracker:
+    """Sliding window of successful call latencies per request kind."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, kind: str, seconds: float):
+        self._samples.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, kind: str, q: float) -> Optional[float]:
+        samples = self._samples.get(kind)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+latencies = LatencyTracker()
+
+
+async def _timed(call: Callable[[], Awaitable[Any]], kind: str) -> Any:
+    with tracing.span(f"gemini.{kind}", tracing.CLIENT, **{"llm.kind": kind}) as call_span:
+        result = await _measured(call, kind)
+        usage = getattr(result, "usage_metadata", None)
+        if usage is not None:
+            call_span.set_attribute("llm.prompt_tokens", getattr(usage, "prompt_token_count", 0) or 0)
+            call_span.set_attribute("llm.output_tokens", getattr(usage, "candidates_token_count", 0) or 0)
+        return result
+
+
+async def _measured(call: Callable[[], Awaitable[Any]], kind: str) -> Any:
+    started = time.monotonic()
+    try:
+        result = await call()
+    except asyncio.CancelledError:
+        metrics.GEMINI_REQUEST_SECONDS.observe(time.monotonic() - started, kind, "cancelled")
+        raise
+    except Exception as e:
+        outcome = "throttled" if is_quota_error(e) else "error"
+        metrics.GEMINI_REQUEST_SECONDS.observe(time.monotonic() - started, kind, outcome)
+        raise
+    elapsed = time.monotonic() - started
+    latencies.record(kind, elapsed)
+    metrics.GEMINI_REQUEST_SECONDS.observe(elapsed, kind, "ok")
+    metrics.record_gemini_usage(kind, result)
+    return result
+
+
+async def _hedged(call: Callable[[], Awaitable[Any]], kind: str, priority: Priority) -> Any:
+    """
+    Starts the call, and if it has not answered by the recent p95 latency, sends one more
+    copy, but only when the scheduler has a spare token right now. First answer wins.
+    """
+    primary = asyncio.ensure_future(_timed(call, kind))
+    delay = latencies.percentile(kind, 0.95) if HEDGE_ENABLED else None
+    if delay is None:
+        return await primary
+
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return primary.result()
+        left = deadline.remaining()
+        if (left is not None and left < delay) or not scheduler.try_acquire(priority):
+            return await primary
+
+        hedge_stats["hedges_sent"] += 1
+        hedge = asyncio.ensure_future(_timed(call, kind))
+        tasks.add(hedge)
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None or not tasks:
+                    if task is hedge and task.exception() is None:
+                        hedge_stats["hedge_wins"] += 1
+                    return task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call(fn: Callable[[], Awaitable[Any]], priority: Priority = Priority.STANDARD, kind: str = "default") -> Any:
+    """
+    Runs a Gemini request paced and retried by the quota scheduler, bounded by the request
+    deadline and optionally hedged. fn must start an independent request each time it is called.
+    """
+    deadline.check()
+    return await deadline.bounded(scheduler.run(lambda: _hedged(fn, kind, priority), priority))
+
+
+async def generate(model, contents, priority: Priority = Priority.STANDARD, kind: str = "default", **kwargs) -> Any:
+    if GEMINI_API_ENDPOINT:
+        # The REST transport has no async client, so run the blocking call in a thread
+        return await call(lambda: asyncio.to_thread(model.generate_content, contents, **kwargs), priority, kind)
+    return await call(lambda: model.generate_content_async(contents, **kwargs), priority, kind)
+
+
+def send_message(chat, message) -> Awaitable[Any]:
+    if GEMINI_API_ENDPOINT:
+        return asyncio.to_thread(chat.send_message, message)
+    return chat.send_message_async(message)
+
+
+def stats() -> dict:
+    return {
+        "coalescing": coalescer.stats(),
+        "scheduler": scheduler.stats(),
+        "hedging": dict(hedge_stats, enabled=HEDGE_ENABLED),
+        "deadline_misses": deadline.stats["deadline_misses"],
+    }
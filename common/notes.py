@@ -0,0 +1,610 @@
+"""
+Section-aware chunking of long clinical notes.
+A note is split on its section headers (HPI, Medications, Assessment/Plan, ...), small sections
+are packed together and oversized ones split on paragraph/sentence boundaries so that every
+chunk fits a token budget. Chunks are analyzed concurrently and each is retried on its own;
+the per-chunk results are merged back into a single analysis with duplicate entities folded,
+then the merged medications are checked for interactions and one summary is written for the
+whole note. In incremental mode (off by default), results are cached per section by content, so
+re-analyzing an edited note only sends the sections that changed.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from common import deadline, metrics, scheduler, terminology
+
+# Notes longer than this (estimated tokens) are analyzed in chunks
+CHUNK_TOKENS = int(os.getenv("NOTE_CHUNK_TOKENS", "2000"))
+CHUNK_RETRIES = int(os.getenv("NOTE_CHUNK_RETRIES", "2"))
+# Incremental mode: notes at least this long are analyzed per section, reusing unchanged sections.
+# Off by default: a first analysis sends more prompts (and tokens) than the whole-note path
+INCREMENTAL_ENABLED = os.getenv("NOTE_INCREMENTAL", "false").lower() == "true"
+INCREMENTAL_MIN_TOKENS = int(os.getenv("NOTE_INCREMENTAL_MIN_TOKENS", "500"))
+# Consecutive sections are analyzed together until they reach this size. Every unit repeats the
+# instructions, so smaller units make edits cheaper and first analyses dearer
+SECTION_MIN_TOKENS = int(os.getenv("NOTE_SECTION_MIN_TOKENS", "300"))
+SECTION_CACHE_SIZE = int(os.getenv("NOTE_SECTION_CACHE_SIZE", "4096"))
+
+SECTION_NAMES = {
+    "Chief Complaint": r"chief\s+complaint|cc|reason\s+for\s+(?:visit|admission|consultation)",
+    "HPI": r"hpi|history\s+of\s+(?:the\s+)?present(?:ing)?\s+illness|interval\s+history|subjective",
+    "Past Medical History": r"pmh|past\s+medical\s+history|past\s+history|medical\s+history|problem\s+list",
+    "Past Surgical History": r"psh|past\s+surgical\s+history|surgical\s+history",
+    "Medications": r"medications?|meds|current\s+medications|home\s+medications|discharge\s+medications|"
+                   r"medications\s+on\s+(?:admission|discharge)|rx",
+    "Allergies": r"allerg(?:y|ies)(?:\s+and\s+adverse\s+reactions)?|nkda",
+    "Family History": r"fh|family\s+history",
+    "Social History": r"sh|social\s+history",
+    "Review of Systems": r"ros|review\s+of\s+systems",
+    "Physical Exam": r"pe|physical\s+exam(?:ination)?|exam(?:ination)?|objective|vitals|vital\s+signs",
+    "Labs": r"labs?|laboratory(?:\s+(?:data|results))?|investigations|results|imaging|diagnostics?",
+    "Hospital Course": r"hospital\s+course|brief\s+hospital\s+course|course",
+    "Assessment and Plan": r"a/?p|a\s*&\s*p|assessment(?:\s+(?:and|&)\s+plan)?|impression(?:\s+(?:and|&)\s+plan)?|plan|"
+                           r"diagnos[ie]s|discharge\s+diagnos[ie]s",
+    "Follow-up": r"follow[\s\-]?up|disposition|discharge\s+instructions",
+}
+
+# A header is a known section name at the start of a line, ending in a colon or the end of the line
+HEADER = re.compile(
+    r"^[ \t]*(?:#+[ \t]*)?(?:" + "|".join(f"(?P<s{i}>{p})" for i, p in enumerate(SECTION_NAMES.values())) +
+    r")[ \t]*(?::|-{1,2}(?=[ \t])|$)",
+    re.IGNORECASE | re.MULTILINE,
+)
+_SECTION_BY_GROUP = {f"s{i}": name for i, name in enumerate(SECTION_NAMES)}
+# A sentence or line plus its trailing whitespace; the units concatenate back to the original text
+_UNIT = re.compile(r".+?(?:[.!?]\s+|\n+|$)|\n+", re.DOTALL)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English clinical text)."""
+    return (len(text) + 3) // 4
+
+
+@dataclass
+class Section:
+    name: str
+    text: str
+
+
+@dataclass
+class Chunk:
+    sections: List[str]
+    text: str
+    index: int = 0
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.text)
+
+
+def segment(note_text: str) -> List[Section]:
+    """Splits a note at its section headers. Text before the first header becomes a "Preamble" section."""
+    sections = []
+    last_name, last_start = "Preamble", 0
+    for match in HEADER.finditer(note_text):
+        if match.start() > last_start or last_name != "Preamble":
+            body = note_text[last_start:match.start()]
+            if body.strip():
+                sections.append(Section(last_name, body))
+        last_name, last_start = _SECTION_BY_GROUP[match.lastgroup], match.start()
+    tail = note_text[last_start:]
+    if tail.strip():
+        sections.append(Section(last_name, tail))
+    return sections
+
+
+def _split_oversized(text: str, max_tokens: int) -> List[str]:
+    """Packs whole sentences/lines into pieces under budget; only a single overlong sentence is cut hard."""
+    max_chars = max_tokens * 4
+    pieces: List[str] = []
+    current = ""
+    for unit in _UNIT.findall(text):
+        while len(unit) > max_chars:
+            pieces.append(unit[:max_chars])
+            unit = unit[max_chars:]
+        if len(current) + len(unit) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += unit
+    if current.strip():
+        pieces.append(current)
+    return [p for p in pieces if p.strip()]
+
+
+def chunk(note_text: str, max_tokens: int = CHUNK_TOKENS) -> List[Chunk]:
+    """
+    Packs consecutive sections into chunks of at most max_tokens. A section is only split when it
+    is larger than the budget by itself; its pieces keep the section name so the model has context.
+    """
+    chunks: List[Chunk] = []
+    names: List[str] = []
+    parts: List[str] = []
+    size = 0
+
+    def flush():
+        nonlocal names, parts, size
+        if parts:
+            chunks.append(Chunk(names, "".join(parts), len(chunks)))
+        names, parts, size = [], [], 0
+
+    for section in segment(note_text):
+        tokens = estimate_tokens(section.text)
+        if tokens > max_tokens:
+            flush()
+            pieces = _split_oversized(section.text, max_tokens)
+            for i, piece in enumerate(pieces, start=1):
+                label = f"{section.name} (part {i} of {len(pieces)})" if len(pieces) > 1 else section.name
+                chunks.append(Chunk([label], piece, len(chunks)))
+            continue
+        if size + tokens > max_tokens:
+            flush()
+        names.append(section.name)
+        parts.append(section.text)
+        size += tokens
+    flush()
+    return chunks
+
+
+# --- Merging ------------------------------------------------------------------
+
+def _norm(value: Any) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", str(value or "").lower()).strip()
+
+
+# Entity category -> fields that identify the same entity (first non-empty wins)
+ENTITY_KEYS: Dict[str, Tuple[str, ...]] = {
+    "conditions": ("icd_10", "snomed_ct", "clinical_text"),
+    "medications": ("rxnorm_code", "drug_name"),
+    "allergies": ("allergen",),
+    "labs": ("loinc_code", "test_name"),
+    "social_determinants": ("category", "finding"),
+}
+# Code fields in ENTITY_KEYS -> terminology system they are checked against (None: no local table)
+CODE_FIELDS: Dict[str, Optional[str]] = {"icd_10": "icd10cm", "snomed_ct": "snomedct", "rxnorm_code": "rxnorm",
+                                         "loinc_code": None}
+SEVERITY_RANK = {"low": 1, "mild": 1, "moderate": 2, "medium": 2, "high": 3, "severe": 3, "major": 3, "critical": 4}
+
+
+def _confidence(entity: Dict[str, Any]) -> float:
+    try:
+        return float(entity.get("confidence") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _entity_keys(category: str, entity: Dict[str, Any]) -> List[str]:
+    """Every identifying value of an entity; two entities are the same if any of them match."""
+    fields = ENTITY_KEYS.get(category, ())
+    if category == "labs":
+        # The same test can legitimately appear with several results
+        code = entity.get("loinc_code") if _usable_code("loinc_code", entity.get("loinc_code") or "") else None
+        return [_norm(code or entity.get("test_name")) + "|" + _norm(entity.get("result"))]
+    if category == "social_determinants":
+        return ["|".join(_norm(entity.get(f)) for f in fields)]
+    keys = [field + ":" + _norm(entity[field]) for field in fields
+            if entity.get(field) and (field not in CODE_FIELDS or _usable_code(field, entity[field]))]
+    return keys or [_norm(entity)]
+
+
+def _usable_code(field: str, code: Any) -> bool:
+    """Whether a code can identify an entity: placeholders ("Unknown", "N/A", "...") and unknown codes cannot."""
+    system = CODE_FIELDS[field]
+    if system:
+        return terminology.validate(system, str(code).strip())
+    return any(ch.isdigit() for ch in str(code))
+
+
+def _merge_entity(kept: Dict[str, Any], other: Dict[str, Any], review: List[Dict[str, Any]], category: str):
+    """Keeps the more confident extraction, fills its gaps from the other, and flags contradictions."""
+    if _confidence(other) > _confidence(kept):
+        kept, other = dict(other), kept
+    else:
+        kept = dict(kept)
+    for field, value in other.items():
+        if kept.get(field) in (None, "", []) and value not in (None, "", []):
+            kept[field] = value
+    if "negated" in kept and bool(kept.get("negated")) != bool(other.get("negated", kept.get("negated"))):
+        kept["requires_review"] = True
+        review.append({
+            "entity_type": category,
+            "reason": f"Conflicting negation for '{kept.get('clinical_text') or kept.get('drug_name')}' across note sections",
+            "priority": "high",
+        })
+    if other.get("requires_review"):
+        kept["requires_review"] = True
+    return kept
+
+
+def _union(lists: List[List[Any]]) -> List[Any]:
+    seen, merged = set(), []
+    for items in lists:
+        for item in items or []:
+            key = _norm(item) if isinstance(item, str) else repr(sorted(item.items())) if isinstance(item, dict) else repr(item)
+            if key not in seen:
+                seen.add(key)
+                merged.append(item)
+    return merged
+
+
+def _merge_interactions(lists: List[Optional[List[Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+    """One entry per drug pair, keeping the most severe report."""
+    interactions: Dict[Tuple[str, ...], Dict[str, Any]] = {}
+    for items in lists:
+        for item in items or []:
+            if not isinstance(item, dict):
+                continue
+            pair = tuple(sorted((_norm(item.get("drug_a")), _norm(item.get("drug_b")))))
+            current = interactions.get(pair)
+            if current is None or (SEVERITY_RANK.get(_norm(item.get("severity")), 0)
+                                   > SEVERITY_RANK.get(_norm(current.get("severity")), 0)):
+                interactions[pair] = item
+    return list(interactions.values())
+
+
+def merge_analyses(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merges per-chunk analyses (the CLINICAL_ANALYSIS_PROMPT / api analyze-note shapes) into one."""
+    results = [r for r in results if isinstance(r, dict)]
+    review: List[Dict[str, Any]] = []
+    merged: Dict[str, Any] = {"status": "success"}
+
+    entities: Dict[str, List[Dict[str, Any]]] = {}
+    for result in results:
+        for category, items in (result.get("extracted_entities") or {}).items():
+            bucket = entities.setdefault(category, [])
+            index = {key: i for i, e in enumerate(bucket) for key in _entity_keys(category, e)}
+            for entity in items or []:
+                if not isinstance(entity, dict):
+                    continue
+                keys = _entity_keys(category, entity)
+                position = next((index[k] for k in keys if k in index), None)
+                if position is None:
+                    position = len(bucket)
+                    bucket.append(entity)
+                else:
+                    bucket[position] = _merge_entity(bucket[position], entity, review, category)
+                for key in _entity_keys(category, bucket[position]):
+                    index.setdefault(key, position)
+    merged["extracted_entities"] = entities
+
+    if any("clinical_validations" in r for r in results):
+        flags = [(r.get("clinical_validations") or {}).get("safety_flags") or {} for r in results]
+        merged["clinical_validations"] = {
+            "drug_interactions": _merge_interactions(
+                [(r.get("clinical_validations") or {}).get("drug_interactions") for r in results]),
+            "safety_flags": {
+                level: _union([f.get(level) for f in flags]) for level in ("red_flags", "yellow_flags", "blue_flags")
+            },
+        }
+
+    if any("adherence_insights" in r for r in results):
+        insights = [r.get("adherence_insights") or {} for r in results]
+        scores = []
+        for insight in insights:
+            try:
+                scores.append(int(str(insight.get("complexity_score")).split("-")[0]))
+            except (TypeError, ValueError):
+                pass
+        merged["adherence_insights"] = {
+            "barriers_identified": _union([i.get("barriers_identified") for i in insights]),
+            "patient_app_recommendations": _union([i.get("patient_app_recommendations") for i in insights]),
+            "complexity_score": max(scores) if scores else None,
+        }
+
+    summaries = excerpt_summaries(results)
+    if len(summaries) == 1:
+        merged["clinical_summary"] = summaries[0]
+    elif summaries:
+        # Stand-in until summarize_merged writes one summary for the whole note
+        merged["clinical_summary"] = _entity_summary(entities)
+    if any("fhir_resources" in r for r in results):
+        merged["fhir_resources"] = {
+            "resourceType": "Bundle",
+            "type": "collection",
+            "entry": _merge_fhir_entries([(r.get("fhir_resources") or {}).get("entry") for r in results]),
+        }
+
+    merged["human_review_queue"] = _union([r.get("human_review_queue") for r in results] + [review])
+    return merged
+
+
+def excerpt_summaries(results: List[Dict[str, Any]]) -> List[str]:
+    """The per-excerpt clinical summaries, in note order."""
+    return [r["clinical_summary"].strip() for r in results
+            if isinstance(r, dict) and isinstance(r.get("clinical_summary"), str) and r["clinical_summary"].strip()]
+
+
+def _entity_summary(entities: Dict[str, List[Dict[str, Any]]]) -> str:
+    """A plain listing of the merged findings, used when no model summary is available."""
+    parts = []
+    for label, category, field in (("Conditions", "conditions", "clinical_text"), ("Medications", "medications", "drug_name"),
+                                   ("Allergies", "allergies", "allergen")):
+        names = _union([[e[field]] for e in entities.get(category) or []
+                        if isinstance(e, dict) and e.get(field) and not e.get("negated")])
+        if names:
+            parts.append(f"{label}: {', '.join(str(n) for n in names)}.")
+    return " ".join(parts)
+
+
+def _merge_fhir_entries(lists: List[Optional[List[Any]]]) -> List[Any]:
+    """
+    Concatenates per-chunk bundle entries, keeping one Patient (every excerpt describes the same
+    patient) and one copy of resources repeated across chunks. References to a dropped Patient are
+    pointed at the kept one.
+    """
+    patient: Optional[Dict[str, Any]] = None
+    renamed: Dict[str, str] = {}
+    others: List[Any] = []
+    for items in lists:
+        for entry in items or []:
+            resource = entry.get("resource") if isinstance(entry, dict) else None
+            if not isinstance(resource, dict) or resource.get("resourceType") != "Patient":
+                others.append(entry)
+            elif patient is None:
+                patient = dict(entry, resource=dict(resource))
+            else:
+                kept = patient["resource"]
+                for field, value in resource.items():
+                    if kept.get(field) in (None, "", []) and value not in (None, "", []):
+                        kept[field] = value
+                if resource.get("id") and kept.get("id") and resource["id"] != kept["id"]:
+                    renamed[f"Patient/{resource['id']}"] = f"Patient/{kept['id']}"
+                if entry.get("fullUrl") and patient.get("fullUrl") and entry["fullUrl"] != patient["fullUrl"]:
+                    renamed[entry["fullUrl"]] = patient["fullUrl"]
+
+    entries: List[Any] = [patient] if patient is not None else []
+    seen = set()
+    for entry in others:
+        entry = _rename_references(entry, renamed) if renamed else entry
+        key = json.dumps(entry, sort_keys=True, default=str)
+        if key not in seen:
+            seen.add(key)
+            entries.append(entry)
+    return entries
+
+
+def _rename_references(value: Any, renamed: Dict[str, str]) -> Any:
+    if isinstance(value, dict):
+        return {k: (renamed.get(v, v) if k == "reference" and isinstance(v, str) else _rename_references(v, renamed))
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [_rename_references(v, renamed) for v in value]
+    return value
+
+
+# --- Concurrent analysis --------------------------------------------------------
+
+# Whole-note interaction check: medication names -> drug_interactions entries
+InteractionCheck = Callable[[List[str]], Awaitable[List[Dict[str, Any]]]]
+# Whole-note summary: the excerpt summaries, in note order -> one clinical summary
+Summarize = Callable[[List[str]], Awaitable[str]]
+
+
+async def check_interactions_across(merged: Dict[str, Any], check_interactions: Optional[InteractionCheck]):
+    """
+    Checks the merged medication list as a whole. Each chunk only sees its own medications, so a
+    home medication in one section and a new prescription in another are only compared here.
+    A failed check is put in the human review queue and recorded in merged["chunks"].
+    """
+    names = _union([[m["drug_name"]] for m in (merged.get("extracted_entities") or {}).get("medications") or []
+                    if isinstance(m, dict) and m.get("drug_name") and not m.get("negated")])
+    if check_interactions is None or len(names) < 2:
+        return
+    try:
+        found = await check_interactions(names)
+    except Exception as e:
+        print(f"Interaction check across note sections failed: {e}")
+        merged["human_review_queue"].append({
+            "entity_type": "drug_interactions",
+            "reason": f"Interactions between medications in different note sections could not be checked: {e}",
+            "priority": "high",
+        })
+        merged.setdefault("chunks", {})["interactions_checked"] = False
+        return
+    validations = merged.setdefault("clinical_validations", {})
+    validations["drug_interactions"] = _merge_interactions([validations.get("drug_interactions"), found])
+
+
+async def summarize_merged(merged: Dict[str, Any], summaries: List[str], summarize: Optional[Summarize],
+                           cache=None, namespace: str = ""):
+    """
+    Replaces the stand-in summary of a multi-excerpt merge with one written by summarize. With a
+    cache (see analyze_incremental) the summary is kept by the excerpt summaries it was written
+    from, so re-analyzing a note whose sections all come from the cache costs no call. On failure
+    the plain listing of findings stays.
+    """
+    if summarize is None or len(summaries) <= 1:
+        return
+    key = hashlib.sha256((namespace + "\x1fsummary\x1f" + "\x1e".join(summaries)).encode("utf-8")).hexdigest()
+    cached = cache.get_many([key]).get(key) if cache is not None else None
+    if cached and cached.get("clinical_summary"):
+        merged["clinical_summary"] = cached["clinical_summary"]
+        return
+    try:
+        summary = (await summarize(summaries) or "").strip()
+    except Exception as e:
+        print(f"Summary of the merged note analysis failed: {e}")
+        return
+    if summary:
+        merged["clinical_summary"] = summary
+        if cache is not None:
+            cache.put(key, {"clinical_summary": summary})
+
+
+async def analyze_in_chunks(
+    note_text: str,
+    analyze_chunk: Callable[[Chunk, int], Awaitable[Dict[str, Any]]],
+    max_tokens: int = CHUNK_TOKENS,
+    retries: int = CHUNK_RETRIES,
+    check_interactions: Optional[InteractionCheck] = None,
+    summarize: Optional[Summarize] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Analyzes each chunk concurrently with analyze_chunk(chunk, total) and merges the results.
+    A failing chunk is retried on its own; if it still fails, the merged result lists it in the
+    human review queue. The merged medications are then checked for interactions with
+    check_interactions, and the excerpt summaries combined into one with summarize, if given.
+    Returns None when the note fits in one chunk (callers use their single-prompt path) and
+    re-raises when every chunk failed.
+    """
+    chunks = chunk(note_text, max_tokens)
+    if len(chunks) <= 1:
+        return None
+
+    outcomes = await _analyze_all(chunks, len(chunks), analyze_chunk, retries)
+    failures = [(c, o) for c, o in zip(chunks, outcomes) if isinstance(o, BaseException)]
+    if len(failures) == len(chunks):
+        raise failures[0][1]
+    results = [o for o in outcomes if not isinstance(o, BaseException)]
+    merged = merge_analyses(results)
+    _report_failures(merged, failures)
+    merged["chunks"] = {"total": len(chunks), "failed": len(failures)}
+    await asyncio.gather(check_interactions_across(merged, check_interactions),
+                         summarize_merged(merged, excerpt_summaries(results), summarize))
+    return merged
+
+
+async def _analyze_all(chunks: List[Chunk], total: int, analyze_chunk, retries: int) -> List[Any]:
+    """Results (or exceptions) of analyze_chunk for each chunk, run concurrently with per-chunk retries."""
+
+    async def run(item: Chunk) -> Dict[str, Any]:
+        for attempt in range(retries + 1):
+            try:
+                return await analyze_chunk(item, total)
+            except Exception as e:
+                # An expired deadline or a full model queue is not going to go away by asking again
+                if attempt == retries or isinstance(e, (deadline.DeadlineExceeded, scheduler.QueueFull)):
+                    raise
+                print(f"Chunk {item.index + 1}/{total} ({', '.join(item.sections)}) failed, retrying: {e}")
+
+    return await asyncio.gather(*(run(c) for c in chunks), return_exceptions=True)
+
+
+def _report_failures(merged: Dict[str, Any], failures: List[Tuple[Chunk, BaseException]]):
+    for item, error in failures:
+        merged["human_review_queue"].append({
+            "entity_type": "note_section",
+            "reason": f"Sections {', '.join(item.sections)} could not be analyzed: {error}",
+            "priority": "high",
+        })
+
+
+# --- Incremental re-analysis ------------------------------------------------------
+# An edited note is split into the same units as its previous version except around the edit,
+# so only changed units go to the model; the others are served from a cache keyed by content.
+
+class SectionCache:
+    """Bounded in-process LRU of unit results, keyed by unit_key."""
+
+    def __init__(self, max_entries: int = SECTION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        found = {}
+        for key in keys:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                found[key] = self._entries[key]
+        return found
+
+    def put(self, key: str, result: Dict[str, Any]):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def units(note_text: str, max_tokens: int = CHUNK_TOKENS, min_tokens: int = SECTION_MIN_TOKENS) -> List[Chunk]:
+    """
+    Splits a note into analysis units with boundaries that depend only on nearby content. Each
+    unit holds consecutive sections and is closed once it reaches min_tokens, so a large section
+    is a unit of its own. A section over max_tokens is split on sentence boundaries, after closing
+    any pending small sections as a unit, so no unit exceeds max_tokens. An edit
+    changes its own unit, and can regroup small sections after it only until the next section
+    that reaches min_tokens by itself.
+    """
+    result: List[Chunk] = []
+    names: List[str] = []
+    parts: List[str] = []
+    size = 0
+    for section in segment(note_text):
+        tokens = estimate_tokens(section.text)
+        if tokens > max_tokens:
+            # Pending small sections are a unit of their own: the pieces are already up to max_tokens
+            if parts:
+                result.append(Chunk(names, "".join(parts), len(result)))
+                names, parts, size = [], [], 0
+            pieces = _split_oversized(section.text, max_tokens)
+            for i, piece in enumerate(pieces, start=1):
+                label = f"{section.name} (part {i} of {len(pieces)})" if len(pieces) > 1 else section.name
+                result.append(Chunk([label], piece, len(result)))
+            continue
+        names.append(section.name)
+        parts.append(section.text)
+        size += tokens
+        if size >= min_tokens:
+            result.append(Chunk(names, "".join(parts), len(result)))
+            names, parts, size = [], [], 0
+    if parts:
+        result.append(Chunk(names, "".join(parts), len(result)))
+    return result
+
+
+def unit_key(item: Chunk, namespace: str = "") -> str:
+    """Cache key of a unit's result; namespace separates prompts whose results differ in shape."""
+    text = re.sub(r"\s+", " ", item.text).strip()
+    payload = namespace + "\x1f" + "|".join(item.sections) + "\x1f" + text
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+async def analyze_incremental(
+    note_text: str,
+    analyze_chunk: Callable[[Chunk, int], Awaitable[Dict[str, Any]]],
+    cache,
+    namespace: str = "",
+    min_note_tokens: int = INCREMENTAL_MIN_TOKENS,
+    retries: int = CHUNK_RETRIES,
+    check_interactions: Optional[InteractionCheck] = None,
+    summarize: Optional[Summarize] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Analyzes only the units of the note that are not in cache (a SectionCache, or anything with
+    get_many/put) and merges them with the cached results of the others; the merged result is
+    then checked and summarized as a whole, like analyze_in_chunks. Returns None when incremental
+    mode is off or the note is too short or too unstructured to be worth it (callers use their
+    whole-note path), and re-raises when every unit that needed the model failed.
+    """
+    if not INCREMENTAL_ENABLED or estimate_tokens(note_text) < min_note_tokens:
+        return None
+    items = units(note_text)
+    if len(items) <= 1:
+        return None
+    keys = [unit_key(item, namespace) for item in items]
+    cached = cache.get_many(keys)
+    missing = [(item, key) for item, key in zip(items, keys) if key not in cached]
+    metrics.CACHE_REQUESTS.inc("note_sections", "hit", amount=len(items) - len(missing))
+    metrics.CACHE_REQUESTS.inc("note_sections", "miss", amount=len(missing))
+
+    outcomes = await _analyze_all([item for item, _ in missing], len(items), analyze_chunk, retries) if missing else []
+    failures = [(item, o) for (item, _), o in zip(missing, outcomes) if isinstance(o, BaseException)]
+    if missing and len(failures) == len(missing):
+        raise failures[0][1]
+    results = dict(cached)
+    for (item, key), outcome in zip(missing, outcomes):
+        if not isinstance(outcome, BaseException):
+            cache.put(key, outcome)
+            results[key] = outcome
+    ordered = [results[key] for key in keys if key in results]
+    merged = merge_analyses(ordered)
+    _report_failures(merged, failures)
+    merged["chunks"] = {"total": len(items), "reused": len(cached), "failed": len(failures),
+                        "analyzed_tokens": sum(item.tokens for item, _ in missing)}
+    await asyncio.gather(check_interactions_across(merged, check_interactions),
+                         summarize_merged(merged, excerpt_summaries(ordered), summarize, cache, namespace))
+    return merged
@@ -0,0 +1,305 @@
+"""
+On-demand request profiling for the MedX services.
+A middleware profiles a sampled fraction of requests, or watches every request and keeps the
+profile only when it turns out slower than a threshold. The slowest N profiles are kept in
+memory and can be downloaded as collapsed stacks (flamegraph.pl / speedscope input) from a
+token-protected admin endpoint, which also switches the profiler on and off at runtime.
+
+Backends:
+- "sampling" (default): a background thread snapshots the stacks of all busy threads every few
+  milliseconds. Overhead does not depend on how much Python code runs, so it is safe to leave
+  watching every request. Requests served concurrently show up in each other's profiles.
+- "cprofile": deterministic, exact call counts, but slows the profiled request down noticeably
+  and only sees the event-loop thread. One request is profiled at a time.
+"""
+import cProfile
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from pydantic import BaseModel
+from starlette.responses import PlainTextResponse
+
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN")
+
+
+class ProfilerConfig(BaseModel):
+    enabled: bool = os.getenv("PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+    backend: str = os.getenv("PROFILER_BACKEND", "sampling")
+    # Fraction of requests profiled and always kept
+    sample_rate: float = float(os.getenv("PROFILER_SAMPLE_RATE", "0"))
+    # Requests slower than this are kept (0 disables slow-request capture)
+    slow_ms: float = float(os.getenv("PROFILER_SLOW_MS", "500"))
+    interval_ms: float = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+    top_n: int = int(os.getenv("PROFILER_TOP_N", "20"))
+
+
+config = ProfilerConfig()
+
+
+class ProfilerUpdate(BaseModel):
+    enabled: Optional[bool] = None
+    backend: Optional[str] = None
+    sample_rate: Optional[float] = None
+    slow_ms: Optional[float] = None
+    interval_ms: Optional[float] = None
+    top_n: Optional[int] = None
+
+
+class Profile:
+    def __init__(self, method: str, path: str, backend: str):
+        self.id = next(_ids)
+        self.method = method
+        self.path = path
+        self.backend = backend
+        self.started_at = time.time()
+        self.duration_ms = 0.0
+        self.stacks: Counter = Counter()
+
+    def summary(self) -> Dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "backend": self.backend,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 1),
+            "samples": sum(self.stacks.values()),
+        }
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_ids = itertools.count(1)
+
+
+class ProfileStore:
+    """Keeps the N slowest profiles (min-heap on duration)."""
+
+    def __init__(self):
+        self._heap: List = []
+        self._lock = threading.Lock()
+
+    def add(self, profile: Profile):
+        with self._lock:
+            item = (profile.duration_ms, profile.id, profile)
+            if len(self._heap) < config.top_n:
+                heapq.heappush(self._heap, item)
+            elif profile.duration_ms > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+            while len(self._heap) > config.top_n:
+                heapq.heappop(self._heap)
+
+    def list(self) -> List[Profile]:
+        with self._lock:
+            return [p for _, _, p in sorted(self._heap, reverse=True)]
+
+    def get(self, profile_id: int) -> Optional[Profile]:
+        return next((p for p in self.list() if p.id == profile_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+
+
+store = ProfileStore()
+
+
+# --- Sampling backend ---------------------------------------------------------
+
+# Innermost frames that mean "this thread is idle", not doing work for a request
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"), ("thread.py", "_worker")}
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """One sampler thread, running only while at least one profile is recording."""
+
+    def __init__(self):
+        self._active: Dict[int, Profile] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, profile: Profile):
+        with self._lock:
+            self._active[profile.id] = profile
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+
+    def stop(self, profile: Profile):
+        with self._lock:
+            self._active.pop(profile.id, None)
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(config.interval_ms / 1000)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                profiles = list(self._active.values())
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(labels)))
+            for profile in profiles:
+                profile.stacks.update(stacks)
+
+
+sampler = StackSampler()
+
+
+# --- cProfile backend ---------------------------------------------------------
+
+_cprofile_busy = threading.Lock()
+
+
+def _cprofile_to_collapsed(profiler: cProfile.Profile, max_depth: int = 64) -> Counter:
+    """
+    Rebuilds approximate call stacks from cProfile's caller/callee totals: each function's own
+    time is split across the paths that reached it in proportion to the time spent via each path.
+    Counts are in microseconds.
+    """
+    profiler.create_stats()
+    stats = profiler.stats
+    callees: Dict = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    roots = [f for f, (_, _, _, _, callers) in stats.items() if not callers]
+
+    def label(func) -> str:
+        filename, line, name = func
+        return f"{name} ({os.path.basename(filename)}:{line})" if line else name
+
+    stacks: Counter = Counter()
+
+    def walk(func, path, fraction, seen):
+        _, _, own, total, _ = stats[func]
+        path = path + [label(func)]
+        self_us = int(own * fraction * 1e6)
+        if self_us:
+            stacks[";".join(path)] += self_us
+        if len(path) >= max_depth or total <= 0:
+            return
+        for callee, edge_total in callees.get(func, ()):
+            if callee in seen:
+                continue
+            callee_total = stats[callee][3]
+            if callee_total > 0 and edge_total > 0:
+                walk(callee, path, fraction * edge_total / callee_total, seen | {callee})
+
+    for root in roots:
+        walk(root, [], 1.0, {root})
+    return stacks
+
+
+# --- Middleware and admin endpoints ---------------------------------------------
+
+class ProfilerMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not config.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        sampled = random.random() < config.sample_rate
+        if not sampled and config.slow_ms <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(scope["method"], scope["path"], config.backend)
+        profiler = None
+        if profile.backend == "cprofile":
+            if not _cprofile_busy.acquire(blocking=False):
+                await self.app(scope, receive, send)
+                return
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            sampler.start(profile)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profile.duration_ms = (time.perf_counter() - started) * 1000
+            if profiler is not None:
+                profiler.disable()
+                _cprofile_busy.release()
+            else:
+                sampler.stop(profile)
+            if sampled or profile.duration_ms >= config.slow_ms:
+                if profiler is not None:
+                    profile.stacks = _cprofile_to_collapsed(profiler)
+                store.add(profile)
+
+
+def require_profiler_token(authorization: Optional[str]):
+    if not PROFILER_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiler admin endpoints are disabled (PROFILER_TOKEN not set)")
+    if authorization != f"Bearer {PROFILER_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid profiler token")
+
+
+router = APIRouter()
+
+
+@router.get("/admin/profiler", include_in_schema=False)
+def get_profiler(authorization: Optional[str] = Header(None)):
+    require_profiler_token(authorization)
+    return {"config": config.dict(), "profiles": [p.summary() for p in store.list()]}
+
+
+@router.put("/admin/profiler", include_in_schema=False)
+def update_profiler(update: ProfilerUpdate, authorization: Optional[str] = Header(None)):
+    """Changes the given settings; takes effect on the next request, no restart needed."""
+    require_profiler_token(authorization)
+    if update.backend is not None and update.backend not in ("sampling", "cprofile"):
+        raise HTTPException(status_code=400, detail="backend must be 'sampling' or 'cprofile'")
+    for field, value in update.dict(exclude_none=True).items():
+        setattr(config, field, value)
+    return {"config": config.dict()}
+
+
+@router.delete("/admin/profiler/profiles", include_in_schema=False)
+def clear_profiles(authorization: Optional[str] = Header(None)):
+    require_profiler_token(authorization)
+    store.clear()
+    return {"status": "cleared"}
+
+
+@router.get("/admin/profiler/profiles/{profile_id}", include_in_schema=False)
+def download_profile(profile_id: int, authorization: Optional[str] = Header(None)):
+    """Collapsed stacks, one `frame;frame;frame count` line each (feed to flamegraph.pl or speedscope)."""
+    require_profiler_token(authorization)
+    profile = store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(
+        profile.collapsed(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'},
+    )
@@ -0,0 +1,253 @@
+"""
+Response classes shared by the MedX services.
+JSON goes through orjson when it is installed (stdlib json otherwise). Endpoints that return
+FastJSONResponse themselves also skip FastAPI's jsonable_encoder pass; large arrays can be
+streamed with StreamingJSONResponse so the whole document never sits in memory as one string.
+"""
+import json
+import os
+import stat
+import uuid
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, Mapping, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response, StreamingResponse
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+    print("Warning: orjson not installed. JSON responses use the standard library encoder.")
+
+# (start, end) inclusive; None means "serve the whole file"
+ByteRange = Optional[Tuple[int, int]]
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(value: str, size: int) -> ByteRange:
+    """Parses a single `bytes=` range. Malformed or multi-range headers are ignored (RFC 9110 14.2)."""
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            suffix = int(last)
+            if suffix <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Weak comparison as required for If-None-Match."""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
+# Listings change whenever their data does; clients keep a copy but revalidate every time
+REVALIDATE = "private, no-cache"
+
+
+def validator_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": REVALIDATE}
+
+
+def not_modified(if_none_match: Optional[str], etag: str) -> Optional[Response]:
+    """A bodyless 304 when the client's copy (If-None-Match) is still current, else None."""
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=validator_headers(etag))
+    return None
+
+
+class RangedFileResponse(Response):
+    """
+    Serves a file with ETag revalidation (304) and single byte-range support (206).
+    The body goes out through the ASGI zero-copy extension when the server offers it,
+    otherwise it is streamed in chunks from a worker thread.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        etag: str,
+        filename: Optional[str] = None,
+        media_type: Optional[str] = None,
+        headers: Optional[Mapping[str, str]] = None,
+        disposition: str = "inline",
+        cache_control: str = "private, no-cache",
+    ):
+        self.path = path
+        self.etag = etag
+        self.status_code = 200
+        self.media_type = media_type or "application/octet-stream"
+        self.background = None
+        self.init_headers(headers)
+        self.headers.setdefault("etag", etag)
+        self.headers.setdefault("accept-ranges", "bytes")
+        self.headers.setdefault("cache-control", cache_control)
+        if filename:
+            self.headers.setdefault("content-disposition", f"{disposition}; filename*=utf-8''{quote(filename)}")
+
+    async def __call__(self, scope, receive, send):
+        request_headers = Headers(scope=scope)
+        head_only = scope["method"].upper() == "HEAD"
+
+        if etag_matches(request_headers.get("if-none-match"), self.etag):
+            await self._send_empty(send, 304)
+            return
+
+        stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise RuntimeError(f"File at path {self.path} is not a file.")
+        size = stat_result.st_size
+
+        byte_range = None
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        # If-Range only honours strong validators; anything else falls back to the full body
+        if range_header and (if_range is None or (if_range == self.etag and not self.etag.startswith("W/"))):
+            try:
+                byte_range = parse_range_header(range_header, size)
+            except RangeNotSatisfiable:
+                self.headers["content-range"] = f"bytes */{size}"
+                await self._send_empty(send, 416)
+                return
+
+        if byte_range is None:
+            start, end = 0, size - 1
+        else:
+            start, end = byte_range
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+        length = max(end - start + 1, 0)
+        self.headers["content-length"] = str(length)
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if head_only or length == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        extensions = scope.get("extensions", {})
+        if "http.response.zerocopysend" in extensions:
+            with open(self.path, "rb") as file:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file.fileno(),
+                    "offset": start,
+                    "count": length,
+                    "more_body": False,
+                })
+        elif "http.response.pathsend" in extensions and byte_range is None:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(start)
+                remaining = length
+                while remaining:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+                if remaining:
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_empty(self, send, status_code: int):
+        headers = [(k, v) for k, v in self.raw_headers if k not in (b"content-disposition", b"content-length")]
+        if status_code != 304:
+            headers.append((b"content-length", b"0"))
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+# --- JSON -------------------------------------------------------------------------
+
+def _default(value: Any) -> Any:
+    """Types neither encoder handles natively (orjson already covers datetimes, UUIDs and dataclasses)."""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    if hasattr(value, "_asdict"):
+        return value._asdict()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """Drop-in for JSONResponse; also used as each app's default_response_class."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def rows_to_dicts(rows: Iterable[Any]) -> list:
+    """SQLAlchemy result rows (from a column query) as plain dicts, without loading ORM objects."""
+    return [row._asdict() for row in rows]
+
+
+def stream_json(envelope: Dict[str, Any], key: str, items: Iterable[Any], batch: int = 256) -> Iterator[bytes]:
+    """
+    Encodes {**envelope, key: [*items]} piece by piece: the envelope first, then the items in
+    batches, so only one batch is encoded at a time.
+    """
+    head = dumps({**{k: v for k, v in envelope.items() if k != key}, key: []})
+    yield head[:-2]  # ...,"key":[
+    pending = []
+    first = True
+    for item in items:
+        pending.append(dumps(item))
+        if len(pending) >= batch:
+            yield (b"" if first else b",") + b",".join(pending)
+            pending, first = [], False
+    if pending:
+        yield (b"" if first else b",") + b",".join(pending)
+    yield b"]}"
+
+
+class StreamingJSONResponse(StreamingResponse):
+    def __init__(self, envelope: Dict[str, Any], key: str, items: Iterable[Any], **kwargs: Any):
+        kwargs.setdefault("media_type", "application/json")
+        super().__init__(stream_json(envelope, key, items), **kwargs)
@@ -0,0 +1,170 @@
+"""
+Quota-aware priority scheduler for Gemini calls.
+A token bucket paces outgoing requests; waiters are served strictly by priority class, so
+clinical work keeps its share of the quota when chat and coaching traffic pile up. A 429
+halves the rate (AIMD) and the call is retried with jittered exponential backoff.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from common import metrics
+
+
+class Priority(IntEnum):
+    CLINICAL = 0    # note analysis, interaction checks, prescription scans
+    STANDARD = 1    # de-identification, OCR fallback
+    BACKGROUND = 2  # coaching, chat
+
+
+class QueueFull(Exception):
+    """Raised when a priority class already has too many requests waiting for quota."""
+
+    def __init__(self, priority: Priority, depth: int):
+        super().__init__(f"Gemini request queue for {priority.name.lower()} traffic is full ({depth} waiting)")
+        self.priority = priority
+
+
+def is_quota_error(error: BaseException) -> bool:
+    if isinstance(error, QueueFull):
+        return True
+    # google.api_core.exceptions.ResourceExhausted carries code 429
+    return getattr(error, "code", None) == 429 or "429" in str(error)
+
+
+class QuotaScheduler:
+    def __init__(
+        self,
+        requests_per_minute: float,
+        burst: int = 5,
+        max_retries: int = 3,
+        base_backoff: float = 1.0,
+        max_backoff: float = 30.0,
+        max_queue: Optional[Dict[Priority, int]] = None,
+    ):
+        self.max_rate = requests_per_minute / 60.0
+        self.min_rate = self.max_rate / 20
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_queue = max_queue or {}
+        self._queues: Dict[Priority, Deque[asyncio.Future]] = {p: deque() for p in Priority}
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.throttled = 0
+        self.retries = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _waiting_at_or_above(self, priority: Priority) -> bool:
+        return any(self._queues[p] for p in Priority if p <= priority)
+
+    def try_acquire(self, priority: Priority) -> bool:
+        """Takes a token only if one is free right now and nobody more important is waiting."""
+        self._refill()
+        if self.tokens >= 1 and not self._waiting_at_or_above(priority):
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority: Priority):
+        if self.try_acquire(priority):
+            return
+
+        queue = self._queues[priority]
+        limit = self.max_queue.get(priority)
+        if limit is not None and len(queue) >= limit:
+            raise QueueFull(priority, len(queue))
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.tokens += 1  # granted just as the caller gave up; hand the token back
+            else:
+                try:
+                    queue.remove(future)
+                except ValueError:
+                    pass
+            raise
+
+    async def _dispatch(self):
+        while any(self._queues.values()):
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            for priority in Priority:
+                queue = self._queues[priority]
+                while queue and queue[0].done():
+                    queue.popleft()
+                if queue:
+                    self.tokens -= 1
+                    queue.popleft().set_result(None)
+                    break
+
+    def on_throttled(self):
+        self.throttled += 1
+        metrics.GEMINI_THROTTLED.inc()
+        self.rate = max(self.min_rate, self.rate / 2)
+        # Whatever burst we had saved is clearly not available upstream
+        self.tokens = min(self.tokens, 0.0)
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    async def run(self, fn: Callable[[], Awaitable[Any]], priority: Priority = Priority.STANDARD) -> Any:
+        attempt = 0
+        while True:
+            await self.acquire(priority)
+            try:
+                result = await fn()
+            except Exception as e:
+                if not is_quota_error(e) or attempt >= self.max_retries:
+                    raise
+                self.on_throttled()
+                self.retries += 1
+                # Full jitter keeps a burst of 429s from retrying in lockstep
+                await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt)))
+                attempt += 1
+                continue
+            self.on_success()
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "rate_per_minute": round(self.rate * 60, 2),
+            "max_rate_per_minute": round(self.max_rate * 60, 2),
+            "tokens": round(self.tokens, 2),
+            "queue_depth": {p.name.lower(): len(q) for p, q in self._queues.items()},
+            "throttled": self.throttled,
+            "retries": self.retries,
+        }
+
+
+def scheduler_from_env() -> QuotaScheduler:
+    return QuotaScheduler(
+        requests_per_minute=float(os.getenv("GEMINI_RPM", "60")),
+        burst=int(os.getenv("GEMINI_BURST", "5")),
+        max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "3")),
+        max_queue={
+            Priority.STANDARD: int(os.getenv("GEMINI_MAX_QUEUE_STANDARD", "100")),
+            Priority.BACKGROUND: int(os.getenv("GEMINI_MAX_QUEUE_BACKGROUND", "50")),
+        },
+    )
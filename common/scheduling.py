@@ -0,0 +1,306 @@
+"""
+Appointment scheduling: doctor availability templates and per-doctor booking calendars.
+A doctor's free-text availability ("Mon-Fri, 9am - 5pm", "Mon/Wed 10:00-13:00; Sat 9-12")
+is parsed into weekly windows. Booked appointments are kept per doctor as a sorted list of
+start minutes, so overlap checks and free-slot queries are binary searches in memory; the
+database stays authoritative and is re-checked when a booking is committed.
+"""
+import bisect
+import os
+import re
+import time
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+# Every appointment occupies this many minutes; free slots are offered on the same grid
+APPOINTMENT_MINUTES = int(os.getenv("APPOINTMENT_MINUTES", "30"))
+# Appointment times are stored as naive wall-clock times in this zone
+CLINIC_TIMEZONE = os.getenv("CLINIC_TIMEZONE", "UTC")
+# A calendar is reloaded from the database after this long (bookings made by other workers)
+INDEX_TTL_SECONDS = float(os.getenv("SCHEDULE_INDEX_TTL_SECONDS", "30"))
+# Days listed without hours ("Mon-Fri") use these; hours listed without days apply to weekdays
+DEFAULT_HOURS = (9 * 60, 17 * 60)
+DEFAULT_DAYS = (0, 1, 2, 3, 4)
+
+DAY_NAMES = {
+    "mon": 0, "monday": 0, "tue": 1, "tues": 1, "tuesday": 1, "wed": 2, "weds": 2, "wednesday": 2,
+    "thu": 3, "thur": 3, "thurs": 3, "thursday": 3, "fri": 4, "friday": 4, "sat": 5, "saturday": 5,
+    "sun": 6, "sunday": 6,
+}
+DAY_GROUPS = {
+    "weekdays": (0, 1, 2, 3, 4), "weekday": (0, 1, 2, 3, 4), "weekends": (5, 6), "weekend": (5, 6),
+    "daily": tuple(range(7)), "everyday": tuple(range(7)), "all days": tuple(range(7)),
+}
+_DAY = r"(?:%s)\.?" % "|".join(sorted(DAY_NAMES, key=len, reverse=True))
+_CLOCK = r"(?:\d{1,2}(?::\d{2})?\s*(?:[ap]\.?m\.?)?|noon|midnight)"
+TOKEN = re.compile(
+    r"(?P<days>\b%s\s*(?:-|–|to|through|thru)\s*%s\b)" % (_DAY, _DAY)
+    + r"|(?P<group>\b(?:%s)\b)" % "|".join(DAY_GROUPS)
+    + r"|(?P<day>\b%s\b)" % _DAY
+    + r"|(?P<closed>\bclosed\b|\boff\b)"
+    + r"|(?P<times>(?<![\d:])%s\s*(?:-|–|to|until|till)\s*%s(?![\d:]))" % (_CLOCK, _CLOCK),
+    re.IGNORECASE,
+)
+CLOCK = re.compile(r"(\d{1,2})(?::(\d{2}))?\s*([ap])?", re.IGNORECASE)
+RANGE_SEPARATOR = re.compile(r"\s*(?:-|–|to|until|till)\s*", re.IGNORECASE)
+
+Window = Tuple[int, int]
+
+
+def _day_number(token: str) -> int:
+    return DAY_NAMES[token.lower().rstrip(".")]
+
+
+def _clock(text: str) -> Tuple[int, int, Optional[str]]:
+    """(hour, minute, 'a'/'p'/None) for one end of a time range."""
+    text = text.strip().lower()
+    if text == "noon":
+        return 12, 0, "p"
+    if text == "midnight":
+        return 12, 0, "a"
+    hour, minute, meridiem = CLOCK.match(text).groups()
+    return int(hour), int(minute or 0), meridiem and meridiem.lower()
+
+
+def _to_minutes(hour: int, minute: int, meridiem: Optional[str]) -> int:
+    if meridiem == "a":
+        hour = 0 if hour == 12 else hour
+    elif meridiem == "p":
+        hour = hour if hour == 12 else hour + 12
+    return hour * 60 + minute
+
+
+def parse_time_range(text: str) -> Optional[Window]:
+    """'9am - 5pm', '9:30-13:00', '9-5' (read as 9:00-17:00) -> minutes since midnight."""
+    parts = RANGE_SEPARATOR.split(text.strip(), maxsplit=1)
+    if len(parts) != 2:
+        return None
+    (h1, m1, p1), (h2, m2, p2) = _clock(parts[0]), _clock(parts[1])
+    if p1 is None and p2 is not None:
+        # "9-5pm" / "1-5pm": the start shares the end's half of the day unless that puts it after the end
+        p1 = p2 if _to_minutes(h1, m1, p2) < _to_minutes(h2, m2, p2) else "a"
+    start, end = _to_minutes(h1, m1, p1), _to_minutes(h2, m2, p2)
+    if end == 0 and (p2 == "a" or parts[1].strip().lower() == "midnight"):
+        end = 24 * 60
+    if p2 is None and end <= start and h2 < 12:
+        end += 12 * 60
+    if not (0 <= start < end <= 24 * 60):
+        return None
+    return start, end
+
+
+def _merge(windows: List[Window]) -> Tuple[Window, ...]:
+    merged: List[Window] = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return tuple(merged)
+
+
+class WeeklyTemplate:
+    """Opening windows per weekday (Monday = 0), in minutes since midnight."""
+
+    def __init__(self, windows: Dict[int, List[Window]]):
+        self.days: Tuple[Tuple[Window, ...], ...] = tuple(_merge(windows.get(day, [])) for day in range(7))
+
+    def windows(self, day: date) -> Tuple[Window, ...]:
+        return self.days[day.weekday()]
+
+    def contains(self, start: datetime, minutes: int = APPOINTMENT_MINUTES) -> bool:
+        begin = start.hour * 60 + start.minute
+        return any(a <= begin and begin + minutes <= b for a, b in self.windows(start.date()))
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        names = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+        return {
+            names[day]: [f"{a // 60:02d}:{a % 60:02d}-{b // 60:02d}:{b % 60:02d}" for a, b in windows]
+            for day, windows in enumerate(self.days) if windows
+        }
+
+
+@lru_cache(maxsize=1024)
+def parse_availability(text: Optional[str]) -> Optional[WeeklyTemplate]:
+    """
+    Parses free-text availability into a weekly template, or None when nothing recognisable is
+    found. Day specs and time ranges are read left to right; a day spec that follows a time
+    range starts a new group, so "Mon-Fri 9am-1pm, 2pm-5pm, Sat 10-2" has two groups.
+    """
+    if not text:
+        return None
+    windows: Dict[int, List[Window]] = {}
+    days: List[int] = []
+    day_times: List[Window] = []
+    closed = False
+    # "closed"/"off" before a day spec ("closed Sunday", "9-5, off weekends") applies to that spec
+    closed_next = False
+    found = False
+
+    def flush():
+        if days and not day_times and not closed:
+            day_times.append(DEFAULT_HOURS)
+        for day in days or (DEFAULT_DAYS if day_times else ()):
+            windows.setdefault(day, []).extend(day_times)
+
+    for match in TOKEN.finditer(text):
+        kind = match.lastgroup
+        if kind == "times":
+            window = parse_time_range(match.group())
+            if window:
+                day_times.append(window)
+                found = True
+            continue
+        if kind == "closed":
+            if days and not day_times:
+                closed = True
+            else:
+                closed_next = True
+            continue
+        if day_times or closed or closed_next:
+            flush()
+            days, day_times, closed, closed_next = [], [], closed_next, False
+        if kind == "days":
+            first, last = re.split(r"\s*(?:-|–|to|through|thru)\s*", match.group(), maxsplit=1, flags=re.IGNORECASE)
+            start, end = _day_number(first), _day_number(last)
+            days.extend((start + i) % 7 for i in range((end - start) % 7 + 1))
+        elif kind == "group":
+            days.extend(DAY_GROUPS[match.group().lower()])
+        else:
+            days.append(_day_number(match.group()))
+        found = True
+    flush()
+    return WeeklyTemplate(windows) if found and any(windows.values()) else None
+
+
+try:
+    CLINIC_ZONE = ZoneInfo(CLINIC_TIMEZONE)
+except Exception:
+    print(f"Warning: unknown CLINIC_TIMEZONE {CLINIC_TIMEZONE!r}. Appointment times are stored as UTC.")
+    CLINIC_ZONE = ZoneInfo("UTC")
+
+
+def wall_time(value: datetime) -> datetime:
+    """
+    Appointments are stored as naive wall-clock times in the clinic's zone. A time with a UTC
+    offset is converted to that zone first; naive times are taken as clinic time already.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(CLINIC_ZONE).replace(tzinfo=None)
+    return value
+
+
+def now() -> datetime:
+    """The current clinic wall-clock time, comparable with stored appointment times."""
+    return wall_time(datetime.now(CLINIC_ZONE))
+
+
+def today() -> date:
+    return now().date()
+
+
+def minute_of(value: datetime) -> int:
+    """Absolute minute number of a (naive) datetime, independent of the host timezone."""
+    return value.toordinal() * 1440 + value.hour * 60 + value.minute
+
+
+def from_minute(minute: int) -> datetime:
+    day, rest = divmod(minute, 1440)
+    return datetime.fromordinal(day) + timedelta(minutes=rest)
+
+
+_CLOCK_SUFFIXES = [f"T{m // 60:02d}:{m % 60:02d}:00" for m in range(1440)]
+
+
+@lru_cache(maxsize=4096)
+def _day_iso(ordinal: int) -> str:
+    return date.fromordinal(ordinal).isoformat()
+
+
+def isoformat(minute: int) -> str:
+    """ISO wall-clock time of an absolute minute, without building a datetime."""
+    day, rest = divmod(minute, 1440)
+    return _day_iso(day) + _CLOCK_SUFFIXES[rest]
+
+
+class DoctorCalendar:
+    """Scheduled appointments of one doctor as sorted (start_minute, appointment_id) pairs."""
+
+    def __init__(self, appointments: Iterable[Tuple[int, datetime]] = (), minutes: int = APPOINTMENT_MINUTES):
+        self.minutes = minutes
+        self.entries: List[Tuple[int, int]] = sorted((minute_of(wall_time(dt)), appt_id) for appt_id, dt in appointments)
+        self.loaded_at = time.monotonic()
+
+    def add(self, appt_id: int, start: datetime):
+        bisect.insort(self.entries, (minute_of(wall_time(start)), appt_id))
+
+    def remove(self, appt_id: int):
+        self.entries = [entry for entry in self.entries if entry[1] != appt_id]
+
+    def conflicts(self, start: datetime, ignore: Optional[int] = None) -> List[int]:
+        """Appointments overlapping a new one starting at start (all appointments share one length)."""
+        begin = minute_of(wall_time(start))
+        lo = bisect.bisect_left(self.entries, (begin - self.minutes + 1,))
+        hi = bisect.bisect_left(self.entries, (begin + self.minutes,))
+        return [appt_id for _, appt_id in self.entries[lo:hi] if appt_id != ignore]
+
+    def free_slots(self, template: WeeklyTemplate, first: date, last: date, after: Optional[datetime] = None) -> List[int]:
+        """Open slot starts (absolute minutes, see from_minute) between two dates, inclusive, on the appointment grid."""
+        step = self.minutes
+        entries = self.entries
+        count = len(entries)
+        earliest = minute_of(wall_time(after)) if after else 0
+        slots: List[int] = []
+        for ordinal in range(first.toordinal(), last.toordinal() + 1):
+            base = ordinal * 1440
+            for open_at, close_at in template.days[date.fromordinal(ordinal).weekday()]:
+                # Walk the day's bookings alongside the slots instead of searching per slot
+                i = bisect.bisect_left(entries, (base + open_at - step + 1,))
+                slot, stop = base + open_at, base + close_at - step
+                while slot <= stop:
+                    while i < count and entries[i][0] <= slot - step:
+                        i += 1
+                    if (i == count or entries[i][0] >= slot + step) and slot >= earliest:
+                        slots.append(slot)
+                    slot += step
+        return slots
+
+
+Loader = Callable[[int], Iterable[Tuple[int, datetime]]]
+
+
+class ScheduleIndex:
+    """doctor_id -> DoctorCalendar, loaded on first use and refreshed after INDEX_TTL_SECONDS."""
+
+    def __init__(self, loader: Loader, ttl: float = INDEX_TTL_SECONDS, minutes: int = APPOINTMENT_MINUTES):
+        self.loader = loader
+        self.ttl = ttl
+        self.minutes = minutes
+        self._calendars: Dict[int, DoctorCalendar] = {}
+
+    def calendar(self, doctor_id: int) -> DoctorCalendar:
+        calendar = self._calendars.get(doctor_id)
+        if calendar is None or time.monotonic() - calendar.loaded_at > self.ttl:
+            calendar = DoctorCalendar(self.loader(doctor_id), self.minutes)
+            self._calendars[doctor_id] = calendar
+        return calendar
+
+    def add(self, doctor_id: int, appt_id: int, start: datetime):
+        if doctor_id in self._calendars:
+            self._calendars[doctor_id].add(appt_id, start)
+
+    def remove(self, doctor_id: int, appt_id: int):
+        if doctor_id in self._calendars:
+            self._calendars[doctor_id].remove(appt_id)
+
+    def drop(self, doctor_id: int):
+        self._calendars.pop(doctor_id, None)
+
+    def conflicts(self, doctor_id: int, start: datetime, ignore: Optional[int] = None) -> List[int]:
+        return self.calendar(doctor_id).conflicts(start, ignore)
+
+    def free_slots(self, doctor_id: int, template: WeeklyTemplate, first: date, last: date,
+                   after: Optional[datetime] = None) -> List[int]:
+        return self.calendar(doctor_id).free_slots(template, first, last, after)
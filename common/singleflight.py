@@ -0,0 +1,46 @@
+"""
+Single-flight request coalescing.
+Concurrent callers asking for the same key share one in-flight coroutine and its result.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from common import deadline, metrics
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], kind: str = "default") -> Any:
+        """
+        Runs fn() once per key at a time. The call runs as its own task, without the leader's
+        deadline, so a leader that disconnects or times out does not cancel or fail the result its
+        followers are waiting for. Each waiter bounds its own wait (see llm.coalesced).
+        """
+        stats = self._stats.setdefault(kind, {"calls": 0, "coalesced": 0})
+        task = self._inflight.get(key)
+        if task is None:
+            task = deadline.without_deadline().run(asyncio.ensure_future, fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+            stats["calls"] += 1
+            metrics.COALESCED_CALLS.inc(kind, "leader")
+        else:
+            stats["coalesced"] += 1
+            metrics.COALESCED_CALLS.inc(kind, "coalesced")
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved in case every waiter has already gone away
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {kind: dict(counts) for kind, counts in self._stats.items()}
@@ -0,0 +1,218 @@
+"""
+Cross-doctor slot search.
+A board holds one row per doctor and one column per SLOT_MINUTES of the next
+SLOT_HORIZON_DAYS: whether the doctor is open (from their availability template), whether an
+appointment may start there, how many scheduled appointments cover the slot, and the resulting
+free map. Starts follow the same APPOINTMENT_MINUTES grid from each opening as the per-doctor
+calendars, so both offer the same times. Bookings and cancellations update the counts of the
+slots they cover; "next available" searches run as numpy operations over all matching rows at
+once. Callers search past the horizon with the per-doctor calendars.
+"""
+import math
+import os
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from common import scheduling
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    print("Warning: numpy not installed. Next-available search falls back to per-doctor calendars.")
+
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", "15"))
+HORIZON_DAYS = int(os.getenv("SLOT_HORIZON_DAYS", "60"))
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+
+
+class DoctorRow(NamedTuple):
+    doctor_id: int
+    full_name: Optional[str]
+    specialization: Optional[str]
+    organization_id: Optional[int]
+    organization_name: Optional[str]
+    availability: Optional[str]
+
+
+class OpenSlot(NamedTuple):
+    doctor: DoctorRow
+    start: datetime
+
+
+# Returns the doctors of a board and their scheduled (doctor_id, start) appointments from a date on
+Loader = Callable[[Optional[int], date], Tuple[List[DoctorRow], Iterable[Tuple[int, datetime]]]]
+
+
+def week_pattern(template: scheduling.WeeklyTemplate) -> "np.ndarray":
+    """(7, SLOTS_PER_DAY) open map; a slot is open only if the whole slot is inside a window."""
+    pattern = np.zeros((7, SLOTS_PER_DAY), dtype=bool)
+    for day, windows in enumerate(template.days):
+        for open_at, close_at in windows:
+            pattern[day, math.ceil(open_at / SLOT_MINUTES):close_at // SLOT_MINUTES] = True
+    return pattern
+
+
+def week_starts(template: scheduling.WeeklyTemplate) -> "np.ndarray":
+    """
+    (7, SLOTS_PER_DAY) map of appointment starts: every APPOINTMENT_MINUTES from each opening, as in
+    DoctorCalendar.free_slots. Starts that fall between two columns cannot be offered.
+    """
+    starts = np.zeros((7, SLOTS_PER_DAY), dtype=bool)
+    for day, windows in enumerate(template.days):
+        for open_at, close_at in windows:
+            for minute in range(open_at, close_at - scheduling.APPOINTMENT_MINUTES + 1, scheduling.APPOINTMENT_MINUTES):
+                if minute % SLOT_MINUTES == 0:
+                    starts[day, minute // SLOT_MINUTES] = True
+    return starts
+
+
+class SlotBoard:
+    def __init__(self, doctors: List[DoctorRow], appointments: Iterable[Tuple[int, datetime]],
+                 base: date, days: int = HORIZON_DAYS):
+        self.base = base
+        self.days = days
+        self.doctors = doctors
+        self.rows = {doctor.doctor_id: i for i, doctor in enumerate(doctors)}
+        self._specializations = [(doctor.specialization or "").lower() for doctor in doctors]
+        self.loaded_at = time.monotonic()
+        columns = days * SLOTS_PER_DAY
+        self.open = np.zeros((len(doctors), columns), dtype=bool)
+        self.starts = np.zeros((len(doctors), columns), dtype=bool)
+        weekdays = (base.weekday() + np.arange(days)) % 7
+        for i, doctor in enumerate(doctors):
+            template = scheduling.parse_availability(doctor.availability)
+            if template:
+                self.open[i] = week_pattern(template)[weekdays].ravel()
+                self.starts[i] = week_starts(template)[weekdays].ravel()
+        self.busy = np.zeros((len(doctors), columns), dtype=np.uint16)
+        spans = [(self.rows[doctor_id],) + self._span(start) for doctor_id, start in appointments if doctor_id in self.rows]
+        if spans:
+            rows, firsts, lasts = (np.array(values) for values in zip(*spans))
+            # Appointments cover a handful of columns each; count them all in one scatter-add per offset
+            for offset in range(int((lasts - firsts).max())):
+                covered = firsts + offset < lasts
+                np.add.at(self.busy, (rows[covered], firsts[covered] + offset), 1)
+        self.free = self.open & (self.busy == 0)
+
+    def _span(self, start: datetime) -> Tuple[int, int]:
+        """Columns covered by an appointment starting at start (partially covered slots count)."""
+        offset = scheduling.minute_of(scheduling.wall_time(start)) - self.base.toordinal() * 1440
+        first = offset // SLOT_MINUTES
+        last = -(-(offset + scheduling.APPOINTMENT_MINUTES) // SLOT_MINUTES)
+        return max(first, 0), min(last, self.open.shape[1])
+
+    def _cover(self, doctor_id: int, start: datetime, delta: int) -> Optional[Tuple[int, int, int]]:
+        row = self.rows.get(doctor_id)
+        if row is None:
+            return None
+        first, last = self._span(start)
+        if first >= last:
+            return None
+        counts = self.busy[row, first:last].astype(np.int32) + delta
+        self.busy[row, first:last] = np.clip(counts, 0, None)
+        return row, first, last
+
+    def book(self, doctor_id: int, start: datetime):
+        covered = self._cover(doctor_id, start, 1)
+        if covered:
+            row, first, last = covered
+            self.free[row, first:last] = False
+
+    def release(self, doctor_id: int, start: datetime):
+        covered = self._cover(doctor_id, start, -1)
+        if covered:
+            row, first, last = covered
+            self.free[row, first:last] = self.open[row, first:last] & (self.busy[row, first:last] == 0)
+
+    def column(self, moment: datetime) -> int:
+        minute = scheduling.minute_of(scheduling.wall_time(moment)) - self.base.toordinal() * 1440
+        return -(-minute // SLOT_MINUTES)
+
+    def time_of(self, column: int) -> datetime:
+        return datetime.combine(self.base, datetime.min.time()) + timedelta(minutes=column * SLOT_MINUTES)
+
+    @property
+    def end(self) -> datetime:
+        """First moment past the horizon."""
+        return self.time_of(self.open.shape[1])
+
+    def search(self, start: datetime, end: datetime, specialization: Optional[str] = None,
+               limit: int = 10, per_doctor: int = 3) -> List[OpenSlot]:
+        """
+        Earliest appointment starts in [start, end) across the board, in time order. Only the part of the
+        window before self.end is searched.
+        """
+        if not self.doctors:
+            return []
+        length = -(-scheduling.APPOINTMENT_MINUTES // SLOT_MINUTES)
+        lo = max(self.column(start), 0)
+        hi = min(self.column(end), self.free.shape[1] - length + 1)
+        if lo >= hi:
+            return []
+        rows = np.arange(len(self.doctors))
+        # Plain slicing keeps the unfiltered case a view; a row list copies just one block at a time
+        selected: Any = slice(None)
+        if specialization:
+            needle = specialization.lower()
+            rows = np.array([i for i, name in enumerate(self._specializations) if needle in name], dtype=int)
+            if not len(rows):
+                return []
+            selected = rows
+        results: List[OpenSlot] = []
+        taken: Dict[int, int] = {}
+        # A day of columns at a time; the earliest openings are usually in the first block
+        for block in range(lo, hi, SLOTS_PER_DAY):
+            width = min(SLOTS_PER_DAY, hi - block)
+            free = self.free[selected, block:block + width + length - 1]
+            # A start is usable when all slots the appointment needs are free
+            usable = free[:, :width] & self.starts[selected, block:block + width]
+            for shift in range(1, length):
+                usable &= free[:, shift:shift + width]
+            # Columns in time order; only the columns that have an opening are looked into
+            for column in np.flatnonzero(usable.any(axis=0)).tolist():
+                for match in np.flatnonzero(usable[:, column]).tolist():
+                    row = int(rows[match])
+                    if taken.get(row, 0) >= per_doctor:
+                        continue
+                    taken[row] = taken.get(row, 0) + 1
+                    results.append(OpenSlot(self.doctors[row], self.time_of(block + column)))
+                    if len(results) >= limit:
+                        return results
+        return results
+
+
+class SlotBoards:
+    """organization_id (None = every organization) -> SlotBoard, rebuilt daily and after the TTL."""
+
+    def __init__(self, loader: Loader, ttl: float = scheduling.INDEX_TTL_SECONDS, days: int = HORIZON_DAYS):
+        self.loader = loader
+        self.ttl = ttl
+        self.days = days
+        self._boards: Dict[Optional[int], SlotBoard] = {}
+
+    def board(self, organization_id: Optional[int]) -> SlotBoard:
+        board = self._boards.get(organization_id)
+        today = scheduling.today()
+        if board is None or board.base != today or time.monotonic() - board.loaded_at > self.ttl:
+            doctors, appointments = self.loader(organization_id, today)
+            board = SlotBoard(doctors, appointments, today, self.days)
+            self._boards[organization_id] = board
+        return board
+
+    def book(self, doctor_id: int, start: datetime):
+        for board in self._boards.values():
+            board.book(doctor_id, start)
+
+    def release(self, doctor_id: int, start: datetime):
+        for board in self._boards.values():
+            board.release(doctor_id, start)
+
+    def invalidate(self):
+        """Doctors were added, removed or changed their hours."""
+        self._boards.clear()
+
+    def search(self, organization_id: Optional[int], **kwargs: Any) -> List[OpenSlot]:
+        return self.board(organization_id).search(**kwargs)
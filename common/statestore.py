@@ -0,0 +1,192 @@
+"""
+Shared state for the small document stores (medication lists, adherence and audit logs).
+Items are JSON documents in a table on a SQL database every worker can reach: SQLite in WAL
+mode for several workers on one host, Postgres for several hosts. Each (collection, owner) pair
+has a version that is bumped in the same transaction as the write. Workers keep lists in a local
+read-through cache and revalidate them with one primary-key lookup, so a write in any worker
+invalidates every worker's copy.
+"""
+import json
+import os
+import time
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import (BigInteger, Column, Index, Integer, MetaData, String, Table, Text, bindparam, create_engine,
+                        delete, event, insert, select, update)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+CACHE_ENABLED = os.getenv("STATE_CACHE", "true").lower() == "true"
+
+metadata = MetaData()
+
+items = Table(
+    "state_items", metadata,
+    Column("seq", Integer, primary_key=True, autoincrement=True),
+    Column("collection", String, nullable=False),
+    Column("owner", String, nullable=False),
+    Column("item_id", String, nullable=False),
+    Column("data", Text, nullable=False),
+    Index("ix_state_items_owner", "collection", "owner", "seq"),
+)
+
+versions = Table(
+    "state_versions", metadata,
+    Column("collection", String, primary_key=True),
+    Column("owner", String, primary_key=True),
+    Column("version", BigInteger, nullable=False),
+)
+
+
+# Built once: constructing a statement costs more than running it against a warm connection
+_IN_SCOPE = (versions.c.collection == bindparam("collection"), versions.c.owner == bindparam("owner"))
+_ITEMS_IN_SCOPE = (items.c.collection == bindparam("collection"), items.c.owner == bindparam("owner"))
+_SELECT_VERSION = select(versions.c.version).where(*_IN_SCOPE)
+_SELECT_ITEMS = select(items.c.data).where(*_ITEMS_IN_SCOPE).order_by(items.c.seq.asc())
+_SELECT_ITEMS_NEWEST = select(items.c.data).where(*_ITEMS_IN_SCOPE).order_by(items.c.seq.desc())
+_SELECT_PAGE = select(items.c.seq, items.c.owner, items.c.data).where(
+    items.c.collection == bindparam("collection"), items.c.seq > bindparam("after")
+).order_by(items.c.seq).limit(bindparam("batch"))
+
+
+def _initial_version() -> int:
+    # Starting from the clock keeps versions (and ETags built from them) unique across database resets
+    return int(time.time() * 1000)
+
+
+def _upsert_insert(dialect: str):
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        return dialect_insert
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        return dialect_insert
+    return None
+
+
+class SQLStateStore:
+    def __init__(self, engine: Engine, cache: bool = CACHE_ENABLED):
+        self.engine = engine
+        self._upsert = _upsert_insert(engine.dialect.name)
+        # (collection, owner, newest_first) -> (version, items)
+        self._cache: Optional[Dict[Tuple[str, str, bool], Tuple[int, List[dict]]]] = {} if cache else None
+        if engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+            # WAL lets readers in other workers run while one worker writes; the mode is stored in the file
+            event.listen(engine, "connect", _sqlite_pragmas)
+            with engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+        metadata.create_all(engine, checkfirst=True)
+
+    def version(self, collection: str, owner: str = "") -> int:
+        with self.engine.connect() as conn:
+            return self._version(conn, collection, owner)
+
+    def _version(self, conn, collection: str, owner: str) -> int:
+        return conn.execute(_SELECT_VERSION, {"collection": collection, "owner": owner}).scalar() or 0
+
+    def list(self, collection: str, owner: str = "", newest_first: bool = False) -> List[dict]:
+        """Items in insertion order (or newest first). Cached lists are shared: treat them as read-only."""
+        key = (collection, owner, newest_first)
+        with self.engine.connect() as conn:
+            # Version first: a write landing in between makes the cached copy look older, never newer
+            current = self._version(conn, collection, owner)
+            if self._cache is not None:
+                cached = self._cache.get(key)
+                if cached and cached[0] == current:
+                    return cached[1]
+            rows = conn.execute(_SELECT_ITEMS_NEWEST if newest_first else _SELECT_ITEMS,
+                                {"collection": collection, "owner": owner})
+            result = [json.loads(data) for (data,) in rows]
+        if self._cache is not None:
+            self._cache[key] = (current, result)
+        return result
+
+    def iter_collection(self, collection: str, batch: int = 500) -> Iterator[Tuple[str, dict]]:
+        """(owner, item) for every owner, in keyset pages so no cursor or transaction stays open for long."""
+        after = 0
+        while True:
+            with self.engine.connect() as conn:
+                page = conn.execute(_SELECT_PAGE, {"collection": collection, "after": after, "batch": batch}).all()
+            for seq, owner, data in page:
+                yield owner, json.loads(data)
+            if len(page) < batch:
+                return
+            after = page[-1][0]
+
+    def add(self, collection: str, owner: str, item: dict) -> dict:
+        """Stores item (given an "id" if it has none) and returns it."""
+        item.setdefault("id", str(uuid.uuid4()))
+        with self.engine.begin() as conn:
+            conn.execute(insert(items).values(
+                collection=collection, owner=owner, item_id=str(item["id"]), data=json.dumps(item, default=str)))
+            self._bump(conn, collection, owner)
+        return item
+
+    def delete(self, collection: str, owner: str, item_id: str) -> bool:
+        with self.engine.begin() as conn:
+            removed = conn.execute(delete(items).where(
+                items.c.collection == collection, items.c.owner == owner, items.c.item_id == str(item_id))).rowcount
+            if removed:
+                self._bump(conn, collection, owner)
+        return bool(removed)
+
+    def replace(self, collection: str, owner: str, new_items: Iterable[dict]) -> List[dict]:
+        """Swaps the whole list in one transaction, so no reader sees it half-written."""
+        stored = []
+        with self.engine.begin() as conn:
+            conn.execute(delete(items).where(items.c.collection == collection, items.c.owner == owner))
+            for item in new_items:
+                item.setdefault("id", str(uuid.uuid4()))
+                conn.execute(insert(items).values(
+                    collection=collection, owner=owner, item_id=str(item["id"]), data=json.dumps(item, default=str)))
+                stored.append(item)
+            self._bump(conn, collection, owner)
+        return stored
+
+    def seed(self, collection: str, owner: str, initial: Iterable[dict]):
+        """Stores the initial items only if this collection has never been written (by any worker)."""
+        with self.engine.begin() as conn:
+            marker = {"collection": collection, "owner": owner, "version": _initial_version()}
+            if self._upsert is not None:
+                created = conn.execute(self._upsert(versions).values(**marker).on_conflict_do_nothing()).rowcount
+            elif self._version(conn, collection, owner):
+                created = 0
+            else:
+                created = conn.execute(insert(versions).values(**marker)).rowcount
+            if created:
+                for item in initial:
+                    conn.execute(insert(items).values(
+                        collection=collection, owner=owner, item_id=str(item["id"]), data=json.dumps(item, default=str)))
+
+    def _bump(self, conn, collection: str, owner: str):
+        if self._upsert is not None:
+            statement = self._upsert(versions).values(collection=collection, owner=owner, version=_initial_version())
+            conn.execute(statement.on_conflict_do_update(
+                index_elements=[versions.c.collection, versions.c.owner], set_={"version": versions.c.version + 1}))
+            return
+        updated = conn.execute(update(versions).where(
+            versions.c.collection == collection, versions.c.owner == owner).values(version=versions.c.version + 1)).rowcount
+        if not updated:
+            try:
+                with conn.begin_nested():
+                    conn.execute(insert(versions).values(collection=collection, owner=owner, version=_initial_version()))
+            except IntegrityError:
+                # Another worker created the row first
+                conn.execute(update(versions).where(
+                    versions.c.collection == collection, versions.c.owner == owner).values(version=versions.c.version + 1))
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # NORMAL is durable in WAL mode except for the last transactions before a power loss
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def open_store(url: str, cache: bool = CACHE_ENABLED) -> SQLStateStore:
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+    return SQLStateStore(create_engine(url, connect_args=connect_args), cache=cache)
@@ -0,0 +1,118 @@
+"""
+Content-addressed blob storage for uploaded documents.
+Uploads are streamed to disk in fixed-size chunks and hashed on the fly, so memory use
+does not grow with file size. Blobs are stored once under their SHA-256 digest; reference
+counts live in the database next to the documents that point at them. Files are published
+before the database commit and only deleted after the database says nothing references them.
+"""
+import hashlib
+import os
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import aiofiles
+import aiofiles.os
+
+CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, limit: int):
+        super().__init__(f"Upload exceeds the {limit} byte limit")
+        self.limit = limit
+
+
+@dataclass
+class StagedBlob:
+    """An upload that has been fully written and hashed but not yet published."""
+    tmp_path: Path
+    sha256: str
+    size: int
+
+
+class BlobStore:
+    def __init__(self, root: Path, chunk_size: int = CHUNK_SIZE):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.tmp_dir = self.root / "tmp"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    async def stage(self, upload, max_bytes: int = MAX_UPLOAD_BYTES) -> StagedBlob:
+        """Streams an UploadFile into a temp file, hashing it and enforcing max_bytes as it goes."""
+        known_size = getattr(upload, "size", None)
+        if known_size is not None and known_size > max_bytes:
+            raise UploadTooLarge(max_bytes)
+
+        tmp_path = self.tmp_dir / uuid.uuid4().hex
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as out:
+                while True:
+                    chunk = await upload.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise UploadTooLarge(max_bytes)
+                    digest.update(chunk)
+                    await out.write(chunk)
+        except BaseException:
+            await self.discard_path(tmp_path)
+            raise
+        return StagedBlob(tmp_path=tmp_path, sha256=digest.hexdigest(), size=size)
+
+    async def publish(self, staged: StagedBlob) -> Path:
+        """
+        Links a staged blob into place (a no-op if the content is already there). The staged copy is
+        kept until discard(), so an upload can publish again after its database commit in case a
+        concurrent delete took the file in between.
+        """
+        final_path = self.path_for(staged.sha256)
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            await aiofiles.os.link(staged.tmp_path, final_path)
+        except FileExistsError:
+            pass
+        return final_path
+
+    async def discard(self, staged: StagedBlob):
+        await self.discard_path(staged.tmp_path)
+
+    async def delete(self, sha256: str, referenced: Callable[[], bool]) -> bool:
+        """
+        Removes a blob if referenced() (a database check) says nothing points at it. The file is
+        moved aside first and put back if a reference appeared meanwhile, so an upload of the same
+        content that commits during the delete keeps its file.
+        """
+        if referenced():
+            return False
+        final_path = self.path_for(sha256)
+        trash_path = self.tmp_dir / f"{sha256}.{uuid.uuid4().hex}.deleted"
+        try:
+            await aiofiles.os.rename(final_path, trash_path)
+        except FileNotFoundError:
+            return False
+        try:
+            if referenced():
+                try:
+                    await aiofiles.os.link(trash_path, final_path)
+                except FileExistsError:
+                    pass
+                return False
+            return True
+        finally:
+            await self.discard_path(trash_path)
+
+    @staticmethod
+    async def discard_path(path: Path):
+        try:
+            await aiofiles.os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,441 @@
+"""
+Local ICD-10-CM, SNOMED CT and RxNorm terminology.
+Code tables are compiled into sorted binary index files that are memory-mapped on first use, so
+opening one costs a few microseconds and only the pages a lookup touches become resident.
+Lookups binary-search the sorted codes; name search binary-searches a sorted word index.
+
+    python -m common.terminology build                        # compile the bundled seed tables
+    python -m common.terminology build --icd10cm icd10cm_order_2025.txt \\
+        --rxnorm RXNCONSO.RRF --snomed sct2_Description_Snapshot-en_INT.txt
+    python -m common.terminology search icd10cm "type 2 diabetes"
+
+The seed tables only hold common codes; an index built from a full release is marked complete,
+and only then are unknown codes treated as invalid rather than unverified.
+"""
+import argparse
+import copy
+import mmap
+import os
+import re
+import struct
+import tempfile
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+DATA_DIR = os.getenv("TERMINOLOGY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "terminology_data"))
+
+SYSTEMS = {
+    "icd10cm": "http://hl7.org/fhir/sid/icd-10-cm",
+    "snomedct": "http://snomed.info/sct",
+    "rxnorm": "http://www.nlm.nih.gov/research/umls/rxnorm",
+}
+
+MAGIC = b"MEDXTRM1"
+# magic, record count, word count, flags, blob size
+HEADER = struct.Struct("<8sIIII")
+OFFSET = struct.Struct("<I")
+# word offset in blob, word length, record index
+WORD = struct.Struct("<IHI")
+FLAG_COMPLETE = 1
+SEP = b"\x1f"
+
+STOPWORDS = {"of", "the", "and", "or", "in", "to", "a", "an", "with", "without", "for", "by", "not", "on", "due"}
+DOSE_TOKEN = re.compile(r"^\d+(?:\.\d+)?(?:mg|mcg|g|ml|iu|units?|%)$")
+
+
+class Concept(NamedTuple):
+    system: str
+    code: str
+    display: str
+
+
+def code_key(system: str, code: str) -> str:
+    """Canonical sort key: ICD-10 without the dot and upper-cased, SNOMED/RxNorm digits only."""
+    code = str(code or "").strip()
+    if system == "icd10cm":
+        return code.replace(".", "").replace(" ", "").upper()
+    return re.sub(r"\D", "", code)
+
+
+def format_code(system: str, key: str) -> str:
+    if system == "icd10cm" and len(key) > 3:
+        return key[:3] + "." + key[3:]
+    return key
+
+
+def words(text: str) -> List[str]:
+    return [w for w in re.findall(r"[a-z0-9]+", (text or "").lower()) if w not in STOPWORDS]
+
+
+# --- Build ----------------------------------------------------------------------
+
+Row = Tuple[str, str, List[str]]
+
+
+def build(system: str, rows: Iterable[Row], path: str, complete: bool = False) -> int:
+    """Writes rows of (code, display, synonyms) as a sorted, memory-mappable index file."""
+    records: Dict[str, Tuple[str, List[str]]] = {}
+    for code, display, synonyms in rows:
+        key = code_key(system, code)
+        if not key or not display:
+            continue
+        if key in records:
+            first, names = records[key]
+            names.extend(s for s in [display] + synonyms if s and s != first and s not in names)
+        else:
+            records[key] = (display, [s for s in synonyms if s and s != display])
+
+    blob = bytearray()
+    offsets = []
+    word_entries = []
+    for index, key in enumerate(sorted(records)):
+        display, synonyms = records[key]
+        offsets.append(len(blob))
+        blob += SEP.join(x.encode("utf-8") for x in (key, display, "|".join(synonyms)))
+        for word in sorted(set(words(display)) | {w for s in synonyms for w in words(s)}):
+            word_entries.append((word.encode("utf-8"), index))
+    offsets.append(len(blob))
+
+    word_offsets = {}
+    for word, _ in word_entries:
+        if word not in word_offsets:
+            word_offsets[word] = len(blob)
+            blob += word
+    word_entries.sort()
+
+    # A private temp file per build, so concurrent builds (several workers starting) never share one
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(records), len(word_entries), FLAG_COMPLETE if complete else 0, len(blob)))
+            f.write(b"".join(OFFSET.pack(o) for o in offsets))
+            f.write(b"".join(WORD.pack(word_offsets[w], len(w), i) for w, i in word_entries))
+            f.write(blob)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return len(records)
+
+
+def read_seed(path: str) -> Iterable[Row]:
+    """code<TAB>display<TAB>synonyms separated by |; lines starting with # are comments."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            parts = line.rstrip("\n").split("\t")
+            synonyms = [s.strip() for s in parts[2].split("|")] if len(parts) > 2 and parts[2].strip() else []
+            yield parts[0].strip(), parts[1].strip(), synonyms
+
+
+def read_icd10cm_order(path: str) -> Iterable[Row]:
+    """CMS icd10cm_order_YYYY.txt (fixed width: order, code, header flag, short and long description)."""
+    with open(path, encoding="latin-1") as f:
+        for line in f:
+            if len(line) < 16:
+                continue
+            code = line[6:13].strip()
+            short, long_desc = line[16:76].strip(), line[77:].strip()
+            yield code, long_desc or short, [short] if short and short != long_desc else []
+
+
+RXNORM_TTY_RANK = {"IN": 0, "PIN": 1, "MIN": 2, "SCD": 3, "SBD": 4, "BN": 5, "SCDC": 6, "SBDC": 7, "GPCK": 8, "BPCK": 9}
+
+
+def read_rxnconso(path: str) -> Iterable[Row]:
+    """RxNorm RXNCONSO.RRF; keeps SAB=RXNORM, names each RXCUI by its most specific term type."""
+    names: Dict[str, List[Tuple[int, str]]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.split("|")
+            if len(fields) < 17 or fields[11] != "RXNORM" or fields[16] not in ("N", ""):
+                continue
+            names.setdefault(fields[0], []).append((RXNORM_TTY_RANK.get(fields[12], 50), fields[14]))
+    for rxcui, entries in names.items():
+        entries.sort()
+        yield rxcui, entries[0][1], [name for _, name in entries[1:]]
+
+
+SNOMED_FSN = "900000000000003001"
+
+
+def read_snomed_descriptions(path: str) -> Iterable[Row]:
+    """SNOMED CT RF2 description snapshot; active synonyms, with the FSN (semantic tag dropped) as display."""
+    concepts: Dict[str, Tuple[Optional[str], List[str]]] = {}
+    with open(path, encoding="utf-8") as f:
+        next(f, None)
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 8 or fields[2] != "1":
+                continue
+            fsn, synonyms = concepts.get(fields[4], (None, []))
+            if fields[6] == SNOMED_FSN:
+                fsn = re.sub(r"\s*\([^()]*\)$", "", fields[7])
+            else:
+                synonyms.append(fields[7])
+            concepts[fields[4]] = (fsn, synonyms)
+    for concept_id, (fsn, synonyms) in concepts.items():
+        display = fsn or (synonyms[0] if synonyms else "")
+        yield concept_id, display, synonyms
+
+
+SEED_FILES = {"icd10cm": "icd10cm.tsv", "snomedct": "snomedct.tsv", "rxnorm": "rxnorm.tsv"}
+
+
+def index_path(system: str, directory: str = DATA_DIR) -> str:
+    return os.path.join(directory, f"{system}.idx")
+
+
+# --- Lookup ---------------------------------------------------------------------
+
+class TerminologyIndex:
+    def __init__(self, system: str, path: str):
+        self.system = system
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.word_count, flags, blob_size = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a terminology index")
+        self.complete = bool(flags & FLAG_COMPLETE)
+        self._offsets = HEADER.size
+        self._words = self._offsets + OFFSET.size * (self.count + 1)
+        self._blob = self._words + WORD.size * self.word_count
+
+    def _record(self, i: int) -> bytes:
+        start, end = struct.unpack_from("<II", self._mm, self._offsets + OFFSET.size * i)
+        return self._mm[self._blob + start:self._blob + end]
+
+    def _key(self, i: int) -> bytes:
+        record = self._record(i)
+        return record[:record.index(SEP)]
+
+    def _concept(self, i: int) -> Concept:
+        key, display, _ = self._record(i).decode("utf-8").split("\x1f")
+        return Concept(self.system, format_code(self.system, key), display)
+
+    def _names(self, i: int) -> List[str]:
+        _, display, synonyms = self._record(i).decode("utf-8").split("\x1f")
+        return [display] + (synonyms.split("|") if synonyms else [])
+
+    def _word(self, j: int) -> Tuple[bytes, int]:
+        offset, length, record = WORD.unpack_from(self._mm, self._words + WORD.size * j)
+        return self._mm[self._blob + offset:self._blob + offset + length], record
+
+    def _lower_bound(self, count: int, key_at, target: bytes) -> int:
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key_at(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, code: str) -> Optional[Concept]:
+        key = code_key(self.system, code).encode("utf-8")
+        if not key:
+            return None
+        i = self._lower_bound(self.count, self._key, key)
+        if i < self.count and self._key(i) == key:
+            return self._concept(i)
+        return None
+
+    def codes_with_prefix(self, prefix: str, limit: int = 20) -> List[Concept]:
+        key = code_key(self.system, prefix).encode("utf-8")
+        i = self._lower_bound(self.count, self._key, key)
+        found = []
+        while i < self.count and len(found) < limit and self._key(i).startswith(key):
+            found.append(self._concept(i))
+            i += 1
+        return found
+
+    def _records_for_word(self, word: str, prefix: bool = False) -> List[int]:
+        target = word.encode("utf-8")
+        j = self._lower_bound(self.word_count, lambda k: self._word(k)[0], target)
+        records = []
+        while j < self.word_count:
+            found, record = self._word(j)
+            if not (found.startswith(target) if prefix else found == target):
+                break
+            records.append(record)
+            j += 1
+        return records
+
+    def search(self, text: str, limit: int = 10) -> List[Concept]:
+        """Concepts whose code starts with text, or whose names contain every word (the last as a prefix)."""
+        if re.fullmatch(r"[A-Za-z]?\d[\w.]*", (text or "").strip()):
+            by_code = self.codes_with_prefix(text, limit)
+            if by_code:
+                return by_code
+        query = words(text)
+        if not query:
+            return []
+        candidates = set(self._records_for_word(query[-1], prefix=True))
+        for word in query[:-1]:
+            candidates &= set(self._records_for_word(word))
+        ranked = sorted(candidates, key=lambda i: (min(len(words(n)) for n in self._names(i)), i))
+        return [self._concept(i) for i in ranked[:limit]]
+
+    def best_match(self, name: str) -> Optional[Concept]:
+        """The concept a free-text name refers to: exact name/synonym first, then the tightest name containing all its words."""
+        query = [w for w in words(name) if not DOSE_TOKEN.match(w) and not (self.system == "rxnorm" and w.isdigit())]
+        if not query:
+            return None
+        candidates = set(self._records_for_word(max(query, key=len)))
+        for word in query:
+            candidates &= set(self._records_for_word(word))
+        wanted = " ".join(query)
+        best, best_score = None, None
+        for i in candidates:
+            for candidate in self._names(i):
+                tokens = words(candidate)
+                if not set(query) <= set(tokens):
+                    continue
+                score = (0 if " ".join(tokens) == wanted else 1, len(tokens) - len(query), i)
+                if best_score is None or score < best_score:
+                    best, best_score = i, score
+        return self._concept(best) if best is not None else None
+
+
+_indexes: Dict[str, TerminologyIndex] = {}
+
+
+def needs_build(path: str, seed: str) -> bool:
+    """True if the index is missing, unreadable, or compiled from an older copy of the seed table."""
+    if not os.path.exists(path):
+        return True
+    if not os.path.exists(seed) or os.path.getmtime(seed) <= os.path.getmtime(path):
+        return False
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+        return True
+    # An index built from a full release is never replaced by the seed table
+    return not HEADER.unpack(header)[3] & FLAG_COMPLETE
+
+
+def index(system: str) -> TerminologyIndex:
+    """
+    Opens (memory-maps) the index for a system, compiling the seed table first if no index was
+    built or the seed table changed since.
+    """
+    found = _indexes.get(system)
+    if found is None:
+        path = index_path(system)
+        seed = os.path.join(DATA_DIR, SEED_FILES[system])
+        if needs_build(path, seed):
+            print(f"Terminology index {path} missing or out of date; compiling the seed table (run `python -m common.terminology build`)")
+            try:
+                build(system, read_seed(seed), path)
+            except OSError:
+                path = index_path(system, tempfile.gettempdir())
+                if needs_build(path, seed):
+                    build(system, read_seed(seed), path)
+        found = _indexes[system] = TerminologyIndex(system, path)
+    return found
+
+
+def lookup(system: str, code: str) -> Optional[Concept]:
+    return index(system).lookup(code)
+
+
+def validate(system: str, code: str) -> bool:
+    return index(system).lookup(code) is not None
+
+
+def search(system: str, text: str, limit: int = 10) -> List[Concept]:
+    return index(system).search(text, limit)
+
+
+def best_match(system: str, name: str) -> Optional[Concept]:
+    return index(system).best_match(name)
+
+
+# --- Analysis post-processing ---------------------------------------------------
+
+def _normalize_field(entity: Dict[str, Any], field: str, system: str, name: Optional[str], report: Dict[str, str]):
+    terms = index(system)
+    code = entity.get(field)
+    if code:
+        concept = terms.lookup(code)
+        if concept is not None:
+            entity[field] = concept.code
+            report[field] = "valid"
+            return
+        if not terms.complete:
+            # The seed table is not exhaustive, so an unknown code is not necessarily wrong
+            report[field] = "unverified"
+            return
+    concept = terms.best_match(name) if name else None
+    if concept is None:
+        if code:
+            report[field] = "invalid"
+            entity["requires_review"] = True
+        return
+    if code:
+        entity[f"{field}_original"] = code
+        entity["requires_review"] = True
+        report[field] = "replaced"
+    else:
+        report[field] = "filled"
+    entity[field] = concept.code
+
+
+def normalize_analysis(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validates and normalizes the codes in an analysis (extracted_entities) against the local tables:
+    known codes are reformatted, missing ones filled from the entity name, and invalid ones replaced
+    or flagged for review. Returns a copy; each entity gets a code_validation map of what happened.
+    """
+    result = copy.deepcopy(result)
+    entities = result.get("extracted_entities") or {}
+    for condition in entities.get("conditions") or []:
+        if isinstance(condition, dict):
+            report: Dict[str, str] = {}
+            _normalize_field(condition, "icd_10", "icd10cm", condition.get("clinical_text"), report)
+            if "snomed_ct" in condition:
+                _normalize_field(condition, "snomed_ct", "snomedct", condition.get("clinical_text"), report)
+            condition["code_validation"] = report
+    for medication in entities.get("medications") or []:
+        if isinstance(medication, dict):
+            report = {}
+            _normalize_field(medication, "rxnorm_code", "rxnorm", medication.get("drug_name"), report)
+            medication["code_validation"] = report
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_cmd = sub.add_parser("build", help="compile code tables into memory-mappable index files")
+    build_cmd.add_argument("--icd10cm", help="CMS icd10cm_order_*.txt")
+    build_cmd.add_argument("--rxnorm", help="RxNorm RXNCONSO.RRF")
+    build_cmd.add_argument("--snomed", help="SNOMED CT RF2 sct2_Description_Snapshot*.txt")
+    build_cmd.add_argument("--out", default=DATA_DIR)
+    search_cmd = sub.add_parser("search", help="look up a code or search names")
+    search_cmd.add_argument("system", choices=sorted(SYSTEMS))
+    search_cmd.add_argument("text")
+    args = parser.parse_args()
+
+    if args.command == "search":
+        concept = lookup(args.system, args.text)
+        for found in [concept] if concept else search(args.system, args.text):
+            print(f"{found.code}\t{found.display}")
+        return
+
+    releases = {"icd10cm": (args.icd10cm, read_icd10cm_order), "rxnorm": (args.rxnorm, read_rxnconso),
+                "snomedct": (args.snomed, read_snomed_descriptions)}
+    for system, (release, reader) in releases.items():
+        path = index_path(system, args.out)
+        if release:
+            count = build(system, reader(release), path, complete=True)
+        else:
+            count = build(system, read_seed(os.path.join(DATA_DIR, SEED_FILES[system])), path)
+        print(f"{system}: {count} concepts -> {path} ({os.path.getsize(path)} bytes{', seed' if not release else ''})")
+
+
+if __name__ == "__main__":
+    main()
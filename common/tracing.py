@@ -0,0 +1,289 @@
+"""
+Lightweight distributed tracing for the MedX services.
+Trace context travels between services in the W3C `traceparent` header. Sampled spans are
+batched on a background thread and written as OTLP/JSON lines (the OpenTelemetry file exporter
+format), and optionally POSTed to an OTLP/HTTP collector, so traces can be opened in Jaeger or
+any OTLP viewer, or inspected offline with jq.
+"""
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+# Fraction of new traces that are recorded; an incoming traceparent's sampled flag always wins
+SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0"))
+EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "traces.jsonl")
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "medx")
+
+TRACEPARENT = "traceparent"
+
+# OTLP SpanKind values
+INTERNAL, SERVER, CLIENT, PRODUCER = 1, 2, 3, 4
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "sampled",
+                 "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, kind: int, trace_id: str, parent_id: Optional[str], sampled: bool):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        if self.sampled:
+            self.attributes[key] = value
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if self.end_ns:
+            return
+        self.end_ns = time.time_ns()
+        if self.sampled:
+            exporter.submit(self)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        data = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            data["parentSpanId"] = self.parent_id
+        return data
+
+
+def _attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def parse_traceparent(value: Optional[str]):
+    """Returns (trace_id, parent_span_id, sampled) or None for a missing/malformed header."""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3][:2], 16)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def start_span(name: str, kind: int = INTERNAL, traceparent: Optional[str] = None) -> Span:
+    """Starts a span under the current one, or under `traceparent`, or as a new sampled-or-not root."""
+    parent = _current.get()
+    if parent is not None and traceparent is None:
+        return Span(name, kind, parent.trace_id, parent.span_id, parent.sampled)
+    remote = parse_traceparent(traceparent)
+    if remote:
+        trace_id, parent_id, sampled = remote
+        return Span(name, kind, trace_id, parent_id, sampled)
+    return Span(name, kind, "%032x" % random.getrandbits(128), None, random.random() < SAMPLE_RATIO)
+
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, **attributes) -> Iterator[Span]:
+    current = start_span(name, kind)
+    if current.sampled:
+        current.attributes.update(attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        current.end()
+
+
+def inject_headers(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Adds the current traceparent to outgoing request headers."""
+    headers = dict(headers or {})
+    current = _current.get()
+    if current is not None:
+        headers[TRACEPARENT] = current.traceparent()
+    return headers
+
+
+class SpanExporter:
+    """Batches finished spans on a daemon thread; the request path only does a queue put."""
+
+    def __init__(self, path: Optional[str], endpoint: Optional[str], batch_size: int = 128, interval: float = 2.0):
+        self.path = path
+        self.endpoint = endpoint.rstrip("/") + "/v1/traces" if endpoint else None
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: "queue.SimpleQueue[Optional[Span]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, finished: Span):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.shutdown)
+        self._queue.put(finished)
+
+    def _run(self):
+        batch: List[Span] = []
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                item = False
+            if item is None:
+                self._flush(batch)
+                return
+            if item:
+                batch.append(item)
+            if len(batch) >= self.batch_size or (batch and time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.interval
+
+    def _flush(self, batch: List[Span]):
+        if not batch:
+            return
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "medx.tracing"}, "spans": [s.to_otlp() for s in batch]}],
+        }]}
+        body = json.dumps(payload, separators=(",", ":"))
+        try:
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(body + "\n")
+            if self.endpoint:
+                request = urllib.request.Request(
+                    self.endpoint, data=body.encode(), headers={"Content-Type": "application/json"})
+                urllib.request.urlopen(request, timeout=5).close()
+        except Exception as e:
+            print(f"Trace export failed ({len(batch)} spans dropped): {e}")
+
+    def shutdown(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+
+exporter = SpanExporter(EXPORT_PATH, OTLP_ENDPOINT)
+
+
+def configure(service_name: str):
+    global SERVICE_NAME
+    SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", service_name)
+
+
+def instrument_engine(engine):
+    """Adds a client span per SQL statement on a SQLAlchemy engine."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        parent = _current.get()
+        if parent is None or not parent.sampled:
+            return
+        db_span = start_span("db." + (statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "query"), CLIENT)
+        db_span.set_attribute("db.system", engine.dialect.name)
+        db_span.set_attribute("db.statement", statement[:500])
+        conn.info.setdefault("medx_trace_spans", []).append(db_span)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("medx_trace_spans")
+        if spans:
+            spans.pop().end()
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        spans = context.connection.info.get("medx_trace_spans") if context.connection is not None else None
+        if spans:
+            failed = spans.pop()
+            failed.error = str(context.original_exception)
+            failed.end()
+
+
+class TracingMiddleware:
+    """Opens a server span per request, continuing the caller's trace when it sent a traceparent."""
+
+    def __init__(self, app, service_name: str):
+        self.app = app
+        configure(service_name)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+
+        server_span = start_span(scope["method"], SERVER, traceparent)
+        server_span.set_attribute("http.method", scope["method"])
+        server_span.set_attribute("http.target", scope["path"])
+        token = _current.set(server_span)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                server_span.set_attribute("http.status_code", message["status"])
+                if message["status"] >= 500:
+                    server_span.error = f"HTTP {message['status']}"
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            server_span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            route = scope.get("route")
+            server_span.name = f"{scope['method']} {getattr(route, 'path', scope['path'])}"
+            _current.reset(token)
+            server_span.end()
@@ -48,6 +48,10 @@ export const api = {
 
     // AI Service
     analyzeNote: (data) => apiRequest('ai', '/analyze-note', { method: 'POST', body: JSON.stringify(data) }),
+    getPatientAnalyses: (patientId) => apiRequest('ai', `/patients/${encodeURIComponent(patientId)}/analyses`),
+    getPatientAnalysis: (patientId, analysisId) => apiRequest('ai', `/patients/${encodeURIComponent(patientId)}/analyses/${analysisId}`),
+    getPatientConditions: (patientId) => apiRequest('ai', `/patients/${encodeURIComponent(patientId)}/conditions`),
+    getPatientsOnDrug: (drug) => apiRequest('ai', `/analyses/patients?drug=${encodeURIComponent(drug)}`),
     scanPrescription: (file) => {
         const formData = new FormData();
         formData.append('file', file);
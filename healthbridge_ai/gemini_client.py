@@ -6,6 +6,8 @@ import os
 import json
 from typing import Dict, Any, List
 
+from common import deid, drugnames, llm, notes, terminology
+
 # Try to import Google Generative AI, fall back to mock if not available
 try:
     import google.generativeai as genai
@@ -18,7 +20,10 @@ except ImportError:
 if GEMINI_AVAILABLE:
     api_key = os.getenv("GOOGLE_API_KEY", "")
     if api_key:
-        genai.configure(api_key=api_key)
+        llm.configure_gemini(genai, api_key)
+
+# Per-section results for incremental re-analysis of edited notes
+section_cache = notes.SectionCache()
 
 # System prompt based on HealthBridge_API_Prompt.md
 CLINICAL_ANALYSIS_PROMPT = """
@@ -82,26 +87,54 @@ async def analyze_clinical_note(patient_id: str, note_text: str, note_date: str
         try:
             model = genai.GenerativeModel('gemini-flash-latest')
             
+            # Structured or long notes: one prompt per group of sections, analyzed concurrently and merged
+            async def analyze_chunk(chunk: notes.Chunk, total: int) -> Dict[str, Any]:
+                prompt = (f"{CLINICAL_ANALYSIS_PROMPT}\n\nCLINICAL NOTE EXCERPT (part {chunk.index + 1} of {total}; "
+                          f"sections: {', '.join(chunk.sections)}):\n{chunk.text}\n\n"
+                          "EXTRACT all medical entities in this excerpt only and return structured JSON as specified.")
+
+                async def analyze():
+                    response = await llm.generate(
+                        model, prompt, llm.Priority.CLINICAL, kind="analyze_note_chunk",
+                        generation_config={'temperature': 0.2, 'top_p': 0.95, 'max_output_tokens': 4096},
+                    )
+                    return llm.parse_json_response(response.text)
+
+                return await llm.coalesced("analyze_note_chunk", {"chunk": llm.normalize_text(chunk.text)}, analyze)
+
+            # Sections unchanged since an earlier version of the note are reused; the rest go to the model
+            merged = await notes.analyze_incremental(note_text, analyze_chunk, section_cache, "healthbridge.analyze_note",
+                                                     check_interactions=interactions_from_model,
+                                                     summarize=summary_from_model)
+            if merged is None:
+                merged = await notes.analyze_in_chunks(note_text, analyze_chunk,
+                                                       check_interactions=interactions_from_model,
+                                                       summarize=summary_from_model)
+            if merged is not None:
+                merged = terminology.normalize_analysis(merged)
+                merged["patient_id"] = patient_id
+                return merged
+
             prompt = f"{CLINICAL_ANALYSIS_PROMPT}\n\nCLINICAL NOTE:\n{note_text}\n\nEXTRACT all medical entities and return structured JSON as specified."
             
-            response = model.generate_content(
-                prompt,
-                generation_config={
-                    'temperature': 0.2,
-                    'top_p': 0.95,
-                    'max_output_tokens': 8192,
-                }
-            )
-            
-            # Parse JSON from response
-            result_text = response.text
-            # Remove markdown code blocks if present
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0]
-            elif "```" in result_text:
-                result_text = result_text.split("```")[1].split("```")[0]
+            async def analyze():
+                response = await llm.generate(
+                    model,
+                    prompt,
+                    llm.Priority.CLINICAL,
+                    kind="analyze_note",
+                    generation_config={
+                        'temperature': 0.2,
+                        'top_p': 0.95,
+                        'max_output_tokens': 8192,
+                    }
+                )
+                return llm.parse_json_response(response.text)
             
-            result = json.loads(result_text.strip())
+            # The analysis does not depend on the patient, so identical notes share one call
+            shared = await llm.coalesced("analyze_note", {"note": llm.normalize_text(note_text)}, analyze)
+            # Codes are checked against the local tables (returns a copy, so the shared result is untouched)
+            result = terminology.normalize_analysis(shared)
             result["patient_id"] = patient_id
             return result
             
@@ -195,26 +228,40 @@ def get_mock_analysis(patient_id: str, note_text: str) -> Dict[str, Any]:
         "human_review_queue": []
     }
 
+async def interactions_from_model(medications: List[str]) -> List[Dict[str, Any]]:
+    """Gemini interaction check of a medication list; raises on failure (no mock fallback)."""
+    model = genai.GenerativeModel('gemini-flash-latest')
+    prompt = f"Check these medications for interactions: {', '.join(medications)}. \nReturn ONLY a JSON object with an 'interactions' array containing objects with: drug_a, drug_b, severity (HIGH/MODERATE/LOW), mechanism, recommendation."
+    
+    async def check():
+        response = await llm.generate(model, prompt, llm.Priority.CLINICAL, kind="check_interactions")
+        return llm.parse_json_response(response.text)
+    
+    data = await llm.coalesced("check_interactions", {"medications": llm.normalize_medications(medications)}, check)
+    return data.get("interactions", [])
+
+async def summary_from_model(summaries: List[str]) -> str:
+    """One clinical summary from the summaries of consecutive excerpts of a note; raises on failure."""
+    model = genai.GenerativeModel('gemini-flash-latest')
+    excerpts = "\n".join(f"- {s}" for s in summaries)
+    prompt = f"These are summaries of consecutive excerpts of ONE clinical note:\n{excerpts}\n\nWrite a single concise, professional clinical summary of the patient's condition, diagnosis and plan, without repeating findings. Return ONLY a JSON object: {{\"clinical_summary\": \"...\"}}"
+
+    async def summarize():
+        response = await llm.generate(model, prompt, llm.Priority.CLINICAL, kind="summarize_note")
+        return llm.parse_json_response(response.text)
+
+    data = await llm.coalesced("summarize_note", {"summaries": summaries}, summarize)
+    return data.get("clinical_summary") or ""
+
 async def check_drug_interactions(medications: List[str]) -> Dict[str, Any]:
     """
     Check for drug-drug interactions using Gemini or mock logic.
     """
     interactions = []
     
-    med_list_str = ", ".join(medications)
-    
     if GEMINI_AVAILABLE and os.getenv("GOOGLE_API_KEY"):
         try:
-            model = genai.GenerativeModel('gemini-flash-latest')
-            prompt = f"Check these medications for interactions: {med_list_str}. \nReturn ONLY a JSON object with an 'interactions' array containing objects with: drug_a, drug_b, severity (HIGH/MODERATE/LOW), mechanism, recommendation."
-            
-            response = model.generate_content(prompt)
-            result_text = response.text
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0]
-            
-            data = json.loads(result_text.strip())
-            interactions = data.get("interactions", [])
+            interactions = await interactions_from_model(medications)
         except Exception:
             # Fallback to mock
             interactions = get_mock_interactions(medications)
@@ -228,11 +275,15 @@ async def check_drug_interactions(medications: List[str]) -> Dict[str, Any]:
         "interactions": interactions
     }
 
+# Ingredient RxCUIs used by the mock interaction rules
+WARFARIN, ASPIRIN, LISINOPRIL, POTASSIUM_CHLORIDE = "11289", "1191", "29046", "8591"
+
 def get_mock_interactions(medications: List[str]) -> List[Dict[str, Any]]:
     interactions = []
-    med_set = set(med.lower() for med in medications)
+    # Brand names, typos and dose suffixes all resolve to the same ingredient
+    rxcuis = {match.rxcui for name in medications for match in drugnames.ingredients(name)}
     
-    if "warfarin" in med_set and "aspirin" in med_set:
+    if WARFARIN in rxcuis and ASPIRIN in rxcuis:
         interactions.append({
             "drug_a": "Warfarin",
             "drug_b": "Aspirin",
@@ -241,7 +292,7 @@ def get_mock_interactions(medications: List[str]) -> List[Dict[str, Any]]:
             "recommendation": "Monitor INR closely. Consider alternative antiplatelet agent."
         })
     
-    if "lisinopril" in med_set and any("potassium" in m.lower() for m in medications):
+    if LISINOPRIL in rxcuis and (POTASSIUM_CHLORIDE in rxcuis or any("potassium" in m.lower() for m in medications)):
         interactions.append({
             "drug_a": "Lisinopril",
             "drug_b": "Potassium supplement",
@@ -249,36 +300,44 @@ def get_mock_interactions(medications: List[str]) -> List[Dict[str, Any]]:
             "mechanism": "Risk of hyperkalemia",
             "recommendation": "Monitor serum potassium levels regularly."
         })
+    
+    return interactions
+
 async def de_identify_note(note_text: str) -> str:
-    """De-identify clinical note (HIPAA Safe Harbor) using Gemini."""
-    if GEMINI_AVAILABLE and os.getenv("GOOGLE_API_KEY"):
+    """De-identify clinical note (HIPAA Safe Harbor) locally; Gemini only reviews residual sentences if enabled."""
+    result = deid.deidentify(note_text)
+    if deid.LLM_SECOND_PASS and GEMINI_AVAILABLE and os.getenv("GOOGLE_API_KEY"):
         try:
             model = genai.GenerativeModel('gemini-flash-latest')
-            prompt = f"TASK: De-identify Clinical Note (HIPAA Safe Harbor)\n\nCLINICAL NOTE:\n{note_text}\n\nINSTRUCTIONS:\n1. Remove all 18 HIPAA identifiers.\n2. Replace with generic placeholders like [PATIENT_NAME], [DATE].\n3. Preserve clinical context.\n\nOUTPUT: Return the de-identified text ONLY."
-            response = model.generate_content(prompt)
-            return response.text.strip()
-        except Exception:
-            return "[DE-IDENTIFIED] " + note_text[:100] + "..."
-    return "[DE-IDENTIFIED] " + note_text[:100] + "..."
+            result = await llm.coalesced("de_identify", {"note": result.text},
+                                         lambda: deid.llm_second_pass(result, model))
+        except Exception as e:
+            print(f"De-identification second pass failed, keeping local result: {e}")
+    return result.text
+
+async def coaching_from_model(patient_context: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Personalized medication adherence coaching from Gemini. Raises when Gemini is unavailable or
+    fails, so the coaching worker keeps the patient's previous cards instead of storing mock ones.
+    """
+    if not (GEMINI_AVAILABLE and os.getenv("GOOGLE_API_KEY")):
+        raise RuntimeError("Gemini is not configured")
+    model = genai.GenerativeModel('gemini-flash-latest')
+    prompt = f"TASK: Generate Personalized Patient Adherence Coaching\n\nCONTEXT:\n{json.dumps(patient_context)}\n\nGENERATE JSON array of coaching cards with keys: medication, message (patient-friendly), timing, importance (high/medium/low)."
+
+    async def coach():
+        response = await llm.generate(model, prompt, llm.Priority.BACKGROUND, kind="generate_coaching")
+        return llm.parse_json_response(response.text)
+
+    return await llm.coalesced("generate_coaching", patient_context, coach)
 
 async def generate_patient_coaching(patient_context: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
     Generate personalized medication adherence coaching using Gemini.
     """
-    if GEMINI_AVAILABLE and os.getenv("GOOGLE_API_KEY"):
-        try:
-            model = genai.GenerativeModel('gemini-flash-latest')
-            prompt = f"TASK: Generate Personalized Patient Adherence Coaching\n\nCONTEXT:\n{json.dumps(patient_context)}\n\nGENERATE JSON array of coaching cards with keys: medication, message (patient-friendly), timing, importance (high/medium/low)."
-            
-            response = model.generate_content(prompt)
-            result_text = response.text
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0]
-            
-            return json.loads(result_text.strip())
-        except Exception:
-            return get_mock_coaching()
-    else:
+    try:
+        return await coaching_from_model(patient_context)
+    except Exception:
         return get_mock_coaching()
 
 def get_mock_coaching() -> List[Dict[str, Any]]:
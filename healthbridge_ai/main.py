@@ -7,11 +7,17 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from gemini_client import analyze_clinical_note, check_drug_interactions
+from gemini_client import analyze_clinical_note, check_drug_interactions, coaching_from_model, get_mock_coaching
 from vision_ocr import extract_prescription_data
+from common import coaching, compression, deadline, drugnames, llm, metrics, profiling, responses, statestore, tracing
 
-app = FastAPI(title="HealthBridge AI")
+app = FastAPI(title="HealthBridge AI", default_response_class=responses.FastJSONResponse)
 
+app.add_middleware(profiling.ProfilerMiddleware)
+app.add_middleware(deadline.DeadlineMiddleware)
+app.add_middleware(tracing.TracingMiddleware, service_name="healthbridge-ai")
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(compression.CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -28,13 +34,22 @@ class ClinicalNote(BaseModel):
 class MedicationsRequest(BaseModel):
     medications: List[str]
 
+class CoachingRefresh(BaseModel):
+    patient_id: str
+    medications: List[Dict[str, Any]]
+
 @app.get("/")
 def root():
     return {"status": "HealthBridge AI is running", "version": "1.0.0"}
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy", "service": "healthbridge-ai"}
+    return {"status": "healthy", "service": "healthbridge-ai", "llm": llm.stats(), "coaching": coaching_worker.stats()}
+
+# Prometheus scrape target; set METRICS_TOKEN to require a bearer token
+app.add_route("/metrics", metrics.metrics_endpoint, include_in_schema=False)
+# Slow-request profiles and runtime profiler switch; needs PROFILER_TOKEN
+app.include_router(profiling.router)
 
 @app.post("/analyze-note")
 async def analyze_note(note: ClinicalNote):
@@ -42,21 +57,46 @@ async def analyze_note(note: ClinicalNote):
 
 @app.post("/scan-prescription")
 async def scan_prescription(file: UploadFile = File(...)):
-    return await extract_prescription_data(await file.read())
+    return await extract_prescription_data(await file.read(), file.content_type or "image/jpeg")
 
 @app.post("/check-interactions")
 async def check_interactions(req: MedicationsRequest):
     return await check_drug_interactions(req.medications)
 
+@app.post("/normalize-medications")
+async def normalize_medications(req: MedicationsRequest):
+    """Resolves free-text names (brands, typos, dose suffixes) to ingredient RxCUIs."""
+    return {"status": "success", "medications": drugnames.normalize_many(req.medications)}
+
 @app.post("/de-identify")
 async def de_identify(note: ClinicalNote):
     from gemini_client import de_identify_note
     return {"status": "success", "de_identified_text": await de_identify_note(note.note_text)}
 
+# Coaching cards are generated per medication set in the background and served from the store,
+# which is shared between workers only when STATE_DATABASE_URL is set
+STATE_DATABASE_URL = os.getenv("STATE_DATABASE_URL")
+coaching_worker = coaching.CoachingWorker(
+    lambda patient_id, context: coaching_from_model(context),
+    coaching.CoachingStore(statestore.open_store(STATE_DATABASE_URL) if STATE_DATABASE_URL else None),
+)
+
+@app.post("/coaching/refresh")
+async def refresh_coaching(req: CoachingRefresh):
+    """Called by patient-service when a patient's medications change; regeneration is debounced."""
+    coaching_worker.schedule(req.patient_id, req.medications)
+    return {"status": "scheduled"}
+
 @app.post("/generate-coaching")
 async def generate_coaching(patient_context: Dict[str, Any]):
-    from gemini_client import generate_patient_coaching
-    return {"status": "success", "coaching_messages": await generate_patient_coaching(patient_context)}
+    medications = patient_context.get("medications") or []
+    context = coaching.patient_context(patient_context)
+    patient_id = patient_context.get("patient_id") or "meds:" + coaching.fingerprint(medications, context)
+    result = await coaching_worker.fetch(str(patient_id), medications, context)
+    if result["generated_at"] is None:
+        # Nothing generated yet (Gemini unavailable or failing): show the mock cards without storing them
+        result["coaching_messages"] = get_mock_coaching()
+    return {"status": "success", **result}
 
 if __name__ == "__main__":
     import uvicorn
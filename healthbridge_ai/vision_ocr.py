@@ -0,0 +1,277 @@
+"""
+Prescription OCR for HealthBridge AI.
+Text is extracted by a pluggable local OCR backend running in a process pool, then parsed into
+structured medications. Gemini vision is only consulted when the local result is not confident.
+"""
+import asyncio
+import io
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import gemini_client
+from common import drugnames, llm
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    import pytesseract
+    TESSERACT_AVAILABLE = True
+except ImportError:
+    TESSERACT_AVAILABLE = False
+    print("Warning: pytesseract not installed. Prescription OCR will rely on Gemini.")
+
+OCR_BACKEND = os.getenv("OCR_BACKEND", "tesseract")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+# Mean word confidence (0-100) below which Gemini is asked instead
+OCR_MIN_CONFIDENCE = float(os.getenv("OCR_MIN_CONFIDENCE", "70"))
+
+
+@dataclass
+class OCRResult:
+    text: str
+    confidence: float
+    engine: str
+
+
+class OCRBackend:
+    """Base class for local OCR engines. recognize() runs inside a pool worker process."""
+    name = "base"
+
+    def available(self) -> bool:
+        return False
+
+    def recognize(self, image_bytes: bytes) -> OCRResult:
+        raise NotImplementedError
+
+
+class TesseractBackend(OCRBackend):
+    name = "tesseract"
+    # Tesseract is most accurate around 300 DPI, i.e. roughly 2500px across an A5/A4 prescription
+    target_width = 2500
+
+    def available(self) -> bool:
+        return TESSERACT_AVAILABLE and PIL_AVAILABLE
+
+    def prepare(self, image_bytes: bytes):
+        image = Image.open(io.BytesIO(image_bytes))
+        image.draft("L", (self.target_width, self.target_width))
+        image = ImageOps.exif_transpose(image).convert("L")
+        if image.width < self.target_width // 2:
+            scale = self.target_width / image.width
+            image = image.resize((self.target_width, int(image.height * scale)), Image.LANCZOS)
+        elif image.width > self.target_width * 1.5:
+            image.thumbnail((self.target_width, self.target_width * 2), Image.LANCZOS)
+        return ImageOps.autocontrast(image, cutoff=1)
+
+    def recognize(self, image_bytes: bytes) -> OCRResult:
+        image = self.prepare(image_bytes)
+        # psm 6: a single uniform block of text suits printed and typed prescriptions
+        data = pytesseract.image_to_data(image, config="--oem 1 --psm 6", output_type=pytesseract.Output.DICT)
+        lines: Dict[tuple, List[str]] = {}
+        confidences = []
+        for i, word in enumerate(data["text"]):
+            word = word.strip()
+            conf = float(data["conf"][i])
+            if not word or conf < 0:
+                continue
+            confidences.append(conf)
+            key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            lines.setdefault(key, []).append(word)
+        text = "\n".join(" ".join(words) for _, words in sorted(lines.items()))
+        confidence = sum(confidences) / len(confidences) if confidences else 0.0
+        return OCRResult(text=text, confidence=round(confidence, 1), engine=self.name)
+
+
+BACKENDS: Dict[str, Callable[[], OCRBackend]] = {
+    "tesseract": TesseractBackend,
+}
+
+
+def register_backend(name: str, factory: Callable[[], OCRBackend]):
+    BACKENDS[name] = factory
+
+
+_worker_backend: Optional[OCRBackend] = None
+
+
+def _recognize_in_worker(backend_name: str, image_bytes: bytes) -> OCRResult:
+    # One backend instance per worker process, created on first use
+    global _worker_backend
+    if _worker_backend is None or _worker_backend.name != backend_name:
+        _worker_backend = BACKENDS[backend_name]()
+    return _worker_backend.recognize(image_bytes)
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=OCR_WORKERS)
+    return _pool
+
+
+# --- Medication parsing -------------------------------------------------------
+
+FORM_PREFIX = r"(?:(?:tab|tabs|tablet|cap|caps|capsule|syp|syrup|inj|susp|oint|drops?)\.?\s+)"
+STRENGTH = r"(\d+(?:\.\d+)?\s*(?:mg|mcg|µg|g|ml|iu|units?|%)(?:\s*/\s*\d*\s*(?:ml|g))?)"
+FREQUENCIES = {
+    r"\b(?:od|qd|once\s+(?:a\s+)?daily|once\s+a\s+day|daily)\b": "Once daily",
+    r"\b(?:bd|bid|twice\s+(?:a\s+)?daily|twice\s+a\s+day)\b": "Twice daily",
+    r"\b(?:tds|tid|thrice\s+daily|three\s+times\s+(?:a\s+)?day)\b": "Three times daily",
+    r"\b(?:qid|four\s+times\s+(?:a\s+)?day)\b": "Four times daily",
+    r"\b(?:hs|qhs|at\s+bedtime|at\s+night)\b": "At bedtime",
+    r"\b(?:prn|sos|as\s+needed)\b": "As needed",
+    r"\bq\s*(\d+)\s*h(?:rs?|ours?)?\b": "Every {0} hours",
+}
+FREQUENCY_PATTERNS = [(re.compile(p, re.IGNORECASE), label) for p, label in FREQUENCIES.items()]
+# Indian-style morning-noon-night dosing, e.g. 1-0-1
+DOSING_GRID = re.compile(r"\b([0-2](?:\.5)?)\s*-\s*([0-2](?:\.5)?)\s*-\s*([0-2](?:\.5)?)\b")
+DURATION = re.compile(r"(?:x|for)\s*(\d+)\s*(d|days?|w|wks?|weeks?|m|months?)\b", re.IGNORECASE)
+MED_LINE = re.compile(
+    r"^\s*(?:\d+[.)]\s*)?(?:rx[:.]?\s*)?" + FORM_PREFIX + r"?"
+    r"([A-Za-z][A-Za-z\-]+(?:\s+[A-Za-z][A-Za-z\-]+){0,2}?)\s+" + STRENGTH,
+    re.IGNORECASE,
+)
+DURATION_UNITS = {"d": "days", "w": "weeks", "m": "months"}
+
+
+def _frequency(line: str) -> str:
+    grid = DOSING_GRID.search(line)
+    if grid:
+        return "-".join(grid.groups()) + " (morning-noon-night)"
+    for pattern, label in FREQUENCY_PATTERNS:
+        match = pattern.search(line)
+        if match:
+            return label.format(*match.groups())
+    return ""
+
+
+def _duration(line: str) -> str:
+    match = DURATION.search(line)
+    if not match:
+        return ""
+    count, unit = match.groups()
+    return f"{count} {DURATION_UNITS[unit[0].lower()]}"
+
+
+def parse_medications(text: str) -> List[Dict[str, str]]:
+    """Pulls name/dosage/frequency/duration out of OCR lines that look like medication orders."""
+    medications = []
+    for line in text.splitlines():
+        match = MED_LINE.match(line)
+        if not match:
+            continue
+        name, strength = match.groups()
+        medications.append(drugnames.annotate({
+            "name": name.strip().title(),
+            "dosage": re.sub(r"\s+", "", strength),
+            "frequency": _frequency(line),
+            "duration": _duration(line),
+        }))
+    return medications
+
+
+# --- Extraction entry point ---------------------------------------------------
+
+async def run_local_ocr(image_bytes: bytes, backend_name: str = OCR_BACKEND) -> Optional[OCRResult]:
+    backend = BACKENDS.get(backend_name)
+    if backend is None or not backend().available():
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), _recognize_in_worker, backend_name, image_bytes)
+
+
+async def extract_with_gemini(image_bytes: bytes, mime_type: str, ocr_hint: str = "") -> Optional[Dict[str, Any]]:
+    if not (gemini_client.GEMINI_AVAILABLE and os.getenv("GOOGLE_API_KEY")):
+        return None
+    try:
+        model = gemini_client.genai.GenerativeModel('gemini-flash-latest')
+        prompt = (
+            "Analyze this prescription image. Extract all medications with their dosage, frequency, and duration, "
+            "and provide a raw transcription of the relevant text.\n"
+            + (f"A local OCR pass read (may contain errors):\n{ocr_hint}\n" if ocr_hint else "")
+            + 'Return ONLY JSON: {"medications": [{"name": "...", "dosage": "...", "frequency": "...", "duration": "..."}], "raw_text": "..."}'
+        )
+        response = await llm.generate(model, [prompt, {"mime_type": mime_type, "data": image_bytes}], llm.Priority.STANDARD, kind="scan_prescription")
+        return llm.parse_json_response(response.text)
+    except Exception as e:
+        print(f"Gemini OCR fallback error: {e}")
+        return None
+
+
+async def extract_prescription_data(image_bytes: bytes, mime_type: str = "image/jpeg") -> Dict[str, Any]:
+    """
+    Local OCR first; Gemini only when OCR confidence is below OCR_MIN_CONFIDENCE or no
+    medication could be parsed from the text.
+    """
+    ocr = None
+    try:
+        ocr = await run_local_ocr(image_bytes)
+    except Exception as e:
+        print(f"Local OCR error: {e}")
+
+    medications = parse_medications(ocr.text) if ocr else []
+    if ocr and ocr.confidence >= OCR_MIN_CONFIDENCE and medications:
+        return {
+            "status": "success",
+            "medications": medications,
+            "raw_text": ocr.text,
+            "engine": ocr.engine,
+            "ocr_confidence": ocr.confidence,
+            "requires_review": False,
+        }
+
+    gemini_result = await extract_with_gemini(image_bytes, mime_type, ocr.text if ocr else "")
+    if gemini_result is not None:
+        gemini_result.setdefault("status", "success")
+        gemini_result["medications"] = [drugnames.annotate(m) for m in gemini_result.get("medications") or [] if isinstance(m, dict)]
+        gemini_result["engine"] = "gemini"
+        gemini_result["ocr_confidence"] = ocr.confidence if ocr else None
+        gemini_result["requires_review"] = False
+        return gemini_result
+
+    # Nothing better available: hand back what OCR found and flag it for a human
+    return {
+        "status": "success",
+        "medications": medications,
+        "raw_text": ocr.text if ocr else "",
+        "engine": ocr.engine if ocr else "none",
+        "ocr_confidence": ocr.confidence if ocr else None,
+        "requires_review": True,
+    }
+
+
+def benchmark(paths: List[str], backend_name: str = OCR_BACKEND, rounds: int = 3):
+    """Reports single-core OCR throughput: python vision_ocr.py bench img1.jpg img2.png ..."""
+    backend = BACKENDS[backend_name]()
+    if not backend.available():
+        print(f"OCR backend '{backend_name}' is not available on this machine.")
+        return
+    images = [open(p, "rb").read() for p in paths]
+    backend.recognize(images[0])  # warm up language data
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for image in images:
+            backend.recognize(image)
+    elapsed = time.perf_counter() - start
+    count = rounds * len(images)
+    print(f"{backend_name}: {count} images in {elapsed:.2f}s -> {count / elapsed:.2f} images/s per core "
+          f"({1000 * elapsed / count:.0f} ms/image); the service runs {OCR_WORKERS} such workers")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "bench":
+        benchmark(sys.argv[2:])
+    else:
+        print("usage: python vision_ocr.py bench <image> [<image> ...]")
@@ -1,29 +1,27 @@
+import os
 import uuid
 from datetime import datetime
 
-# Mock database for MVP
-_MOCK_DB = {}
+from common import statestore
+
+# Shared by every worker of the service (SQLite in WAL mode by default; point it at Postgres to scale out)
+STATE_DATABASE_URL = os.getenv("STATE_DATABASE_URL", "sqlite:///patient_state.db")
+
+_store = statestore.open_store(STATE_DATABASE_URL)
 
 def add_medication(user_id: str, data: dict) -> dict:
-    med_id = str(uuid.uuid4())
-    data["id"] = med_id
+    data["id"] = str(uuid.uuid4())
     data["created_at"] = datetime.now().isoformat()
-    
-    if user_id not in _MOCK_DB:
-        _MOCK_DB[user_id] = {"medications": [], "adherence": []}
-    
-    _MOCK_DB[user_id]["medications"].append(data)
-    return data
+    return _store.add("medications", user_id, data)
 
 def get_medications(user_id: str) -> list:
-    return _MOCK_DB.get(user_id, {}).get("medications", [])
+    return _store.list("medications", user_id)
+
+def delete_medication(user_id: str, med_id: str) -> bool:
+    return _store.delete("medications", user_id, med_id)
 
 def log_adherence(user_id: str, data: dict) -> str:
     log_id = str(uuid.uuid4())
     data["id"] = log_id
-    
-    if user_id not in _MOCK_DB:
-        _MOCK_DB[user_id] = {"medications": [], "adherence": []}
-        
-    _MOCK_DB[user_id]["adherence"].append(data)
+    _store.add("adherence", user_id, data)
     return log_id
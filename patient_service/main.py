@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
@@ -6,9 +6,17 @@ import os
 import firestore
 import auth
 import events
+import requests
+from common import compression, drugnames, metrics, profiling, responses, tracing
 
-app = FastAPI(title="HealthBridge Patient Service")
+AI_SERVICE_URL = os.getenv("AI_SERVICE_URL", "http://healthbridge-ai:8082")
 
+app = FastAPI(title="HealthBridge Patient Service", default_response_class=responses.FastJSONResponse)
+
+app.add_middleware(profiling.ProfilerMiddleware)
+app.add_middleware(tracing.TracingMiddleware, service_name="patient-service")
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(compression.CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -41,13 +49,41 @@ async def get_current_user(authorization: str = Header(None)):
 def health_check():
     return {"status": "healthy", "service": "patient-service"}
 
+# Prometheus scrape target; set METRICS_TOKEN to require a bearer token
+app.add_route("/metrics", metrics.metrics_endpoint, include_in_schema=False)
+# Slow-request profiles and runtime profiler switch; needs PROFILER_TOKEN
+app.include_router(profiling.router)
+
 @app.get("/medications", response_model=List[dict])
 async def list_medications(user: dict = Depends(get_current_user)):
-    return firestore.get_medications(user["uid"])
+    return responses.FastJSONResponse(firestore.get_medications(user["uid"]))
+
+def refresh_coaching(user_id: str):
+    """Tells HealthBridge AI to regenerate this patient's coaching cards (debounced there)."""
+    medications = [{k: m.get(k) for k in ("name", "dosage", "frequency")} for m in firestore.get_medications(user_id)]
+    try:
+        with tracing.span("POST /coaching/refresh", tracing.CLIENT, **{"peer.service": "healthbridge-ai"}):
+            requests.post(
+                f"{AI_SERVICE_URL}/coaching/refresh",
+                json={"patient_id": user_id, "medications": medications},
+                headers=tracing.inject_headers(),
+                timeout=5,
+            )
+    except requests.RequestException as e:
+        print(f"Coaching refresh not delivered: {e}")
 
 @app.post("/medications")
-async def add_medication(med: Medication, user: dict = Depends(get_current_user)):
-    return firestore.add_medication(user["uid"], med.dict())
+async def add_medication(med: Medication, background_tasks: BackgroundTasks, user: dict = Depends(get_current_user)):
+    result = firestore.add_medication(user["uid"], drugnames.annotate(med.dict()))
+    background_tasks.add_task(refresh_coaching, user["uid"])
+    return result
+
+@app.delete("/medications/{med_id}")
+async def delete_medication(med_id: str, background_tasks: BackgroundTasks, user: dict = Depends(get_current_user)):
+    if not firestore.delete_medication(user["uid"], med_id):
+        raise HTTPException(status_code=404, detail="Medication not found")
+    background_tasks.add_task(refresh_coaching, user["uid"])
+    return {"status": "success"}
 
 @app.post("/adherence")
 async def log_adherence(log: AdherenceLog, user: dict = Depends(get_current_user)):
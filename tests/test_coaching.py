@@ -0,0 +1,48 @@
+import asyncio
+
+from common import coaching, deadline, statestore, tracing
+
+
+def test_debounced_refresh_does_not_inherit_request_context():
+    seen = []
+
+    async def generate(patient_id, context):
+        seen.append((deadline.remaining(), tracing.current_span()))
+        await deadline.bounded(asyncio.sleep(0.2))
+        return [{"medication": "Metformin"}]
+
+    async def main():
+        worker = coaching.CoachingWorker(generate, debounce=0.05)
+
+        async def request():
+            deadline.set_timeout(0.1)
+            with tracing.span("POST /api/medications"):
+                worker.schedule("p1", [{"name": "Metformin"}])
+
+        await request()
+        await asyncio.sleep(0.4)
+        return worker
+
+    worker = asyncio.run(main())
+    assert seen == [(None, None)]
+    assert worker.cards("p1")["coaching_messages"] == [{"medication": "Metformin"}]
+
+
+def test_workers_sharing_a_state_store_serve_the_same_cards(tmp_path):
+    calls = []
+
+    async def generate(patient_id, context):
+        calls.append(patient_id)
+        return [{"medication": "Metformin"}]
+
+    state = statestore.open_store(f"sqlite:///{tmp_path / 'state.db'}")
+    first = coaching.CoachingWorker(generate, coaching.CoachingStore(state))
+    second = coaching.CoachingWorker(generate, coaching.CoachingStore(statestore.open_store(f"sqlite:///{tmp_path / 'state.db'}")))
+    medications = [{"name": "Metformin"}]
+
+    asyncio.run(first.fetch("p1", medications))
+    result = second.cards("p1", medications)
+
+    assert calls == ["p1"]
+    assert result["coaching_messages"] == [{"medication": "Metformin"}]
+    assert not result["stale"]
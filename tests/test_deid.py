@@ -0,0 +1,38 @@
+from common import deid
+
+
+def redact(text: str) -> str:
+    return deid.deidentify(text).text
+
+
+def test_possessive_surname_is_redacted():
+    assert redact("Smith's daughter called.") == "[NAME_1]'s daughter called."
+
+
+def test_possessive_first_name_is_redacted():
+    assert redact("John's wife brought him in.") == "[NAME_1]'s wife brought him in."
+
+
+def test_possessive_after_title_shares_surrogate_with_bare_name():
+    assert redact("Mr. Smith's BP was high. Smith agreed.") == "Mr. [NAME_1]'s BP was high. [NAME_1] agreed."
+
+
+def test_apostrophe_names_after_title():
+    assert redact("Seen by Dr. O'Neil; Dr. O'Brien consulted.") == "Seen by Dr. [NAME_1]; Dr. [NAME_2] consulted."
+
+
+def test_facility_and_city():
+    assert redact("Seen at Mercy Hospital in Boston.") == "Seen at [LOCATION_1] in [LOCATION_2]."
+
+
+def test_multi_word_facility_and_city():
+    assert redact("Transferred to St. Mary's Medical Center from New Delhi.") == \
+        "Transferred to [LOCATION_1] from [LOCATION_2]."
+
+
+def test_generic_facility_word_is_kept():
+    assert redact("Blood pressure in Clinic was high.") == "Blood pressure in Clinic was high."
+
+
+def test_city_prefix_alone_is_kept():
+    assert redact("New patient, seen in San Jose.") == "New patient, seen in [LOCATION_1]."
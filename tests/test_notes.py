@@ -0,0 +1,20 @@
+from common import notes
+
+NOTE = (
+    "Chief Complaint: cough.\n"
+    "Medications: metformin 500mg daily.\n"
+    "History of Present Illness: " + "Patient reports a dry cough for two weeks. " * 200 + "\n"
+    "Plan: follow up in two weeks.\n"
+)
+
+
+def test_units_stay_within_max_tokens():
+    units = notes.units(NOTE, max_tokens=500, min_tokens=100)
+    assert all(unit.tokens <= 500 for unit in units)
+    assert "".join(unit.text for unit in units) == NOTE
+
+
+def test_sections_before_an_oversized_one_form_their_own_unit():
+    units = notes.units(NOTE, max_tokens=500, min_tokens=100)
+    assert units[0].sections == ["Chief Complaint", "Medications"]
+    assert all(section.startswith("HPI (part ") for unit in units[1:-1] for section in unit.sections)
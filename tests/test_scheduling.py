@@ -0,0 +1,13 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from common import scheduling
+
+
+def test_now_is_clinic_wall_time(monkeypatch):
+    monkeypatch.setattr(scheduling, "CLINIC_ZONE", ZoneInfo("Pacific/Kiritimati"))
+    expected = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=14)
+    now = scheduling.now()
+    assert now.tzinfo is None
+    assert abs(now - expected) < timedelta(minutes=1)
+    assert scheduling.today() == scheduling.now().date()
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from common import deadline
+from common.singleflight import SingleFlight
+
+
+def test_follower_outlives_leader_deadline():
+    flight = SingleFlight()
+    calls = []
+
+    async def shared():
+        calls.append(deadline.remaining())
+        # Work inside the shared call checks whatever deadline its context carries
+        await deadline.bounded(asyncio.sleep(0.5))
+        return "result"
+
+    async def waiter(timeout: float, delay: float):
+        await asyncio.sleep(delay)
+        deadline.set_timeout(timeout)
+        return await deadline.bounded(flight.do("key", shared))
+
+    async def main():
+        return await asyncio.gather(waiter(0.2, 0), waiter(5, 0.05), return_exceptions=True)
+
+    leader, follower = asyncio.run(main())
+    assert isinstance(leader, deadline.DeadlineExceeded)
+    assert follower == "result"
+    assert calls == [None]
+
+
+def test_waiter_deadline_still_applies():
+    flight = SingleFlight()
+
+    async def shared():
+        await asyncio.sleep(0.3)
+        return "result"
+
+    async def main():
+        deadline.set_timeout(0.05)
+        await deadline.bounded(flight.do("key", shared))
+
+    with pytest.raises(deadline.DeadlineExceeded):
+        asyncio.run(main())
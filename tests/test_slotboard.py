@@ -0,0 +1,30 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from common import scheduling, slotboard
+
+pytestmark = pytest.mark.skipif(not slotboard.NUMPY_AVAILABLE, reason="numpy not installed")
+
+MONDAY = date(2026, 10, 19)
+
+
+def board(availability, appointments=()):
+    doctor = slotboard.DoctorRow(1, "Dr. A", "Cardiology", 1, "Clinic", availability)
+    return slotboard.SlotBoard([doctor], appointments, MONDAY, days=7)
+
+
+def test_starts_follow_the_calendar_grid():
+    availability = "Mon 10:15am-1pm"
+    appointments = [(1, datetime(2026, 10, 19, 11, 0))]
+    found = board(availability, appointments).search(datetime(2026, 10, 19), datetime(2026, 10, 20), per_doctor=20)
+
+    calendar = scheduling.DoctorCalendar([(7, datetime(2026, 10, 19, 11, 0))])
+    expected = calendar.free_slots(scheduling.parse_availability(availability), MONDAY, MONDAY)
+    assert [scheduling.minute_of(slot.start) for slot in found] == expected
+
+
+def test_search_stops_at_the_horizon():
+    found_board = board("Daily 9am-5pm")
+    assert found_board.end == datetime(2026, 10, 26)
+    assert found_board.search(found_board.end, found_board.end + timedelta(days=7)) == []